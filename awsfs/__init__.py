@@ -1 +1 @@
-from awsfs import AwsOps
+from awsfs import AwsFUSE, AwsOps
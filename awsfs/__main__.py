@@ -1,6 +1,7 @@
 import boto3
 import logging
 import logging.handlers
+import os
 from sys import argv, exit, stderr
 
 from botocore.exceptions import NoCredentialsError
@@ -20,6 +21,20 @@ The simplest way is to set AWS_ACCESS_KEY_ID and
 AWS_SECRET_ACCESS_KEY. See the AWS docs for other
 methods.
 
+To answer at once after a remount, set AWSFS_CACHE_DIR
+to a directory where awsfs can keep what it fetches.
+
+The kernel caches the attributes and names of files
+for AWSFS_ATTR_TIMEOUT and AWSFS_ENTRY_TIMEOUT seconds
+(5 by default) before asking awsfs again.
+
+To record every AWS call awsfs makes, with its response
+and timing, set AWSFS_RECORD to the file to write them
+to. To mount the AWS seen in such a recording, without
+going to AWS at all, set AWSFS_REPLAY to its file. Each
+call then takes as long as it did when recorded, times
+AWSFS_REPLAY_LATENCY_SCALE (1 by default; 0 for none).
+
 path    Where awsfs should be mounted (e.g. ~/aws).
         Must be a directory that exists and you can
         write.'''
@@ -40,13 +55,32 @@ def main():
         error('or from homebrew: `brew install Caskroom/cask/osxfuse`.')
         exit(2)
 
-    from awsfs import AwsOps
-
-    test_boto_conn()
+    from awsfs import AwsFUSE, AwsOps
+    from clients import registry
+    from stats import install_dump_signal
+    from traffic import Player, Recorder
+
+    if os.environ.get('AWSFS_REPLAY'):
+        registry.use_session(Player(
+            os.environ['AWSFS_REPLAY'],
+            float(os.environ.get('AWSFS_REPLAY_LATENCY_SCALE', 1))
+        ).make_session())
+    else:
+        test_boto_conn()
+        if os.environ.get('AWSFS_RECORD'):
+            registry.use_session(
+                Recorder(os.environ['AWSFS_RECORD']).make_session())
 
     setup_logging()
 
-    FUSE(AwsOps(), argv[1], foreground=False)
+    install_dump_signal()
+
+    # auto_inval_data makes the kernel drop the pages it kept of a file
+    # (see VNode.keeps_cache) once the file's mtime or size changes
+    AwsFUSE(AwsOps(cache_dir=os.environ.get('AWSFS_CACHE_DIR')), argv[1],
+            foreground=False, raw_fi=True, auto_inval_data=True,
+            attr_timeout=float(os.environ.get('AWSFS_ATTR_TIMEOUT', 5)),
+            entry_timeout=float(os.environ.get('AWSFS_ENTRY_TIMEOUT', 5)))
 
 
 def error(line):
@@ -1,14 +1,23 @@
 import logging
 import os
 from errno import *
+from itertools import count
+from threading import Lock
 from time import time
 
 from botocore.exceptions import NoCredentialsError, \
     PartialCredentialsError, ClientError
-from fuse import FuseOSError, Operations
+from fuse import FUSE, FuseOSError, Operations, c_stat, set_st_attrs
 
+import stats
+from cache import LoadingCache, cache_stats, default_budget
+from clients import registry
+from format import to_json
 from iam import iam_root
+from memo import memo
+from store import DiskStore
 from dynamo import dynamo_root
+from governor import THROTTLE_CODES
 from ec2 import ec2_root
 from elb import elb_root
 from s3 import s3_root
@@ -18,15 +27,56 @@ from vfs import *
 log = logging.getLogger('awsfs')
 
 
+# Most entries readdir returns at once. The kernel only takes what fits in
+# its buffer and asks again from where it left off.
+READDIR_BATCH = 256
+
+
 class AwsOps(Operations):
-    def __init__(self):
+    """
+    :param cache_dir    If given, where to keep what's fetched from AWS
+                        across mounts.
+    """
+    def __init__(self, cache_dir=None):
+        # The store is opened in init, once FUSE has daemonized, so that
+        # its SQLite connection isn't carried across the fork
+        self.cache_dir = cache_dir
+
         self.root = RootDir()
+        # The time of nodes that don't know theirs. Unlike the time of the
+        # call, this lets tools that compare times tell nothing has changed.
+        self.mounted = time()
+
+        # path -> (node, [(dir, generation) for each dir on the way]), so
+        # that FUSE's constant stats of the same paths needn't walk the tree.
+        # Entries are good as long as all those dirs are unchanged.
+        self.paths = LoadingCache(self.walk, max_entries=10000, name='paths')
+
+        # Open files, by the fh we gave the kernel
+        self.handles = dict()
+        self.handles_lock = Lock()
+        self.next_fh = count(1)
 
     def __call__(self, op, *args):
-        log.debug('-> %s %s', op, repr(args))
+        started = time()
+        failed = True
+        try:
+            ret = self.call(op, *args)
+            failed = False
+            return ret
+        finally:
+            stats.fuse_ops.record(op, time() - started, error=failed)
+
+    def call(self, op, *args):
+        # repr of a read's buffer or a big listing is expensive, so only
+        # make it if it'll be logged
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug('-> %s %s', op, repr(args))
         try:
             ret = Operations.__call__(self, op, *args)
-            log.debug('<- %s %s', op, repr(ret))
+            if debug:
+                log.debug('<- %s %s', op, repr(ret))
             return ret
         except FuseOSError as fuse_ex:
             # The lower-level code can log at a higher level if cares to
@@ -86,6 +136,12 @@ class AwsOps(Operations):
                 return FuseOSError(EPERM), logging.WARNING
             if code in ['Blocked']:
                 return FuseOSError(EPERM), logging.WARNING
+            if code in ['PreconditionFailed']:
+                # e.g. an S3 object changed while we were reading it
+                return FuseOSError(ESTALE), logging.WARNING
+            if code in THROTTLE_CODES:
+                # Still throttled after the Governor's retries
+                return FuseOSError(EAGAIN), logging.WARNING
 
             # There are zillions of response codes.
             # Use the HTTP status to figure out a little more.
@@ -119,6 +175,47 @@ class AwsOps(Operations):
         finally:
             os.abort()
 
+    def add_handle(self, handle):
+        with self.handles_lock:
+            fh = next(self.next_fh)
+            self.handles[fh] = handle
+        return fh
+
+    def get_handle(self, fh):
+        with self.handles_lock:
+            handle = self.handles.get(fh)
+        if handle is None:
+            raise FuseOSError(EBADF)
+        return handle
+
+    def resolve(self, path):
+        (node, dirs) = self.paths.get(path)
+        for (dir_node, generation) in dirs:
+            if not dir_node.is_current(generation):
+                self.paths.invalidate(path)
+                (node, _) = self.paths.get(path)
+                break
+        return node
+
+    def walk(self, path):
+        parts = path.split("/")[1:]
+        if parts[-1] == '':
+            del parts[-1]
+
+        cur = self.root
+        dirs = []
+        for part in parts:
+            if not cur.is_dir():
+                raise FuseOSError(ENOTDIR)
+            listing = cur.get_listing()
+            dirs.append((cur, listing.generation))
+            child = listing.get_child(part)
+            if child is None:
+                raise FuseOSError(ENOENT)
+            cur = child
+
+        return cur, dirs
+
     #################################################
     # The actual operations
     #################################################
@@ -132,54 +229,109 @@ class AwsOps(Operations):
     def create(self, path, mode, fi=None):
         raise FuseOSError(EPERM)
 
-    def getattr(self, path, fh=None):
-        node = self.root.resolve(path)
+    def getattr(self, path, fi=None):
+        node = self.resolve(path)
+        if node.is_dir():
+            return self.get_attrs(node, 0)
+        # If the file is open, we know exactly what the reader will see
+        handle = self.get_handle(fi.fh) if fi else node
+        return self.get_attrs(node, handle.get_size())
+
+    def get_attrs(self, node, size):
+        mtime = node.get_mtime()
+        if mtime is None:
+            mtime = self.mounted
         if node.is_dir():
-            return dict(st_mode=(S_IFDIR | 0755), st_ctime=time(),
-                        st_mtime=time(), st_atime=time(), st_nlink=2)
+            return dict(st_mode=(S_IFDIR | 0755), st_ctime=mtime,
+                        st_mtime=mtime, st_atime=mtime, st_nlink=2)
         else:
-            return dict(st_mode=node.get_type(), st_nlink=1,
-                        st_size=node.get_size(),
-                        st_ctime=time(), st_mtime=time(), st_atime=time())
+            return dict(st_mode=node.get_type(), st_nlink=1, st_size=size,
+                        st_ctime=mtime, st_mtime=mtime, st_atime=mtime)
+
+    def get_listed_attrs(self, node):
+        """
+        :return What getattr would, if it's known without loading anything.
+                Else only the type, or None if the node isn't made yet.
+        """
+        if node is None:
+            return None
+        size = node.get_listed_size()
+        if size is None:
+            return dict(st_mode=node.get_type())
+        return self.get_attrs(node, size)
 
     def getxattr(self, path, name, position=0):
         return ''
 
+    def init(self, path):
+        if self.cache_dir:
+            memo.store = DiskStore(os.path.join(self.cache_dir,
+                                                'awsfs.sqlite'))
+        default_budget.start_reaper()
+        stats.start_dump_thread(get_stats_json)
+
     def listxattr(self, path):
         return []
 
     def mkdir(self, path, mode):
         raise FuseOSError(EPERM)
 
-    def open(self, path, flags):
-        node = self.root.resolve(path)
-        if node.is_dir():
-            raise FuseOSError(EISDIR)
-        return 0
+    # We're mounted with raw_fi, so that open can set direct_io.
+    # The file ops then get a fuse_file_info instead of a plain fh.
 
-    def read(self, path, size, offset, fh):
-        node = self.root.resolve(path)
+    def open(self, path, fi):
+        node = self.resolve(path)
         if node.is_dir():
             raise FuseOSError(EISDIR)
 
-        contents = node.read()
-        if len(contents) < offset + size:
-            return []
-        return contents[offset:offset + size]
+        fi.fh = self.add_handle(node.open())
+        # If we only guessed the size in getattr, have the kernel read until
+        # we return EOF instead of stopping at the guess.
+        fi.direct_io = not node.is_size_exact()
+        # Otherwise the kernel drops what it's read of the file on every
+        # open, since it can't know whether we've changed it
+        fi.keep_cache = node.keeps_cache()
+        return 0
 
-    def readdir(self, path, fh):
-        node = self.root.resolve(path)
+    def read(self, path, size, offset, fi):
+        return self.get_handle(fi.fh).read(size, offset)
+
+    def opendir(self, path):
+        node = self.resolve(path)
         if not node.is_dir():
             raise FuseOSError(ENOTDIR)
 
-        return [name for (name, value) in node.get_children()]
+        # Hold on to this listing until the dir is closed, so that offsets
+        # into it stay valid even if the dir is refreshed in the meantime
+        return self.add_handle(node.get_listing())
+
+    def readdir(self, path, fh, offset=0):
+        """
+        :return (name, attrs, offset of the next entry) for a batch of
+                entries, starting at offset. Called by AwsFUSE, which lets
+                us list a directory a batch at a time. A paged listing
+                returns as soon as its first page of the batch is in.
+        """
+        entries = self.get_handle(fh).get_entries_from(offset, READDIR_BATCH)
+        return [(name, self.get_listed_attrs(node), offset + i + 1)
+                for (i, (name, node)) in enumerate(entries)]
 
     def readlink(self, path):
-        node = self.root.resolve(path)
+        node = self.resolve(path)
         if node.get_type() != S_IFLNK:
             raise FuseOSError(EINVAL)
         return node.read()
 
+    def release(self, path, fi):
+        with self.handles_lock:
+            self.handles.pop(fi.fh, None)
+        return 0
+
+    def releasedir(self, path, fh):
+        with self.handles_lock:
+            self.handles.pop(fh, None)
+        return 0
+
     def removexattr(self, path, name):
         raise FuseOSError(EPERM)
 
@@ -211,32 +363,50 @@ class AwsOps(Operations):
         raise FuseOSError(EPERM)
 
 
-class RootDir(VDir):
+class AwsFUSE(FUSE):
+    """
+    fusepy's readdir doesn't pass along the offset the kernel asks for, so
+    a directory has to be listed in full every time. We pass it to
+    AwsOps.readdir, which can then return one batch at a time.
+
+    Entries go to the kernel with whatever attrs AwsOps knows of them. At
+    least the type is passed on, so tools like find can tell dirs from
+    files without a stat of each.
+    """
+    def readdir(self, path, buf, filler, offset, fip):
+        # Like FUSE.readdir, we ignore raw_fi for dirs
+        for (name, attrs, next_offset) in self.operations(
+                'readdir', path.decode(self.encoding),
+                fip.contents.fh, offset):
+            st = None
+            if attrs:
+                st = c_stat()
+                set_st_attrs(st, attrs)
+            if filler(buf, name.encode(self.encoding), st, next_offset) != 0:
+                break
+        return 0
+
+
+class RootDir(SDir):
     def __init__(self):
-        VDir.__init__(self)
-        self.children = [
+        SDir.__init__(self, [
             ("iam", iam_root()),
             ("dynamo", dynamo_root()),
             ("ec2", ec2_root()),
             ("elb", elb_root()),
-            ("s3", s3_root())
-        ]
-
-    def get_children(self):
-        return self.children
-
-    def resolve(self, path):
-        parts = path.split("/")[1:]
-        if parts[-1] == '':
-            del parts[-1]
-
-        cur = self
-        for part in parts:
-            if not cur.is_dir():
-                raise FuseOSError(ENOTDIR)
-            child = cur.get_child(part)
-            if not child:
-                raise FuseOSError(ENOENT)
-            cur = child
-
-        return cur
+            ("s3", s3_root()),
+            # About awsfs itself. Hidden, so that it's not mistaken for AWS.
+            (".awsfs", SDir([
+                ("stats", LFile(lambda: get_stats_json().encode()))
+            ]))
+        ])
+
+
+def get_stats_json():
+    return to_json(dict(fuse_ops=stats.fuse_ops.to_dict(),
+                        aws_calls=stats.aws_calls.to_dict(),
+                        caches=cache_stats(),
+                        cache_budget=default_budget.stats(),
+                        memo=memo.stats(),
+                        clients=registry.stats(),
+                        governors=registry.governor_stats()))
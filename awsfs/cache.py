@@ -1,24 +1,482 @@
-from time import time
-from threading import Lock
+import logging
+import sys
+from collections import OrderedDict
+from time import sleep, time
+from threading import Event, Lock, Thread, local
+from types import FunctionType
+from weakref import WeakSet
+
+
+log = logging.getLogger('cache')
+
+# Values loaded from stale data (see note_stale) are only kept this long
+STALE_TTL_SECS = 5
+
+# Per thread, for each load running on it (innermost last), whether it has
+# read stale data
+loading = local()
 
 
 class LoadingCache:
-    def __init__(self, load_func, ttl_secs=-1):
-        self.lock = Lock()
-        self.cache = dict()
+    """
+    A thread-safe cache which loads missing or expired values on demand.
+
+    Loads are single-flight: if several threads want the same missing key,
+    one of them loads it and the rest wait for its result.
+
+    :param load_func    Called with a key to load its value. May be None if
+                        every get gives a load_func of its own.
+    :param ttl_secs     How long a loaded value is good for. -1 means forever.
+    :param max_entries  If set, the least recently used values are evicted
+                        once the cache holds more than this many.
+    :param serve_stale  If True, an expired value is returned right away
+                        while a background thread reloads it. Only a key
+                        that has never been loaded makes the caller wait.
+    :param max_stale_secs   How long past expiry a value may be served
+                            stale before it's reaped.
+    :param budget       A CacheBudget to share with other caches. Values are
+                        then evicted whenever the budget as a whole is
+                        over, least recently used first.
+    :param name         What to report its stats under. Caches with the
+                        same name are reported together.
+    """
+    def __init__(self, load_func, ttl_secs=-1, max_entries=None,
+                 serve_stale=False, max_stale_secs=3600, budget=None,
+                 name='other'):
+        # Caches sharing a budget share its lock, so that it can evict
+        # from any of them
+        self.lock = budget.lock if budget else Lock()
+        self.cache = OrderedDict()
+        self.loads = dict()  # In-flight, by key
         self.load_func = load_func
         self.ttl_secs = ttl_secs
+        self.stale_keys = set()  # Whose values were loaded from stale data
+        self.max_entries = max_entries
+        self.serve_stale = serve_stale
+        self.max_stale_secs = max_stale_secs
+        self.budget = budget
+        self.name = name
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.load_errors = 0
+        self.evictions = 0
+        with caches_lock:
+            caches.add(self)
+
+    def get(self, key, load_func=None):
+        """
+        :param load_func    If given, loads the value instead of the cache's
+                            load_func, should this get be the one to load
+                            it. For what a load needs that isn't part of
+                            the key.
+        """
+        load_func = load_func or self.load_func
+        while True:
+            (is_loader, load, value) = self.get_or_join_load(key, load_func)
+            if is_loader:
+                return self.load(key, load, load_func)
+            if load is None:
+                return value
+            value = load.wait()
+            if not load.abandoned:
+                return value
+            # Whoever was loading it gave up, so try again ourselves
 
-    def get(self, key):
+    def get_or_join_load(self, key, load_func):
+        """
+        :return (whether the caller must load the value, the Load to wait on
+                 or report to, the value if it's cached)
+        """
         with self.lock:
             if key in self.cache:
-                (value, expiry) = self.cache[key]
-                if self.ttl_secs == -1 or time() < expiry:
-                    return value
+                (value, expiry) = self.cache.pop(key)
+                # Re-insert to mark it as most recently used
+                self.cache[key] = (value, expiry)
+                if self.budget:
+                    self.budget.touch(self, key)
+                if key in self.stale_keys:
+                    note_stale()
+                if self.is_fresh(expiry):
+                    self.hits += 1
+                    return False, None, value
+                if self.serve_stale:
+                    self.stale_hits += 1
+                    if key not in self.loads:
+                        load = self.loads[key] = Load()
+                        refresher = Thread(target=self.refresh,
+                                           args=(key, load, load_func),
+                                           name='refresh-%s' % (key,))
+                        refresher.daemon = True
+                        refresher.start()
+                    return False, None, value
+
+            self.misses += 1
+            load = self.loads.get(key)
+            if load is not None:
+                return False, load, None
+            load = self.loads[key] = Load()
+            return True, load, None
+
+    def load(self, key, load, load_func):
+        try:
+            (value, stale) = run_load(load_func, key)
+        except BaseException as e:
+            with self.lock:
+                del self.loads[key]
+                self.load_errors += 1
+            load.fail(e)
+            raise
+        return self.store(key, load, value, stale)
+
+    def load_many(self, keys, load_many_func):
+        """
+        Loads several values at once, e.g. with a batch request. Meanwhile,
+        gets of those keys wait for it instead of loading them one at a time.
+        Keys that are already cached or being loaded are skipped.
+
+        :param load_many_func   Called with the keys to load. Returns a dict
+                                of the values it could load; gets of the
+                                rest will load them themselves.
+        """
+        loads = dict()
+        with self.lock:
+            for key in keys:
+                if key in self.loads:
+                    continue
+                if key in self.cache and self.is_fresh(self.cache[key][1]):
+                    continue
+                loads[key] = self.loads[key] = Load()
+        if not loads:
+            return
+
+        (values, stale) = (dict(), False)
+        try:
+            (values, stale) = run_load(load_many_func, list(loads))
+        finally:
+            for (key, load) in loads.items():
+                if key in values:
+                    self.store(key, load, values[key], stale)
+                else:
+                    with self.lock:
+                        del self.loads[key]
+                    load.abandon()
+
+    def store(self, key, load, value, stale):
+        self.put(key, value, load, stale)
+        load.succeed(value)
+        return value
+
+    def put(self, key, value, load=None, stale=False):
+        """
+        Replaces a value, e.g. with one fetched some other way than by
+        load_func, as if it had just been loaded.
 
-        new_value = self.load_func(key)
+        :param load     If the value is the result of a Load, that Load.
+        :param stale    Whether it was loaded from stale data, so should
+                        only be kept for STALE_TTL_SECS.
+        """
+        # Outside the lock, since it may walk a big value
+        size = estimate_size(value) if self.budget else 0
 
         with self.lock:
-            self.cache[key] = (new_value, time() + self.ttl_secs)
+            if load is not None:
+                del self.loads[key]
+            self.discard(key)
+            if stale:
+                self.stale_keys.add(key)
+                expiry = time() + (STALE_TTL_SECS if self.ttl_secs == -1 else
+                                   min(self.ttl_secs, STALE_TTL_SECS))
+            elif self.ttl_secs == -1:
+                expiry = float('inf')
+            else:
+                expiry = time() + self.ttl_secs
+            self.cache[key] = (value, expiry)
+            if self.budget:
+                self.budget.add(self, key, size, self.get_reap_time(expiry))
+            if self.max_entries is not None:
+                while len(self.cache) > self.max_entries:
+                    self.discard(next(iter(self.cache)))
+                    self.evictions += 1
+
+    def update_size(self, key):
+        """
+        Re-estimates the size of a value which has grown since it was loaded.
+        """
+        with self.lock:
+            if key not in self.cache or not self.budget:
+                return
+            (value, _) = self.cache[key]
+        size = estimate_size(value)
+        with self.lock:
+            if key in self.cache and self.cache[key][0] is value:
+                self.budget.resize(self, key, size)
+
+    def peek(self, key):
+        """
+        :return The cached value, fresh or not, or None. Doesn't load it,
+                count as a hit or mark it as used.
+        """
+        with self.lock:
+            return self.cache.get(key, (None,))[0]
+
+    def invalidate(self, key, value=None):
+        """
+        :param value    If given, only invalidate if this is still the value.
+        """
+        with self.lock:
+            if value is None or self.cache.get(key, (None,))[0] is value:
+                self.discard(key)
+
+    def is_fresh(self, expiry):
+        return time() < expiry
+
+    def get_reap_time(self, expiry):
+        if expiry == float('inf'):
+            return None
+        if self.serve_stale:
+            return expiry + self.max_stale_secs
+        return expiry
+
+    def discard(self, key):
+        """
+        Drops a value. The caller must hold the lock.
+        """
+        if key in self.cache:
+            del self.cache[key]
+            self.stale_keys.discard(key)
+            if self.budget:
+                self.budget.remove(self, key)
+
+    def refresh(self, key, load, load_func):
+        try:
+            self.load(key, load, load_func)
+        except Exception:
+            # Keep serving the stale value; the next get will try again
+            log.warning('Background refresh of %s failed', key, exc_info=True)
+
+
+def note_stale():
+    """
+    Says that the load running on this thread, if any, read stale data:
+    e.g. a response from before a restart, which is being fetched again.
+    Its value is then only kept for STALE_TTL_SECS, rather than its cache's
+    TTL, so that it's soon reloaded from the fresh data. So is that of any
+    load which reads the value in turn.
+    """
+    stale = getattr(loading, 'stale', None)
+    if stale:
+        stale[-1] = True
+
+
+def run_load(func, *args):
+    """
+    :return (func(*args), whether it read stale data)
+    """
+    if not hasattr(loading, 'stale'):
+        loading.stale = []
+    loading.stale.append(False)
+    try:
+        value = func(*args)
+    finally:
+        stale = loading.stale.pop()
+    if stale:
+        # Whatever load this is part of read it too
+        note_stale()
+    return value, stale
+
+
+class CacheBudget:
+    """
+    A limit on the memory used by a group of LoadingCaches. Their values are
+    tracked in a single least-recently-used order, so that a big listing in
+    one cache can push out values nobody has looked at in another.
+
+    Sizes are estimates (see estimate_size), good enough to keep the
+    process from growing without bound.
+
+    :param max_entries  Across all the caches. None means no limit.
+    :param max_bytes    Estimated, across all the caches. None means no
+                        limit.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.lock = Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # (cache, key) -> (size, reap time), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.reaped = 0
+        self.reaper = None
+
+    # The caller must hold the lock for these
+
+    def touch(self, cache, key):
+        entry = (cache, key)
+        self.entries[entry] = self.entries.pop(entry)
+
+    def add(self, cache, key, size, reap_time):
+        self.entries[(cache, key)] = (size, reap_time)
+        self.bytes += size
+        # Never evict the value just added, even if it's over the budget on
+        # its own; the caller is about to use it.
+        while len(self.entries) > 1 and self.is_over():
+            (victim_cache, victim_key) = next(iter(self.entries))
+            victim_cache.discard(victim_key)
+            victim_cache.evictions += 1
+            self.evictions += 1
+
+    def resize(self, cache, key, size):
+        (_, reap_time) = self.entries[(cache, key)]
+        self.remove(cache, key)
+        self.add(cache, key, size, reap_time)
+
+    def remove(self, cache, key):
+        (size, _) = self.entries.pop((cache, key))
+        self.bytes -= size
+
+    def is_over(self):
+        return ((self.max_entries is not None and
+                 len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and
+                 self.bytes > self.max_bytes))
+
+    # These take the lock themselves
+
+    def reap(self):
+        """
+        Drops values too old to be served, which otherwise would linger
+        until pushed out by newer ones.
+        """
+        now = time()
+        with self.lock:
+            expired = [entry
+                       for (entry, (_, reap_time)) in self.entries.items()
+                       if reap_time is not None and reap_time <= now]
+            for (cache, key) in expired:
+                cache.discard(key)
+            self.reaped += len(expired)
+        return len(expired)
+
+    def start_reaper(self, interval_secs=60):
+        if self.reaper:
+            return
+        self.reaper = Thread(target=self.reap_forever, args=(interval_secs,),
+                             name='cache-reaper')
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def reap_forever(self, interval_secs):
+        while True:
+            sleep(interval_secs)
+            try:
+                self.reap()
+                log.debug('Cache footprint: %s', self.stats())
+            except Exception:
+                log.error('Reaping caches failed', exc_info=True)
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries),
+                        bytes=self.bytes,
+                        max_entries=self.max_entries,
+                        max_bytes=self.max_bytes,
+                        evictions=self.evictions,
+                        reaped=self.reaped)
+
+
+# Every LoadingCache, for cache_stats
+caches = WeakSet()
+caches_lock = Lock()
+
+
+def cache_stats():
+    """
+    :return {name: totals of the stats of the caches by that name}
+    """
+    with caches_lock:
+        all_caches = list(caches)
+    totals = dict()
+    for cache in all_caches:
+        with cache.lock:
+            stats = dict(caches=1,
+                         entries=len(cache.cache),
+                         hits=cache.hits,
+                         stale_hits=cache.stale_hits,
+                         misses=cache.misses,
+                         load_errors=cache.load_errors,
+                         evictions=cache.evictions)
+        total = totals.setdefault(cache.name, dict.fromkeys(stats, 0))
+        for (stat, value) in stats.items():
+            total[stat] += value
+    return totals
+
+
+# Shared by the directory and file caches
+default_budget = CacheBudget(max_entries=100000, max_bytes=512 * 1024 * 1024)
+
+
+def estimate_size(value, depth=0, seen=None):
+    """
+    Roughly how many bytes value takes up, including what it refers to:
+    the elements of containers and the attributes of objects (e.g. the
+    children of a directory node). Objects referred to more than once are
+    counted once. Of a function, only the default args are followed, since
+    that's how lazy nodes capture their records. Caches aren't followed at
+    all; they account for themselves.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if depth >= 16 or isinstance(value, (LoadingCache, CacheBudget)):
+        return size
+    if isinstance(value, FunctionType):
+        return size + estimate_size(value.__defaults__, depth + 1, seen)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(estimate_size(item, depth + 1, seen)
+                          for item in value)
+    if isinstance(value, dict):
+        return size + sum(estimate_size(k, depth + 1, seen) +
+                          estimate_size(v, depth + 1, seen)
+                          for (k, v) in value.items())
+    if hasattr(value, '__dict__'):
+        return size + estimate_size(value.__dict__, depth + 1, seen)
+    if hasattr(value, '__slots__'):
+        return size + sum(estimate_size(getattr(value, name, None),
+                                        depth + 1, seen)
+                          for name in value.__slots__)
+    return size
+
+
+class Load:
+    """
+    A load in progress, which other threads can wait on.
+    """
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+        self.abandoned = False
+
+    def succeed(self, value):
+        self.value = value
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+    def abandon(self):
+        self.abandoned = True
+        self.done.set()
 
-        return new_value
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
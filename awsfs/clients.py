@@ -0,0 +1,90 @@
+import logging
+from threading import Lock
+
+import boto3
+from botocore.config import Config
+
+import stats
+from governor import Governor
+
+
+log = logging.getLogger('clients')
+
+
+class ClientRegistry:
+    """
+    Long-lived boto3 clients, one per (service, region).
+
+    Creating a client loads the service model and resolves credentials,
+    and each client has its own connection pool, so making one per call is
+    expensive. Clients themselves are thread-safe, but the session that
+    creates them isn't, so creation happens under a lock.
+
+    Each client's requests are paced by its own Governor.
+
+    :param max_pool_connections Per client. FUSE dispatches ops from many
+                                threads, each of which may have a request
+                                in flight.
+    """
+    def __init__(self, max_pool_connections=32):
+        self.lock = Lock()
+        self.session = None
+        self.config = Config(max_pool_connections=max_pool_connections)
+        self.clients = dict()
+        self.governors = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, service, region=None):
+        key = (service, region)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+
+            self.misses += 1
+            if self.session is None:
+                self.session = boto3.session.Session()
+            log.info('Creating %s client for %s', service, region or '-')
+            client = self.session.client(service, region_name=region,
+                                         config=self.config)
+            governor = Governor()
+            governor.attach(client)
+            stats.attach(client)
+            self.clients[key] = client
+            self.governors[key] = governor
+            return client
+
+    def use_session(self, session):
+        """
+        Makes clients from session from now on, rather than a default boto3
+        one, e.g. a session whose event handlers answer for AWS. Clients
+        made so far are dropped.
+        """
+        with self.lock:
+            self.session = session
+            self.clients.clear()
+            self.governors.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(clients=len(self.clients),
+                        hits=self.hits,
+                        misses=self.misses)
+
+    def governor_stats(self):
+        """
+        :return {'service/region': the Governor's stats}
+        """
+        with self.lock:
+            governors = list(self.governors.items())
+        return dict(('%s/%s' % (service, region or '-'), governor.stats())
+                    for ((service, region), governor) in governors)
+
+
+registry = ClientRegistry()
+
+
+def get_client(service, region=None):
+    return registry.get(service, region)
@@ -1,23 +1,81 @@
-import boto3
+import base64
+import logging
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+
+import clients
+from cache import LoadingCache, default_budget
+from memo import memo
+from regions import RegionalData
 from vfs import *
 from format import to_json
 
 
+log = logging.getLogger('dynamo')
+
+# Each table is scanned in this many segments, in parallel
+SCAN_SEGMENTS = 8
+
+# Shared by all the table scans
+scan_pool = ThreadPoolExecutor(max_workers=32)
+
+# (region, table) -> (key column, key type). These never change.
+key_schemas = LoadingCache(lambda table_id: get_key_schema(*table_id),
+                           name='dynamo-key-schemas')
+
+# Most keys BatchGetItem takes at once
+BATCH_SIZE = 100
+
+# How many items ahead of a sequential reader to fetch
+READ_AHEAD = 4 * BATCH_SIZE
+
+# Runs the batches of a read-ahead in parallel
+batch_pool = ThreadPoolExecutor(max_workers=8)
+
+# (region, table, key name) -> item file contents. Only kept from when an
+# item is read ahead to when it's read, so that other reads are fresh.
+items = LoadingCache(lambda item_id: get_item_file(*item_id), ttl_secs=30,
+                     budget=default_budget, name='dynamo-items')
+
+tables = RegionalData(lambda region: get_tables(region),
+                      lambda: get_regions(), name='dynamo-tables')
+
+# (region, table) -> the table's dir. Kept across refreshes of the region's
+# table list, so that a table's scan (and read-ahead) isn't thrown away
+# with it.
+table_dirs = LoadingCache(lambda table_id: get_table_dir(*table_id),
+                          name='dynamo-table-dirs')
+
+
 def dynamo_root():
 
     return SDir([
         (region, CLDir(lambda _region=region: [
-            (table, CLDir(lambda _table=table: [
-                (key_name, LFile(lambda _key=key_name, _key_col=key_col, _key_attr=key_attr:
-                                 get_item_file(_region, _table, _key_col, _key_attr)))
-                for (key_name, key_col, key_attr) in get_keys(_region, _table)
-            ]))
-            for table in get_tables(_region)
+            (table, lambda _table=table: table_dirs.get((_region, _table)))
+            for table in tables.get(_region)
         ]))
         for region in get_regions()
+    ] + [
+        # Table names are only unique within a region
+        ('_all', CLDir(lambda: [
+            ('%s:%s' % (region, table), VLink('../%s/%s' % (region, table)))
+            for (region, region_tables) in tables.get_all()
+            for table in region_tables
+        ]))
     ])
 
 
+def get_table_dir(region, table):
+    read_ahead = ReadAhead(lambda: table_dir.get_listing())
+    table_dir = PDir(
+        lambda add_names: scan_keys(region, table, add_names),
+        lambda key_name: LFile(lambda: read_item(region, table, key_name,
+                                                 read_ahead)))
+    return table_dir
+
+
 def get_regions():
     return [
         "us-east-1", "us-west-2", "us-west-1", "eu-west-1",
@@ -27,47 +85,178 @@ def get_regions():
 
 
 def get_client(region):
-    return boto3.client('dynamodb', region_name=region)
+    return clients.get_client('dynamodb', region)
 
 
 def get_tables(region):
     return [
         table
-        for page in get_client(region).get_paginator('list_tables').paginate()
+        for page in memo.paginate('dynamodb', region, get_client(region),
+                                  'list_tables')
         for table in page['TableNames']
     ]
 
 
-def get_keys(region, table):
-    key_col = get_key_col(region, table)
-    result = []
+def scan_keys(region, table, add_names):
+    """
+    Lists the names of a table's keys, passing them to add_names a page at a
+    time as they arrive from the parallel scans.
+    """
+    (key_col, _) = key_schemas.get((region, table))
+    segments = [scan_pool.submit(scan_segment,
+                                 region, table, key_col, segment, add_names)
+                for segment in range(SCAN_SEGMENTS)]
+    for segment in segments:
+        segment.result()
+
+
+def scan_segment(region, table, key_col, segment, add_names):
     for page in (get_client(region).
                  get_paginator('scan').
-                 paginate(TableName=table, AttributesToGet=[key_col])):
-        for item in page['Items']:
-            key_attr = item[key_col]
-            result.append((simplify_dynamo_attr(key_attr), key_col, key_attr))
-    return result
+                 paginate(TableName=table, AttributesToGet=[key_col],
+                          Segment=segment, TotalSegments=SCAN_SEGMENTS)):
+        add_names([get_key_name(item[key_col]) for item in page['Items']])
 
 
-def get_key_col(region, table):
-    for key in (get_client(region).describe_table(TableName=table)
-                ['Table']['KeySchema']):
+def get_key_schema(region, table):
+    description = get_client(region).describe_table(TableName=table)['Table']
+    for key in description['KeySchema']:
         if key['KeyType'] == 'HASH':
-            return key['AttributeName']
+            key_col = key['AttributeName']
+            for attr in description['AttributeDefinitions']:
+                if attr['AttributeName'] == key_col:
+                    return key_col, attr['AttributeType']
     raise Exception('Table has no hash key!')
 
 
-def get_item_file(region, table, key_col, key_attr):
+def get_key_name(key_attr):
+    if 'B' in key_attr:
+        return base64.urlsafe_b64encode(key_attr['B']).decode()
+    return simplify_dynamo_attr(key_attr)
+
+
+def get_key_attr(key_type, key_name):
+    """
+    The inverse of get_key_name. We only keep key names in memory, and make
+    the attribute when we need it.
+    """
+    if key_type == 'B':
+        return {'B': base64.urlsafe_b64decode(key_name.encode())}
+    return {key_type: key_name}
+
+
+def read_item(region, table, key_name, read_ahead):
+    window = read_ahead.note_read(key_name)
+    for start in range(0, len(window), BATCH_SIZE):
+        item_ids = [(region, table, name)
+                    for name in window[start:start + BATCH_SIZE]]
+        batch = batch_pool.submit(items.load_many, item_ids,
+                                  batch_get_item_files)
+        batch.add_done_callback(on_batch_done)
+    item_id = (region, table, key_name)
+    contents = items.get(item_id)
+    # Unless a newer one has replaced it meanwhile
+    items.invalidate(item_id, contents)
+    return contents
+
+
+def on_batch_done(batch):
+    # Reads of the items will get them one at a time instead, but say why
+    error = batch.exception()
+    if error is not None:
+        log.warning('Reading items ahead failed: %r', error)
+
+
+class ReadAhead:
+    """
+    Watches the reads of a table's items. When they go through the keys in
+    order, either the order they were listed in (as by `grep -r`) or sorted
+    (as by `cat *`), it says which items to fetch ahead of the reader.
+
+    :param get_listing_func Gets the table dir's PagedListing.
+    """
+    def __init__(self, get_listing_func):
+        self.lock = Lock()
+        self.get_listing_func = get_listing_func
+        self.order = None  # Of the key names, as they're being read
+        self.position = -1  # Of the last read, in order
+        self.fetched_to = 0  # Where in order the read-ahead has reached
+        self.sorted_names = []
+        self.sorted_listing = None  # What sorted_names is sorted from
+
+    def note_read(self, key_name):
+        """
+        :return The names of the items to fetch ahead.
+        """
+        with self.lock:
+            next_position = self.position + 1
+            if (self.order is None or next_position >= len(self.order) or
+                    self.order[next_position] != key_name):
+                # Not sequential, but maybe the start of a run
+                (self.order, self.position) = self.locate(key_name)
+                self.fetched_to = self.position + 1
+                return []
+
+            self.position = next_position
+            if self.fetched_to - self.position > READ_AHEAD // 2:
+                return []
+            start = max(self.fetched_to, self.position + 1)
+            window = self.order[start:start + READ_AHEAD]
+            self.fetched_to = start + len(window)
+            return window
+
+    def locate(self, key_name):
+        listing = self.get_listing_func()
+        if listing.names and listing.names[0] == key_name:
+            return listing.names, 0
+        if listing.complete:
+            if self.sorted_listing is not listing:
+                self.sorted_names = sorted(listing.names)
+                self.sorted_listing = listing
+            i = bisect_left(self.sorted_names, key_name)
+            if i < len(self.sorted_names) and self.sorted_names[i] == key_name:
+                return self.sorted_names, i
+        return None, -1
+
+
+def get_item_file(region, table, key_name):
+    (key_col, key_type) = key_schemas.get((region, table))
     return (
         to_json(
             simplify_dynamo_item(
                 get_client(region).
-                get_item(TableName=table, Key={key_col: key_attr})
+                get_item(TableName=table,
+                         Key={key_col: get_key_attr(key_type, key_name)})
                 ['Item'])
         ).encode())
 
 
+def batch_get_item_files(item_ids):
+    """
+    Gets the item files for some keys of a table, in one BatchGetItem (plus
+    retries of any keys it leaves unprocessed).
+
+    :param item_ids (region, table, key name) of at most BATCH_SIZE items.
+    :return dict of the item files we got, by item id
+    """
+    (region, table, _) = item_ids[0]
+    (key_col, key_type) = key_schemas.get((region, table))
+    request = {table: {'Keys': [{key_col: get_key_attr(key_type, key_name)}
+                                for (_, _, key_name) in item_ids]}}
+    result = dict()
+    for attempt in range(5):
+        response = get_client(region).batch_get_item(RequestItems=request)
+        for item in response['Responses'].get(table, []):
+            item_id = (region, table, get_key_name(item[key_col]))
+            result[item_id] = to_json(simplify_dynamo_item(item)).encode()
+        request = response.get('UnprocessedKeys')
+        if not request:
+            break
+        # Unprocessed keys mean we're over the table's capacity
+        sleep(0.05 * 2 ** attempt)
+    return result
+
+
 def simplify_dynamo_attr(attribute):
     if 'S' in attribute:
         return attribute['S']
@@ -1,42 +1,66 @@
-import boto3
+import clients
 
-from format import to_json
+from cache import LoadingCache, default_budget
+from format import to_json, to_timestamp
+from memo import memo
+from regions import RegionalData
 from vfs import *
 
 
+# region -> {instance id: status}, so that reading every instance's status
+# file costs a few paginated calls rather than one call per instance. This
+# is the only TTL on them: get_instance_statuses doesn't go through memo.
+instance_statuses = LoadingCache(lambda region: get_instance_statuses(region),
+                                 ttl_secs=30, budget=default_budget,
+                                 name='ec2-statuses')
+
+# Image IDs per DescribeImages filter, to keep requests a sane size
+IMAGE_IDS_PER_CALL = 200
+
+instances = RegionalData(lambda region: get_instances(region),
+                         lambda: get_regions(), name='ec2-instances')
+
+
 def ec2_root():
     return SDir([
         (region, SDir([
             ('instances', CLDir(lambda _region=region: [
-                (instance['InstanceId'], SDir([
-                    ('info', SFile(to_json(instance).encode())),
-                    ('status', LFile(lambda _instance=instance:
-                                     get_instance_status(_region, _instance['InstanceId']))),
-                    ('image', VLink('../../images/' + instance['ImageId'])),
-                    ('security-groups', SDir(get_instance_security_group_dirents(instance)))
-                ]))
-                for instance in get_instances(_region)
-            ])),
-            ('images', CLDir(lambda _region=region: [
-                (image['ImageId'], SDir([
-                    ('info', SFile(to_json(image).encode()))
-                ]))
-                for image in get_images(region)
+                (instance['InstanceId'], lambda _instance=instance: SDir([
+                    ('info', CLFile(lambda: to_json(_instance).encode(),
+                                    to_timestamp(_instance.get('LaunchTime')))),
+                    ('status', LFile(lambda: get_instance_status(_region, _instance['InstanceId']))),
+                    ('image', VLink('../../images/' + _instance['ImageId'])),
+                    ('security-groups', SDir(get_instance_security_group_dirents(_instance)))
+                ], to_timestamp(_instance.get('LaunchTime'))))
+                for instance in instances.get(_region)
             ])),
+            ('images', LookupDir(lambda _region=region: [
+                (image['ImageId'], lambda _image=image: get_image_dir(_image))
+                for image in get_images(_region)
+            ], lambda image_id, _region=region: lookup_image(_region, image_id))),
             ('security-groups', CLDir(lambda _region=region: ([
-                (group['GroupId'], SDir([
-                    ('info', SFile(to_json(group).encode()))
+                (group['GroupId'], lambda _group=group: SDir([
+                    ('info', CLFile(lambda: to_json(_group).encode()))
                 ]))
                 for group in get_security_groups(_region)
             ] + [
                 ('by-name',
-                 CLDir(lambda _region=region: [
+                 CLDir(lambda: [
                      (group['GroupName'], VLink('../' + group['GroupId']))
                      for group in get_security_groups(_region) if 'GroupName' in group
                  ]))
             ])))
         ]))
         for region in get_regions()
+    ] + [
+        ('_all', SDir([
+            ('instances', CLDir(lambda: [
+                (instance['InstanceId'],
+                 VLink('../../%s/instances/%s' % (region, instance['InstanceId'])))
+                for (region, region_instances) in instances.get_all()
+                for instance in region_instances
+            ]))
+        ]))
     ])
 
 
@@ -49,29 +73,35 @@ def get_regions():
 
 
 def get_client(region):
-    return boto3.client('ec2', region_name=region)
+    return clients.get_client('ec2', region)
 
 
 def get_instances(region):
     return [
         instance
-        for page in (get_client(region).
-                     get_paginator('describe_instances').
-                     paginate())
+        for page in memo.paginate('ec2', region, get_client(region),
+                                  'describe_instances')
         for reservation in page['Reservations']
         for instance in reservation['Instances']
     ]
 
 
 def get_instance_status(region, instance_id):
-    statuses = (get_client(region).
-                describe_instance_status(InstanceIds=[instance_id])
-                ['InstanceStatuses'])
-    return (to_json(statuses[0]).encode()
-            if len(statuses) > 0
+    status = instance_statuses.get(region).get(instance_id)
+    return (to_json(status).encode()
+            if status is not None
             else 'null'.encode())
 
 
+def get_instance_statuses(region):
+    return {
+        status['InstanceId']: status
+        for page in get_client(region).get_paginator(
+            'describe_instance_status').paginate(IncludeAllInstances=True)
+        for status in page['InstanceStatuses']
+    }
+
+
 def get_instance_security_group_dirents(instance):
     return [
         (group['GroupId'],
@@ -80,9 +110,46 @@ def get_instance_security_group_dirents(instance):
     ]
 
 
+def get_image_dir(image):
+    return SDir([
+        ('info', CLFile(lambda: to_json(image).encode()))
+    ])
+
+
 def get_images(region):
-    return get_client(region).describe_images()['Images']
+    """
+    Just the account's own images and those its instances were launched
+    from. All the images in a region, public ones included, run to
+    hundreds of thousands; any of those can still be looked up by ID.
+    """
+    images = list(memo.call('ec2', region, get_client(region),
+                            'describe_images', Owners=['self'])['Images'])
+    listed_ids = set(image['ImageId'] for image in images)
+    instance_image_ids = sorted(set(
+        instance['ImageId'] for instance in instances.get(region)
+        if instance['ImageId'] not in listed_ids))
+    for i in range(0, len(instance_image_ids), IMAGE_IDS_PER_CALL):
+        images += describe_images_by_id(
+            region, instance_image_ids[i:i + IMAGE_IDS_PER_CALL])
+    return images
+
+
+def lookup_image(region, image_id):
+    if not image_id.startswith('ami-'):
+        # Don't ask AWS about every name a shell or editor probes for
+        return None
+    images = describe_images_by_id(region, [image_id])
+    return get_image_dir(images[0]) if images else None
+
+
+def describe_images_by_id(region, image_ids):
+    # Unlike ImageIds, the filter leaves out IDs that don't exist (e.g.
+    # deregistered images) instead of failing the whole call
+    return memo.call('ec2', region, get_client(region), 'describe_images',
+                     Filters=[{'Name': 'image-id',
+                               'Values': image_ids}])['Images']
 
 
 def get_security_groups(region):
-    return get_client(region).describe_security_groups()['SecurityGroups']
+    return memo.call('ec2', region, get_client(region),
+                     'describe_security_groups')['SecurityGroups']
@@ -1,30 +1,44 @@
-import boto3
+import clients
 
 from format import to_json
+from memo import memo
+from regions import RegionalData
 from vfs import *
 
 
+elbs = RegionalData(lambda region: get_elbs(region), lambda: get_regions(),
+                    name='elb-load-balancers')
+
+
 def elb_root():
 
     return SDir([
         (region, CLDir(lambda _region=region: [
-            (elb['LoadBalancerName'], SDir([
-                ('info', SFile(to_json(elb).encode())),
-                ('status', LFile(lambda _elb=elb: get_status_file(_region, _elb))),
+            (elb['LoadBalancerName'], lambda _elb=elb: SDir([
+                ('info', CLFile(lambda: to_json(_elb).encode())),
+                ('status', LFile(lambda: get_status_file(_region, _elb))),
                 ('instances', SDir([
                     (elb_instance['InstanceId'], VLink('../../../../ec2/%s/instances/%s' %
                                                        (_region, elb_instance['InstanceId'])))
-                    for elb_instance in elb['Instances']
+                    for elb_instance in _elb['Instances']
                 ])),
                 ('security-groups', SDir([
                     (security_group_id, VLink('../../../../ec2/%s/security-groups/%s' %
                                               (_region, security_group_id)))
-                    for security_group_id in elb['SecurityGroups']
+                    for security_group_id in _elb['SecurityGroups']
                 ]))
             ]))
-            for elb in get_elbs(_region)
+            for elb in elbs.get(_region)
         ]))
         for region in get_regions()
+    ] + [
+        # ELB names are only unique within a region
+        ('_all', CLDir(lambda: [
+            ('%s:%s' % (region, elb['LoadBalancerName']),
+             VLink('../%s/%s' % (region, elb['LoadBalancerName'])))
+            for (region, region_elbs) in elbs.get_all()
+            for elb in region_elbs
+        ]))
     ])
 
 
@@ -37,22 +51,21 @@ def get_regions():
 
 
 def get_client(region):
-    return boto3.client('elb', region_name=region)
+    return clients.get_client('elb', region)
 
 
 def get_elbs(region):
     return [
         elb
-        for page in (get_client(region).
-                     get_paginator('describe_load_balancers').
-                     paginate())
+        for page in memo.paginate('elb', region, get_client(region),
+                                  'describe_load_balancers')
         for elb in page['LoadBalancerDescriptions']
     ]
 
 
 def get_status_file(region, elb):
-    name = elb['LoadBalancerName']
-    statuses = (get_client(region).
-                describe_instance_health(LoadBalancerName=name)
-                ['InstanceStates'])
-    return to_json(statuses).encode()
+    # DescribeInstanceHealth only covers one ELB, but all its instances
+    statuses = memo.call('elb', region, get_client(region),
+                         'describe_instance_health',
+                         LoadBalancerName=elb['LoadBalancerName'])
+    return to_json(statuses['InstanceStates']).encode()
@@ -1,6 +1,10 @@
+import base64
 import json
+from calendar import timegm
 from datetime import datetime
 
+from dateutil.parser import parse as parse_datetime
+
 
 def json_serial(obj):
     if isinstance(obj, datetime):
@@ -11,3 +15,53 @@ def json_serial(obj):
 
 def to_json(obj):
     return json.dumps(obj, default=json_serial, sort_keys=True, indent=4) + '\n'
+
+
+def to_timestamp(dt):
+    """
+    A datetime from boto as seconds since the epoch, as stat(2) reports
+    times. None stays None.
+    """
+    if dt is None:
+        return None
+    return timegm(dt.utctimetuple())
+
+
+def dump_tagged(obj):
+    """
+    obj as JSON, with its datetimes and bytes tagged so that load_tagged
+    gives them back as they were. For keeping responses from AWS, which
+    unlike pickle is safe to load from a file someone else could write.
+    """
+    return json.dumps(tag(obj), separators=(',', ':'))
+
+
+def load_tagged(text):
+    return json.loads(text, object_hook=untag)
+
+
+def tag(obj):
+    if isinstance(obj, dict):
+        return dict((key, tag(value)) for (key, value) in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [tag(value) for value in obj]
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, bytes):
+        if str is bytes:
+            # Text, unless it isn't
+            try:
+                return obj.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    return obj
+
+
+def untag(obj):
+    if len(obj) == 1:
+        if '__datetime__' in obj:
+            return parse_datetime(obj['__datetime__'])
+        if '__bytes__' in obj:
+            return base64.b64decode(obj['__bytes__'])
+    return obj
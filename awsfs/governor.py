@@ -0,0 +1,133 @@
+import logging
+import random
+from threading import Condition
+from time import time
+
+
+log = logging.getLogger('governor')
+
+# Error codes with which AWS services say to slow down
+THROTTLE_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottled', 'RequestThrottledException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+    'BandwidthLimitExceeded', 'SlowDown'
+])
+
+
+class Governor:
+    """
+    Paces the requests to one (service, region) with a token bucket, and
+    finds the fastest rate AWS will take without throttling: the rate
+    creeps up while requests succeed and halves when one is throttled
+    (additive increase, multiplicative decrease). Throttled requests are
+    retried after a random delay, until latency_budget_secs have passed.
+
+    Hooked into a client's events with attach(). botocore's own retries
+    still handle other errors, and throttles once the budget is spent.
+
+    :param rate                 Requests per second to start at.
+    :param latency_budget_secs  How long to keep retrying a throttled
+                                request, since a FUSE op blocks meanwhile.
+    """
+    def __init__(self, rate=50.0, min_rate=1.0, max_rate=1000.0,
+                 latency_budget_secs=10.0):
+        self.cond = Condition()
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.latency_budget_secs = latency_budget_secs
+        # Up to a second's worth can be saved up, for bursts
+        self.tokens = self.rate
+        self.refilled = time()
+        self.slowed = 0
+        self.waiting = 0
+        self.requests = 0
+        self.throttles = 0
+        self.retries = 0
+
+    def attach(self, client):
+        client.meta.events.register('before-send', self.on_before_send)
+        # Ahead of botocore's retry handler, since the first answer wins.
+        # That's registered for the service's own needs-retry event, whose
+        # handlers run before those of the plain one.
+        client.meta.events.register_first(
+            'needs-retry.' + client.meta.service_model.service_id.hyphenize(),
+            self.on_needs_retry)
+
+    def on_before_send(self, **kwargs):
+        # Every attempt, retries included, takes a token
+        self.acquire()
+
+    def on_needs_retry(self, response, attempts, request_dict, **kwargs):
+        if response is None:
+            # A connection error, which is botocore's to retry
+            return None
+        if not is_throttle(response[1]):
+            self.on_success()
+            return None
+
+        self.on_throttle()
+        # The context lasts across attempts of the same request
+        context = request_dict['context']
+        started = context.setdefault('governor_started', time())
+        delay = random.uniform(0, min(5.0, 0.1 * 2 ** attempts))
+        if time() + delay - started > self.latency_budget_secs:
+            return None
+        with self.cond:
+            self.retries += 1
+        return delay
+
+    def acquire(self):
+        with self.cond:
+            self.waiting += 1
+            try:
+                while True:
+                    self.refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.requests += 1
+                        return
+                    self.cond.wait((1 - self.tokens) / self.rate)
+            finally:
+                self.waiting -= 1
+
+    def refill(self):
+        """
+        The caller must hold cond.
+        """
+        now = time()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def on_success(self):
+        with self.cond:
+            # About one more request per second, per second of success
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def on_throttle(self):
+        with self.cond:
+            self.throttles += 1
+            now = time()
+            # A burst of requests gets throttled together; only slow down
+            # once for it
+            if now - self.slowed < 1:
+                return
+            self.slowed = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            log.info('Throttled; slowing to %.1f requests/sec', self.rate)
+
+    def stats(self):
+        with self.cond:
+            return dict(rate=self.rate,
+                        backlog=self.waiting,
+                        requests=self.requests,
+                        throttles=self.throttles,
+                        retries=self.retries)
+
+
+def is_throttle(parsed_response):
+    return (parsed_response or {}).get('Error', {}).get('Code') in \
+        THROTTLE_CODES
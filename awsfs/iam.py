@@ -1,125 +1,144 @@
-import boto3
+from collections import OrderedDict
 
-from format import to_json
+import clients
+
+from cache import LoadingCache, default_budget
+from format import to_json, to_timestamp
+from memo import memo
 from vfs import *
 
 
+# The whole account comes from a handful of calls, so there's only one key
+snapshots = LoadingCache(lambda _: load_snapshot(), ttl_secs=60,
+                         serve_stale=True, budget=default_budget,
+                         name='iam-snapshots')
+
+PRINCIPAL_KINDS = ['users', 'groups', 'roles']
+
+
 def iam_root():
     return SDir([
         ('users', CLDir(lambda: [
-            (user['UserName'], SDir([
-                ('info', SFile(to_json(user).encode())),
-                ('groups', CLDir(lambda _user=user: [
-                    (group['GroupName'], VLink('../../../groups/' + group['GroupName']))
-                    for group in get_user_groups(_user)
+            (name, lambda _name=name, _user=user: SDir([
+                ('info', CLFile(lambda: to_json(_user).encode(),
+                                get_mtime(_user))),
+                ('groups', CLDir(lambda: [
+                    (group_name, VLink('../../../groups/' + group_name))
+                    for group_name in get_snapshot().get_user_groups(_name)
                 ])),
-                ('policies', CLDir(lambda _user=user: [
-                    (policy_name, VLink('../../../policies/' + policy_name))
-                    for policy_name in get_user_policy_names(_user)
-                ]))
-            ]))
-            for user in get_users()
+                ('policies', get_policy_links_dir('users', _name))
+            ], get_mtime(_user)))
+            for (name, user) in get_snapshot().users.items()
         ])),
         ('groups', CLDir(lambda: [
-            (group['GroupName'], SDir([
-                ('info', SFile(to_json(group).encode())),
-                ('policies', CLDir(lambda _group=group: [
-                    (policy_name, VLink('../../../policies/' + policy_name))
-                    for policy_name in get_group_policy_names(_group)
-                ]))
-            ]))
-            for group in get_groups()
+            (name, lambda _name=name, _group=group: SDir([
+                ('info', CLFile(lambda: to_json(_group).encode(),
+                                get_mtime(_group))),
+                ('policies', get_policy_links_dir('groups', _name))
+            ], get_mtime(_group)))
+            for (name, group) in get_snapshot().groups.items()
         ])),
         ('roles', CLDir(lambda: [
-            (role['RoleName'], SDir([
-                ('info', SFile(to_json(role).encode())),
-                ('policies', CLDir(lambda _role=role: [
-                    (policy_name, VLink('../../../policies/' + policy_name))
-                    for policy_name in get_role_policy_names(_role)
-                ]))
-            ]))
-            for role in get_roles()
+            (name, lambda _name=name, _role=role: SDir([
+                ('info', CLFile(lambda: to_json(_role).encode(),
+                                get_mtime(_role))),
+                ('policies', get_policy_links_dir('roles', _name))
+            ], get_mtime(_role)))
+            for (name, role) in get_snapshot().roles.items()
         ])),
         ('policies', CLDir(lambda: [
-            (policy['PolicyName'], SDir([
-                ('info', SFile(to_json(policy).encode()))
-            ]))
-            for policy in get_policies()
+            (name, lambda _name=name, _policy=policy: SDir(
+                [('info', CLFile(lambda: to_json(_policy).encode(),
+                                 get_mtime(_policy)))] +
+                [(kind, get_principal_links_dir(_name, kind))
+                 for kind in PRINCIPAL_KINDS],
+                get_mtime(_policy)
+            ))
+            for (name, policy) in get_snapshot().policies.items()
         ])),
     ])
 
 
+def get_policy_links_dir(kind, name):
+    return CLDir(lambda: [
+        (policy_name, VLink('../../../policies/' + policy_name))
+        for policy_name in get_snapshot().get_policy_names(kind, name)
+    ])
+
+
+def get_principal_links_dir(policy_name, kind):
+    return CLDir(lambda: [
+        (name, VLink('../../../%s/%s' % (kind, name)))
+        for name in get_snapshot().get_principal_names(policy_name, kind)
+    ])
+
+
 def get_client():
-    return boto3.client('iam')
-
-
-def get_users():
-    return [
-        user
-        for page in get_client().get_paginator('list_users').paginate()
-        for user in page['Users']
-    ]
-
-
-def get_user_groups(user):
-    return [
-        group
-        for page in (get_client().
-                     get_paginator('list_groups_for_user').
-                     paginate(UserName=user['UserName']))
-        for group in page['Groups']
-    ]
-
-
-def get_groups():
-    return [
-        group
-        for page in get_client().get_paginator('list_groups').paginate()
-        for group in page['Groups']
-    ]
-
-
-def get_roles():
-    return [
-        role
-        for page in get_client().get_paginator('list_roles').paginate()
-        for role in page['Roles']
-    ]
-
-
-def get_policies():
-    return [
-        policy
-        for page in get_client().get_paginator('list_policies').paginate()
-        for policy in page['Policies']
-    ]
-
-
-def get_user_policy_names(user):
-    return [
-        policy['PolicyName']
-        for page in (get_client().
-                     get_paginator('list_attached_user_policies').
-                     paginate(UserName=user['UserName']))
-        for policy in page['AttachedPolicies']
-    ]
-
-
-def get_group_policy_names(group):
-    return [
-        policy['PolicyName']
-        for page in (get_client().
-                     get_paginator('list_attached_group_policies').
-                     paginate(GroupName=group['GroupName']))
-        for policy in page['AttachedPolicies']
-    ]
-
-
-def get_role_policy_names(role):
-    return [
-        policy['PolicyName']
-        for page in (get_client().
-                     get_paginator('list_attached_role_policies').
-                     paginate(RoleName=role['RoleName']))
-        for policy in page['AttachedPolicies']
-    ]
+    return clients.get_client('iam')
+
+
+def get_mtime(record):
+    # Only policies have an UpdateDate
+    return to_timestamp(record.get('UpdateDate') or record.get('CreateDate'))
+
+
+def get_snapshot():
+    return snapshots.get(None)
+
+
+def load_snapshot():
+    snapshot = Snapshot()
+    for page in memo.paginate('iam', None, get_client(),
+                              'get_account_authorization_details'):
+        snapshot.add_page(page)
+    return snapshot
+
+
+class Snapshot:
+    """
+    The account's users, groups, roles and managed policies as of one
+    GetAccountAuthorizationDetails, indexed by name both ways: from
+    principals to their groups and policies, and from policies back to
+    the principals they're attached to.
+    """
+    def __init__(self):
+        self.users = OrderedDict()
+        self.groups = OrderedDict()
+        self.roles = OrderedDict()
+        self.policies = OrderedDict()
+        self.user_groups = dict()       # user name -> group names
+        self.policy_names = dict()      # (kind, name) -> policy names
+        self.principal_names = dict()   # (policy name, kind) -> names
+
+    def add_page(self, page):
+        for user in page.get('UserDetailList', []):
+            self.users[user['UserName']] = user
+            self.user_groups[user['UserName']] = user.get('GroupList', [])
+            self.add_attachments('users', user['UserName'], user)
+        for group in page.get('GroupDetailList', []):
+            self.groups[group['GroupName']] = group
+            self.add_attachments('groups', group['GroupName'], group)
+        for role in page.get('RoleDetailList', []):
+            self.roles[role['RoleName']] = role
+            self.add_attachments('roles', role['RoleName'], role)
+        for policy in page.get('Policies', []):
+            self.policies[policy['PolicyName']] = policy
+
+    def add_attachments(self, kind, name, principal):
+        policy_names = [policy['PolicyName']
+                        for policy in principal.get('AttachedManagedPolicies',
+                                                    [])]
+        self.policy_names[(kind, name)] = policy_names
+        for policy_name in policy_names:
+            (self.principal_names.
+             setdefault((policy_name, kind), []).
+             append(name))
+
+    def get_user_groups(self, user_name):
+        return self.user_groups.get(user_name, [])
+
+    def get_policy_names(self, kind, name):
+        return self.policy_names.get((kind, name), [])
+
+    def get_principal_names(self, policy_name, kind):
+        return self.principal_names.get((policy_name, kind), [])
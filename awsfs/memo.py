@@ -0,0 +1,150 @@
+import json
+import logging
+from threading import Lock, Thread
+from time import time
+
+from cache import LoadingCache, default_budget, note_stale
+
+
+log = logging.getLogger('memo')
+
+
+class Memo:
+    """
+    Remembers the responses to AWS read calls for a while, keyed by
+    (service, region, operation, params), so that one dataset shown in
+    several directories (e.g. security groups by ID and by name) is
+    fetched once.
+
+    Responses are shared by everyone who asks, so callers mustn't
+    modify them.
+
+    If given a DiskStore, responses are also kept there. The first time a
+    call is made after a restart, the response from the last run is given
+    right away while the call is made again in the background. Until then,
+    whatever is cached from it is only cached briefly (see note_stale).
+    """
+    def __init__(self, ttl_secs=30, store=None):
+        # Each get says how to fetch, since that takes its client and params
+        self.cache = LoadingCache(None, ttl_secs, budget=default_budget,
+                                  name='memo')
+        self.store = store
+        self.lock = Lock()
+        self.revived = set()  # Store keys we've answered from the store
+        self.requests = 0
+        self.hits = 0
+        self.calls = 0
+        self.calls_saved = 0
+        self.stale_served = 0
+
+    def call(self, service, region, client, operation, **params):
+        """
+        :return The response to client.<operation>(**params)
+        """
+        return self.get(service, region, client, operation, False, params)
+
+    def paginate(self, service, region, client, operation, **params):
+        """
+        :return All the pages of client.get_paginator(operation)
+        """
+        return self.get(service, region, client, operation, True, params)
+
+    def get(self, service, region, client, operation, is_paginated, params):
+        # Params may hold lists and dicts, so key on a canonical string
+        key = (service, region, operation, is_paginated,
+               json.dumps(params, sort_keys=True, default=str))
+        fetch = self.cache.get(key, lambda key: self.fetch(key, client,
+                                                           params))
+        with self.lock:
+            self.requests += 1
+            if fetch.served:
+                self.hits += 1
+                self.calls_saved += fetch.calls
+            if fetch.stale:
+                self.stale_served += 1
+            fetch.served = True
+        if fetch.stale:
+            note_stale()
+        return fetch.response
+
+    def fetch(self, key, client, params):
+        store_key = json.dumps(key)
+        if self.store is not None and self.should_revive(store_key):
+            stored = self.store.get(store_key)
+            if stored is not None:
+                (response, fetched) = stored
+                refresher = Thread(target=self.refresh,
+                                   args=(key, client, params, store_key),
+                                   name='refresh-%s' % key[2])
+                refresher.daemon = True
+                refresher.start()
+                return Fetch(response, 0, fetched, stale=True)
+        return self.fetch_live(key, client, params, store_key)
+
+    def should_revive(self, store_key):
+        with self.lock:
+            if store_key in self.revived:
+                return False
+            self.revived.add(store_key)
+            return True
+
+    def refresh(self, key, client, params, store_key):
+        # Let the stored response be cached first, lest it replace this one
+        self.cache.get(key, lambda key: self.fetch_live(key, client, params,
+                                                        store_key))
+        try:
+            fetch = self.fetch_live(key, client, params, store_key)
+        except Exception:
+            # The stored response stands until it expires
+            log.warning('Refreshing %s failed', store_key, exc_info=True)
+            return
+        self.cache.put(key, fetch)
+
+    def fetch_live(self, key, client, params, store_key):
+        (_, _, operation, is_paginated, _) = key
+        fetched = time()
+        if is_paginated:
+            response = list(client.get_paginator(operation).paginate(**params))
+            calls = len(response)
+        else:
+            response = getattr(client, operation)(**params)
+            calls = 1
+        with self.lock:
+            self.calls += calls
+        if self.store is not None:
+            self.store.put(store_key, response, fetched)
+        return Fetch(response, calls, fetched)
+
+    def clear(self):
+        with self.cache.lock:
+            for key in list(self.cache.cache):
+                self.cache.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return dict(requests=self.requests,
+                        hits=self.hits,
+                        hit_rate=(float(self.hits) / self.requests
+                                  if self.requests else None),
+                        calls=self.calls,
+                        calls_saved=self.calls_saved,
+                        stale_served=self.stale_served)
+
+
+class Fetch:
+    """
+    A memoized response, and how many AWS calls it took.
+
+    :param fetched  When the calls were made.
+    :param stale    Whether it's from a previous run, and being refetched.
+    """
+    def __init__(self, response, calls, fetched, stale=False):
+        self.response = response
+        self.calls = calls
+        self.fetched = fetched
+        self.stale = stale
+        self.served = False
+
+
+# Shared by all the services
+memo = Memo()
@@ -0,0 +1,72 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LoadingCache, default_budget, note_stale, run_load
+
+
+log = logging.getLogger('regions')
+
+# Shared by all the services' per-region fetches
+region_pool = ThreadPoolExecutor(max_workers=16)
+
+
+class RegionalData:
+    """
+    One kind of resource (e.g. a service's instances), fetched per region.
+
+    Fetching it for one region starts fetching it for the rest in parallel,
+    since a walk of one region (find, or a search for an ID) usually goes
+    on to the others. The all-regions view is then as slow as the slowest
+    region rather than the sum of them.
+
+    :param fetch_func   Called with a region, returns its resources.
+    :param get_regions_func Returns the regions to fetch from.
+    :param name             Of its cache, for stats.
+    """
+    def __init__(self, fetch_func, get_regions_func, ttl_secs=60,
+                 name='regional'):
+        self.fetch_func = fetch_func
+        self.get_regions_func = get_regions_func
+        self.cache = LoadingCache(self.load, ttl_secs, serve_stale=True,
+                                  budget=default_budget, name=name)
+
+    def get(self, region):
+        return self.cache.get(region)
+
+    def get_all(self):
+        """
+        :return [(region, resources)], in region order. Regions that fail
+                are logged and left out, so that one unreachable region
+                doesn't hide the rest.
+        """
+        # Whether the regions were fetched from stale data is noted on the
+        # pool's threads, so pass it on to whatever load called this
+        futures = [(region, region_pool.submit(run_load, self.cache.get,
+                                               region))
+                   for region in self.get_regions_func()]
+        results = []
+        for (region, future) in futures:
+            try:
+                (resources, stale) = future.result()
+            except Exception:
+                log.warning('Fetching %s failed', region, exc_info=True)
+                continue
+            if stale:
+                note_stale()
+            results.append((region, resources))
+        return results
+
+    def load(self, region):
+        for other_region in self.get_regions_func():
+            if other_region != region:
+                region_pool.submit(self.prefetch, other_region)
+        return self.fetch_func(region)
+
+    def prefetch(self, region):
+        # Unlike get, this skips regions already being loaded, and doesn't
+        # prefetch again in turn
+        try:
+            self.cache.load_many(
+                [region], lambda regions: {region: self.fetch_func(region)})
+        except Exception:
+            log.debug('Prefetching %s failed', region, exc_info=True)
@@ -1,5 +1,11 @@
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread
 
+import clients
+
+from cache import LoadingCache, default_budget
+from format import to_timestamp
+from memo import memo
 from vfs import *
 
 import logging
@@ -8,35 +14,280 @@ import logging
 log = logging.getLogger('s3')
 
 
+# Objects are read in blocks of this size, so that read(2)s of a big object
+# cost ranged GETs of about what was asked for rather than the whole thing.
+BLOCK_SIZE = 1024 * 1024
+
+# Keyed by (region, bucket, key, etag, block index). Including the ETag means
+# a changed object never gets served from blocks of its old contents.
+block_cache = LoadingCache(lambda block_id: get_block(*block_id),
+                           max_entries=64, budget=default_budget,
+                           name='s3-blocks')
+
+# Lists prefixes ahead of a recursive walk (e.g. find or du). Its size is
+# how many are listed at once.
+prefetch_pool = ThreadPoolExecutor(max_workers=8)
+
+# Most prefixes waiting to be listed ahead. Past this, whoever is
+# queueing them lists them itself.
+MAX_PENDING_PREFETCHES = 256
+
+prefetch_slots = BoundedSemaphore(MAX_PENDING_PREFETCHES)
+
+# A prefix counts as being walked once this many of its sub-prefixes have
+# been listed
+WALK_THRESHOLD = 3
+
+# Most prefixes one walk lists ahead, and how far below where it started.
+# Past either, the walker lists the rest itself.
+MAX_WALK_PREFETCHES = 2000
+MAX_WALK_DEPTH = 8
+
+# Bucket -> region. A bucket can't move, so these are kept for good.
+bucket_regions = LoadingCache(lambda bucket: get_bucket_region(bucket),
+                              name='s3-bucket-regions')
+
+# Bucket -> its dir. Kept across refreshes of the bucket list, so that what
+# the bucket has listed and read ahead isn't thrown away with it.
+bucket_dirs = LoadingCache(lambda bucket: PrefixDir(bucket_regions.get(bucket),
+                                                    bucket),
+                           name='s3-bucket-dirs')
+
+# Looks up the regions of all the buckets at once
+location_pool = ThreadPoolExecutor(max_workers=16)
+
+
 def s3_root():
     return CLDir(lambda: [
-        (bucket, CLDir(lambda _bucket=bucket:
-                       get_dirents(get_bucket_region(_bucket), _bucket)))
+        (bucket, lambda _bucket=bucket: bucket_dirs.get(_bucket))
         for bucket in get_bucket_names()
     ])
 
 
 def get_client(region):
-    return boto3.client('s3', region_name=region)
+    return clients.get_client('s3', region)
 
 
 def get_bucket_names():
-    return [
+    names = [
         bucket['Name']
-        for bucket in get_client('us-west-2').list_buckets()['Buckets']
+        for bucket in memo.call('s3', 'us-west-2', get_client('us-west-2'),
+                                'list_buckets')['Buckets']
     ]
+    # Whichever bucket is looked at first, its region is probably known by
+    # then. Only new buckets are actually looked up.
+    filler = Thread(target=bucket_regions.load_many,
+                    args=(names, get_bucket_regions),
+                    name='bucket-regions')
+    filler.daemon = True
+    filler.start()
+    return names
+
+
+def get_bucket_regions(buckets):
+    """
+    :return {bucket: region}, leaving out any that couldn't be looked up
+    """
+    futures = [(bucket, location_pool.submit(get_bucket_region, bucket))
+               for bucket in buckets]
+    regions = dict()
+    for (bucket, future) in futures:
+        try:
+            regions[bucket] = future.result()
+        except Exception:
+            log.warning('Looking up the region of %s failed', bucket,
+                        exc_info=True)
+    return regions
 
 
 def get_bucket_region(bucket):
-    return (get_client('us-west-2').
-            get_bucket_location(Bucket=bucket)['LocationConstraint'])
+    location = (get_client('us-west-2').
+                get_bucket_location(Bucket=bucket)['LocationConstraint'])
+    # Buckets in us-east-1 have no location constraint, and the oldest
+    # ones in eu-west-1 have the legacy one 'EU'
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
+
+class PrefixDir(PDir):
+    """
+    A bucket, or a prefix in one, listed a page at a time.
+
+    Once WALK_THRESHOLD of its sub-prefixes are listed, it's probably being
+    walked recursively (e.g. by find or du), so it lists the rest of them
+    ahead of the walker. Each of those only lists itself, until the walker
+    gets to it; then it lists its own sub-prefixes ahead, as part of the
+    same Walk.
+    """
+    def __init__(self, region, bucket, prefix='', parent=None):
+        PDir.__init__(self,
+                      lambda add_names: list_prefix(region, bucket, prefix,
+                                                    add_names),
+                      None, make_entry_node_func=self.make_child)
+        self.region = region
+        self.bucket = bucket
+        self.prefix = prefix
+        self.parent = parent
+        self.lock = Lock()
+        # The prefixes of the sub-prefixes listed so far, until it's walked
+        self.listed_subdirs = set()
+        self.walk = None  # The Walk it's part of, if it's being walked
+
+    def get_listing(self):
+        # Prefetches get the listing from PDir, so this is someone looking
+        # in the dir: maybe the walker
+        if self.parent is not None:
+            self.parent.on_subdir_listed(self)
+        return PDir.get_listing(self)
 
+    def on_subdir_listed(self, subdir):
+        with self.lock:
+            if self.walk is not None:
+                # The walker got to one of the prefixes listed ahead, so
+                # list its sub-prefixes ahead too
+                (to_prefetch, skip) = (subdir.join_walk(self.walk), ())
+            elif self.listed_subdirs is not None:
+                self.listed_subdirs.add(subdir.prefix)
+                if len(self.listed_subdirs) < WALK_THRESHOLD:
+                    return
+                # The walker has already been through these
+                skip = self.listed_subdirs
+                self.listed_subdirs = None
+                self.walk = self.find_walk() or Walk(self)
+                to_prefetch = self if self.walk.reaches(self) else None
+            else:
+                return
+        if to_prefetch is not None:
+            # Off the walker's thread, since it means waiting for a listing
+            prefetch_pool.submit(prefetch_subdirs, to_prefetch, skip)
 
-def get_dirents(region, bucket, prefix=''):
-    result = []
+    def join_walk(self, walk):
+        """
+        :return This dir, if it's the one to prefetch its sub-prefixes, or
+                None
+        """
+        with self.lock:
+            if self.walk is not None:
+                return None
+            self.walk = walk
+            self.listed_subdirs = None
+        return self if walk.reaches(self) else None
+
+    def find_walk(self):
+        """
+        :return The Walk of the nearest ancestor that's being walked, if any
+        """
+        ancestor = self.parent
+        while ancestor is not None:
+            if ancestor.walk is not None:
+                return ancestor.walk
+            ancestor = ancestor.parent
+        return None
+
+    def make_child(self, entry):
+        """
+        Makes the node of a listed object or sub-prefix from its entry, so
+        that a listing keeps only the entries.
+        """
+        if entry.is_dir():
+            return PrefixDir(self.region, self.bucket,
+                             self.prefix + entry.get_name() + '/', self)
+        (region, bucket, key, etag) = (self.region, self.bucket,
+                                       self.prefix + entry.get_name(),
+                                       entry.get_extra())
+        return RFile(lambda size, offset:
+                     read_item_range(region, bucket, key, etag, size, offset),
+                     entry.get_listed_size(), entry.get_mtime())
+
+
+class Walk:
+    """
+    A recursive walk of a prefix, and how much has been listed ahead of it.
+
+    :param root The PrefixDir it was noticed in.
+    """
+    def __init__(self, root):
+        self.lock = Lock()
+        self.depth = root.prefix.count('/')
+        self.prefetches = 0
+
+    def reaches(self, prefix_dir):
+        """
+        :return Whether prefix_dir is shallow enough to have its sub-prefixes
+                listed ahead
+        """
+        return prefix_dir.prefix.count('/') - self.depth < MAX_WALK_DEPTH
+
+    def take_prefetch(self):
+        """
+        :return Whether the walk may list another prefix ahead
+        """
+        with self.lock:
+            if self.prefetches >= MAX_WALK_PREFETCHES:
+                return False
+            self.prefetches += 1
+            return True
+
+
+def prefetch_subdirs(prefix_dir, skip=()):
+    """
+    Lists the sub-prefixes of a walked PrefixDir ahead of the walker, but
+    those in skip.
+    """
+    try:
+        # Only the sub-prefixes' nodes are made, not the objects'
+        listing = PDir.get_listing(prefix_dir)
+        offset = 0
+        while True:
+            entries = listing.get_entries_from(offset, 1000)
+            if not entries:
+                return
+            offset += len(entries)
+            for (name, entry) in entries:
+                if entry is None or not entry.is_dir():
+                    continue
+                if prefix_dir.prefix + name + '/' in skip:
+                    continue
+                if not prefix_dir.walk.take_prefetch():
+                    return
+                subdir = listing.get_child(name)
+                if prefetch_slots.acquire(False):
+                    prefetch_pool.submit(prefetch, subdir)
+                else:
+                    # Too many queued; list it here rather than skip it
+                    list_ahead(subdir)
+    except Exception:
+        log.debug('Prefetching under %s failed', prefix_dir.prefix,
+                  exc_info=True)
+
+
+def prefetch(prefix_dir):
+    try:
+        list_ahead(prefix_dir)
+    except Exception:
+        log.debug('Prefetching %s failed', prefix_dir.prefix, exc_info=True)
+    finally:
+        prefetch_slots.release()
+
+
+def list_ahead(prefix_dir):
+    # Waiting for the listing holds the worker, so that the pool bounds how
+    # many are listed at once
+    listing = PDir.get_listing(prefix_dir)
+    with listing.cond:
+        listing.wait()
+
+
+def list_prefix(region, bucket, prefix, add_names):
     for page in (get_client(region).
-                 get_paginator('list_objects').
+                 get_paginator('list_objects_v2').
                  paginate(Bucket=bucket, Delimiter='/', Prefix=prefix)):
+        names = []
+        # Rather than nodes, which PrefixDir.make_child makes from these
+        attrs = []
 
         # Files
         for item in page.get('Contents') or []:
@@ -44,21 +295,35 @@ def get_dirents(region, bucket, prefix=''):
             if key.endswith('/'):
                 # Sometimes the subdir itself is returned. Drop it
                 continue
-            log.info(key + ": " + key.split('/')[-1])
-            result.append((key.split('/')[-1],
-                           LFile(lambda _key=key:
-                                 get_item_file(region, bucket, _key),
-                                 item['Size'])))
+            names.append(key.split('/')[-1])
+            attrs.append((S_IFREG, item['Size'],
+                          to_timestamp(item.get('LastModified')),
+                          item['ETag']))
 
         # Subdirs
         for subdir_obj in page.get('CommonPrefixes') or []:
             subdir = subdir_obj['Prefix']  # Fully qualified with trailing /
-            result.append((subdir.rstrip('/').split('/')[-1],
-                           CLDir(lambda _subdir=subdir:
-                                 get_dirents(region, bucket, _subdir))))
-    return result
+            names.append(subdir.rstrip('/').split('/')[-1])
+            attrs.append((S_IFDIR, 0, None, None))
+
+        add_names(names, attrs=attrs)
+
+
+def read_item_range(region, bucket, key, etag, size, offset):
+    end = offset + size
+    chunks = []
+    for index in range(offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+        block = block_cache.get((region, bucket, key, etag, index))
+        block_start = index * BLOCK_SIZE
+        chunks.append(block[max(offset - block_start, 0):end - block_start])
+    return b''.join(chunks)
 
 
-def get_item_file(region, bucket, key):
-    return (boto3.resource('s3', region_name=region).
-            Object(bucket, key).get()['Body'].read())
+def get_block(region, bucket, key, etag, index):
+    start = index * BLOCK_SIZE
+    # If the object has changed since we listed it, S3 will refuse the
+    # request rather than give us a mix of old and new contents.
+    return (get_client(region).
+            get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                       Range='bytes=%d-%d' % (start, start + BLOCK_SIZE - 1))
+            ['Body'].read())
@@ -0,0 +1,164 @@
+import fcntl
+import logging
+import os
+import signal
+from threading import Lock, Thread
+from time import time
+
+
+log = logging.getLogger('stats')
+
+
+class Histogram:
+    """
+    Counts of latencies in buckets that double in width, from under 1ms
+    to 16s and over. Percentiles are the upper bound of the bucket they
+    fall in, which is close enough to tell 2ms from 200ms.
+    """
+    BOUNDS_MS = [2 ** i for i in range(15)]  # 1ms to 16s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+    def record(self, secs):
+        ms = secs * 1000
+        for (i, bound) in enumerate(self.BOUNDS_MS):
+            if ms < bound:
+                break
+        else:
+            i = len(self.BOUNDS_MS)
+        self.counts[i] += 1
+        self.count += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+
+    def percentile_ms(self, fraction):
+        if not self.count:
+            return None
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                break
+        if i < len(self.BOUNDS_MS):
+            return self.BOUNDS_MS[i]
+        return self.max_secs * 1000
+
+    def to_dict(self):
+        return dict(
+            count=self.count,
+            mean_ms=(self.total_secs * 1000 / self.count
+                     if self.count else None),
+            p50_ms=self.percentile_ms(0.5),
+            p99_ms=self.percentile_ms(0.99),
+            max_ms=self.max_secs * 1000,
+            buckets=dict(('<%dms' % bound, count)
+                         for (bound, count) in zip(self.BOUNDS_MS,
+                                                   self.counts)
+                         if count) or None)
+
+
+class Timings:
+    """
+    Latencies, errors and bytes transferred, by operation name.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.ops = dict()
+
+    def record(self, name, secs, error=False, byte_count=0):
+        with self.lock:
+            op = self.ops.get(name)
+            if op is None:
+                op = self.ops[name] = dict(latency=Histogram(), errors=0,
+                                           bytes=0)
+            op['latency'].record(secs)
+            if error:
+                op['errors'] += 1
+            op['bytes'] += byte_count
+
+    def to_dict(self):
+        with self.lock:
+            return dict((name, dict(op['latency'].to_dict(),
+                                    errors=op['errors'],
+                                    bytes=op['bytes']))
+                        for (name, op) in self.ops.items())
+
+
+# Of each op the kernel asks of us
+fuse_ops = Timings()
+
+# Of each AWS operation, by 'service.Operation'
+aws_calls = Timings()
+
+
+def attach(client):
+    """
+    Times a client's calls into aws_calls.
+    """
+    # Not before-call, since a handler of that can answer the call itself
+    # (e.g. a Stubber), and then the handlers after it aren't called
+    client.meta.events.register('before-parameter-build', on_before_call)
+    client.meta.events.register('after-call', on_after_call)
+
+
+def on_before_call(context, **kwargs):
+    context['stats_started'] = time()
+
+
+def on_after_call(http_response, model, context, **kwargs):
+    started = context.get('stats_started')
+    if started is None:
+        return
+    headers = getattr(http_response, 'headers', None) or {}
+    aws_calls.record('%s.%s' % (model.service_model.service_name,
+                                model.name),
+                     time() - started,
+                     error=http_response.status_code >= 400,
+                     byte_count=int(headers.get('content-length') or 0))
+
+
+# SIGUSR1 dumps the stats to the log. Python only runs signal handlers on
+# the main thread, which sits in libfuse for as long as we're mounted, so
+# instead the signal wakes a thread of our own through a pipe.
+
+dump_fd = None
+
+
+def install_dump_signal():
+    """
+    Must be called on the main thread, before mounting.
+    """
+    global dump_fd
+    (read_fd, write_fd) = os.pipe()
+    fcntl.fcntl(write_fd, fcntl.F_SETFL,
+                fcntl.fcntl(write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(write_fd)
+    # The handler itself does nothing; it's there so that Python catches
+    # the signal and writes to the pipe
+    signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+    dump_fd = read_fd
+
+
+def start_dump_thread(get_stats_json_func):
+    """
+    Call once mounted, since mounting in the background forks, and threads
+    don't survive a fork.
+    """
+    if dump_fd is None:
+        return
+
+    def dump_forever():
+        while True:
+            os.read(dump_fd, 1)
+            try:
+                log.info('Stats:\n%s', get_stats_json_func())
+            except Exception:
+                log.error('Dumping stats failed', exc_info=True)
+
+    dumper = Thread(target=dump_forever, name='stats-dump')
+    dumper.daemon = True
+    dumper.start()
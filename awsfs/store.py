@@ -0,0 +1,124 @@
+import logging
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from format import dump_tagged, load_tagged
+
+
+log = logging.getLogger('store')
+
+
+class DiskStore:
+    """
+    Values kept on disk across mounts, with when they were fetched, so that
+    a fresh mount can answer from what the last one saw while it fetches
+    the real thing.
+
+    Backed by a SQLite file. Values are read when first asked for, not at
+    startup, and written by a background thread so that nobody waits on
+    the disk. They're kept as compressed JSON (see format.dump_tagged), so
+    they must be what a response from boto can hold.
+
+    Values that take more than max_value_bytes aren't kept. Once there are
+    more than max_entries, or they take more than max_bytes, the ones
+    fetched longest ago are dropped (but never the newest).
+    """
+    def __init__(self, path, max_value_bytes=16 * 1024 * 1024,
+                 max_entries=10000, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_value_bytes = max_value_bytes
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            # Losing the last few writes in a crash just means refetching
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=OFF')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'key TEXT PRIMARY KEY, '
+                            'fetched REAL NOT NULL, '
+                            'value BLOB NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_by_fetched '
+                            'ON entries (fetched)')
+            self.db.commit()
+            (self.entries, self.bytes) = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) '
+                'FROM entries').fetchone()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, key):
+        """
+        :return (value, when it was fetched), or None
+        """
+        try:
+            with self.lock:
+                row = self.db.execute(
+                    'SELECT value, fetched FROM entries WHERE key = ?',
+                    (key,)).fetchone()
+            if row is None:
+                return None
+            return load_tagged(zlib.decompress(bytes(row[0]))), row[1]
+        except Exception:
+            # Whatever's wrong with it, it can just be fetched again
+            log.warning('Reading %s from %s failed', key, self.path,
+                        exc_info=True)
+            return None
+
+    def put(self, key, value, fetched):
+        self.writer.submit(self.write, key, value, fetched)
+
+    def write(self, key, value, fetched):
+        try:
+            data = zlib.compress(dump_tagged(value).encode('utf-8'))
+            with self.lock:
+                self.delete(key)
+                if len(data) <= self.max_value_bytes:
+                    self.db.execute('INSERT INTO entries VALUES (?, ?, ?)',
+                                    (key, fetched, sqlite3.Binary(data)))
+                    self.entries += 1
+                    self.bytes += len(data)
+                    self.evict(key)
+                self.db.commit()
+        except Exception:
+            log.warning('Writing %s to %s failed', key, self.path,
+                        exc_info=True)
+
+    def delete(self, key):
+        """
+        The caller must hold the lock.
+        """
+        row = self.db.execute('SELECT LENGTH(value) FROM entries '
+                              'WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.entries -= 1
+            self.bytes -= row[0]
+
+    def evict(self, keep):
+        """
+        Drops the values fetched longest ago until it's within its limits,
+        but never keep, the one just written. The caller must hold the lock.
+        """
+        if self.entries <= self.max_entries and self.bytes <= self.max_bytes:
+            return
+        victims = []
+        for (key, size) in self.db.execute(
+                'SELECT key, LENGTH(value) FROM entries ORDER BY fetched'):
+            if (self.entries <= self.max_entries and
+                    self.bytes <= self.max_bytes):
+                break
+            if key == keep:
+                continue
+            victims.append((key,))
+            self.entries -= 1
+            self.bytes -= size
+        self.db.executemany('DELETE FROM entries WHERE key = ?', victims)
+
+    def flush(self):
+        """
+        Waits for the writes so far.
+        """
+        self.writer.submit(lambda: None).result()
@@ -0,0 +1,190 @@
+import json
+import logging
+import struct
+import zlib
+from io import BytesIO
+from threading import Lock
+from time import sleep, time
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+from format import dump_tagged, load_tagged
+
+log = logging.getLogger('traffic')
+
+# The first line of a trace file
+MAGIC = b'awsfs-traffic 2\n'
+
+
+class Recorder:
+    """
+    Writes every AWS call made by the clients of its session to a trace
+    file: the params, the response, when it was made and how long it took.
+    Replaying the trace with a Player shows awsfs the same AWS, offline.
+
+    The file is the MAGIC line followed by records, each compressed and
+    prefixed with its length, and is written as calls finish. Whatever
+    made it to disk can be replayed, even if awsfs never unmounted cleanly.
+    Records are JSON (see format.dump_tagged), so a trace from elsewhere
+    is safe to replay.
+
+    A call's time includes botocore's retries of it, since that's how long
+    the caller waited.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.file.flush()
+        self.started = time()
+        self.calls = 0
+
+    def make_session(self):
+        session = boto3.session.Session()
+        session.events.register('before-parameter-build', on_params)
+        session.events.register('before-call', self.on_before_call)
+        session.events.register('after-call', self.on_after_call)
+        return session
+
+    def on_before_call(self, request_signer, context, **kwargs):
+        context['traffic_region'] = request_signer.region_name
+        context['traffic_started'] = time()
+
+    def on_after_call(self, http_response, parsed, model, context, **kwargs):
+        started = context.get('traffic_started')
+        if started is None:
+            return
+        response = dict(parsed)
+        payload = get_streaming_payload(model)
+        if payload is not None and payload in parsed:
+            # Read the stream to record it, and give the caller another
+            data = parsed[payload].read()
+            parsed[payload] = StreamingBody(BytesIO(data), len(data))
+            response[payload] = data
+        record = (started - self.started, time() - started,
+                  model.service_model.service_name, context['traffic_region'],
+                  model.name, context.get('traffic_params', {}),
+                  http_response.status_code, response)
+        try:
+            data = zlib.compress(dump_tagged(record).encode('utf-8'))
+            with self.lock:
+                self.file.write(struct.pack('>I', len(data)))
+                self.file.write(data)
+                self.file.flush()
+                self.calls += 1
+        except Exception:
+            log.warning('Recording %s to %s failed', model.name, self.path,
+                        exc_info=True)
+
+
+class Player:
+    """
+    Answers the AWS calls of the clients of its session from a trace
+    written by a Recorder, without any network.
+
+    Each call gets the response recorded for the same operation and params
+    in the same region, after the time the call took then, scaled by
+    latency_scale (0 to answer at once). A call made several times gets
+    the responses in the order they were recorded, then the last one
+    again. A call that isn't in the trace fails with the code NotInTrace.
+    """
+    def __init__(self, path, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.lock = Lock()
+        # call key -> [(secs, compressed record)], and how many are served
+        self.records = dict()
+        self.served = dict()
+        for data in read_records(path):
+            (_, secs, service, region, operation, params, _, _) = \
+                read_record(data)
+            self.records.setdefault(
+                get_call_key(service, region, operation, params),
+                []).append((secs, data))
+        log.info('Replaying %d calls from %s',
+                 sum(len(records) for records in self.records.values()), path)
+
+    def make_session(self):
+        # The credentials are never used, since nothing is sent
+        session = boto3.session.Session(aws_access_key_id='replay',
+                                        aws_secret_access_key='replay')
+        session.events.register('before-parameter-build', on_params)
+        session.events.register('before-call', self.on_before_call)
+        return session
+
+    def on_before_call(self, model, request_signer, context, **kwargs):
+        key = get_call_key(model.service_model.service_name,
+                           request_signer.region_name, model.name,
+                           context.get('traffic_params', {}))
+        records = self.records.get(key)
+        if not records:
+            return (AWSResponse('https://replay', 500, {}, None),
+                    {'Error': {'Code': 'NotInTrace',
+                               'Message': 'No recorded response to %s'
+                                          % (key,)},
+                     'ResponseMetadata': {'HTTPStatusCode': 500}})
+        with self.lock:
+            i = self.served.get(key, 0)
+            self.served[key] = i + 1
+        (secs, data) = records[min(i, len(records) - 1)]
+        if self.latency_scale:
+            sleep(secs * self.latency_scale)
+
+        (_, _, _, _, _, _, status_code, response) = read_record(data)
+        payload = get_streaming_payload(model)
+        if payload is not None and payload in response:
+            body = response[payload]
+            if not isinstance(body, bytes):
+                # It was recorded as text, since it could be
+                body = body.encode('utf-8')
+            response[payload] = StreamingBody(BytesIO(body), len(body))
+        return AWSResponse('https://replay', status_code, {}, None), response
+
+
+def on_params(params, context, **kwargs):
+    # Later events get the serialized request rather than the params
+    context['traffic_params'] = dict(params)
+
+
+def get_call_key(service, region, operation, params):
+    return (service, region, operation,
+            json.dumps(params, sort_keys=True, default=str))
+
+
+def get_streaming_payload(model):
+    """
+    :return The name of the member of the operation's response that's a
+            stream (e.g. an S3 object's Body), or None
+    """
+    if not model.has_streaming_output:
+        return None
+    return model.output_shape.serialization.get('payload')
+
+
+def read_record(data):
+    """
+    :return The record from a compressed record, as read by read_records
+    """
+    return load_tagged(zlib.decompress(data).decode('utf-8'))
+
+
+def read_records(path):
+    """
+    Yields the compressed records in a trace file. A record cut short, as
+    by a crash while writing it, ends the trace.
+    """
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError('%s is not an awsfs traffic trace' % path)
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            (length,) = struct.unpack('>I', header)
+            data = f.read(length)
+            if len(data) < length:
+                log.warning('%s ends in the middle of a record', path)
+                return
+            yield data
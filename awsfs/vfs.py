@@ -1,6 +1,22 @@
+import logging
+from array import array
 from stat import S_IFDIR, S_IFREG, S_IFLNK
+from threading import Condition, Thread
+from time import time
 
-from cache import LoadingCache
+from cache import LoadingCache, default_budget
+
+
+log = logging.getLogger('vfs')
+
+
+def slice_contents(contents, size=None, offset=0):
+    """
+    The part of a file's contents that read(size, offset) should return.
+    """
+    if size is None:
+        return contents[offset:]
+    return contents[offset:offset + size]
 
 
 class VNode:
@@ -22,7 +38,11 @@ class VNode:
                 return cnode
         return None
 
-    def read(self):
+    def read(self, size=None, offset=0):
+        """
+        :param size     Max number of bytes to read. None means to the end.
+        :param offset   Where in the file to start reading.
+        """
         raise Exception("Abstract!")
 
     def write(self, bytebuf):
@@ -31,6 +51,21 @@ class VNode:
     def get_size(self):
         raise Exception("Abstract!")
 
+    def get_listed_size(self):
+        """
+        The size, if it's known without loading anything, so that it can be
+        given along with the node's name when its dir is listed. Else None.
+        """
+        return None
+
+    def get_mtime(self):
+        """
+        :return When the node last changed, in seconds since the epoch, as
+                far as we know: when AWS says it was modified, or when we
+                fetched it. None if we don't know.
+        """
+        return None
+
 
 class VDir(VNode):
     def is_dir(self):
@@ -42,6 +77,94 @@ class VDir(VNode):
     def get_size(self):
         return 0
 
+    def get_listed_size(self):
+        return 0
+
+    def get_listing(self):
+        raise Exception("Abstract!")
+
+    def get_children(self):
+        return self.get_listing().get_children()
+
+    def get_child(self, name):
+        return self.get_listing().get_child(name)
+
+    def get_names(self):
+        return self.get_listing().get_names()
+
+    def is_current(self, generation):
+        """
+        Whether get_listing() would still return the listing with the given
+        generation, so that whatever was looked up in it is still valid.
+        """
+        return False
+
+
+class Listing:
+    """
+    A directory's (name, node) pairs, indexed by name.
+
+    Instead of a node, a child may be given as a function that makes it.
+    It's called the first time the child is looked up, and the node is
+    kept. That way listing a directory of many complex children (e.g. EC2
+    instances) only costs as much as their names.
+
+    :param generation   Identifies this version of the directory's contents.
+                        None if it may be different on every call.
+    """
+    def __init__(self, children, generation=None):
+        self.children = children
+        self.index = dict()
+        for (name, node) in children:
+            # Like a scan of the children would, the first one wins
+            self.index.setdefault(name, node)
+        self.generation = generation
+        self.made = dict()  # Nodes made from functions, by name
+
+    def get_child(self, name):
+        node = self.index.get(name)
+        if callable(node):
+            node = self.make(name, node)
+        return node
+
+    def get_children(self):
+        children = []
+        for (name, node) in self.children:
+            if callable(node):
+                # Only the first child by each name is kept
+                node = (self.make(name, node) if self.index[name] is node
+                        else node())
+            children.append((name, node))
+        return children
+
+    def get_names(self):
+        return [name for (name, _) in self.children]
+
+    def get_entries_from(self, offset, limit):
+        """
+        Up to limit (name, node) pairs, starting with the one at offset, for
+        listing the directory a batch at a time. The node is None if it's
+        yet to be made, since making it just to list it would undo the
+        point of making it lazily.
+        """
+        return [(name, self.get_made(name, node))
+                for (name, node) in self.children[offset:offset + limit]]
+
+    def get_made(self, name, node):
+        """
+        :return node, or if it's a function, the node made from it, if any
+        """
+        if callable(node):
+            return self.made.get(name)
+        return node
+
+    def make(self, name, make_node_func):
+        made = self.made.get(name)
+        if made is None:
+            # If another thread beat us to it, use its node
+            made = self.made.setdefault(name, make_node_func())
+        return made
+
 
 class VFile(VNode):
     def is_dir(self):
@@ -50,6 +173,32 @@ class VFile(VNode):
     def get_type(self):
         return S_IFREG
 
+    def open(self):
+        """
+        Prepares for a series of reads of this file, as by open(2).
+
+        :return Something to read(size, offset) from until the file is
+                closed. By default, a snapshot of the whole contents, so
+                that opening costs one load and the reader sees a
+                consistent file.
+        """
+        return SFile(self.read())
+
+    def is_size_exact(self):
+        """
+        Whether get_size() is the real size. If not, it's a guess, and reads
+        mustn't be cut off at it.
+        """
+        return True
+
+    def keeps_cache(self):
+        """
+        Whether the kernel may keep the contents it's read between opens.
+        Only for files whose contents can't change without their mtime or
+        size changing too.
+        """
+        return False
+
 
 class VLink(VFile):
     def __init__(self, dest):
@@ -62,20 +211,33 @@ class VLink(VFile):
     def get_size(self):
         return len(self.dest.encode())
 
-    def read(self):
-        return self.dest.encode()
+    def get_listed_size(self):
+        return self.get_size()
+
+    def read(self, size=None, offset=0):
+        return slice_contents(self.dest.encode(), size, offset)
 
 
 class SDir(VDir):
     """
     A directory with static contents.
+
+    :param mtime    See VNode.get_mtime.
     """
-    def __init__(self, children):
+    def __init__(self, children, mtime=None):
         VDir.__init__(self)
         self.children = children
+        self.listing = Listing(children, generation=0)
+        self.mtime = mtime
 
-    def get_children(self):
-        return self.children
+    def get_listing(self):
+        return self.listing
+
+    def get_mtime(self):
+        return self.mtime
+
+    def is_current(self, generation):
+        return True
 
 
 class LDir(VDir):
@@ -86,17 +248,454 @@ class LDir(VDir):
         VDir.__init__(self)
         self.get_children_func = get_children_func
 
-    def get_children(self):
-        return self.get_children_func()
+    def get_listing(self):
+        return Listing(self.get_children_func())
 
 
 class CLDir(LDir):
     """
     A directory with cached, lazy-loaded contents.
+
+    Once loaded, the contents are refreshed in the background when they
+    expire, so listing the directory never waits on AWS again.
     """
     def __init__(self, get_children_func, ttl_sec=60):
-        cache = LoadingCache(lambda _: get_children_func(), ttl_sec)
-        LDir.__init__(self, lambda: cache.get('children'))
+        LDir.__init__(self, get_children_func)
+        self.ttl_sec = ttl_sec
+        # Of the newest listing
+        self.generation = 0
+        self.expiry = 0
+        self.loaded = None
+        self.cache = LoadingCache(lambda _: self.load_listing(), ttl_sec,
+                                  serve_stale=True, budget=default_budget,
+                                  name='listings')
+
+    def get_listing(self):
+        return self.cache.get('listing')
+
+    def load_listing(self):
+        listing = self.make_listing(self.generation + 1)
+        # Loads are single-flight, so only one thread gets here at a time
+        self.generation = listing.generation
+        self.loaded = time()
+        self.expiry = self.loaded + self.ttl_sec
+        return listing
+
+    def make_listing(self, generation):
+        return Listing(self.get_children_func(), generation)
+
+    def is_current(self, generation):
+        return generation == self.generation and time() < self.expiry
+
+    def get_mtime(self):
+        return self.loaded
+
+
+class LookupListing(Listing):
+    """
+    A listing which can also find children it doesn't list, by name. Use
+    this where listing everything would be too much, but any one thing is
+    cheap to look up.
+
+    :param lookup_func  Called as lookup_func(name). Returns the node, or
+                        None if there's no such child.
+    """
+    def __init__(self, children, lookup_func, generation=None):
+        Listing.__init__(self, children, generation)
+        self.lookup_func = lookup_func
+
+    def get_child(self, name):
+        node = Listing.get_child(self, name)
+        if node is None:
+            node = self.make(name, lambda: self.lookup_func(name))
+        return node
+
+
+class LookupDir(CLDir):
+    """
+    A directory with cached, lazy-loaded contents, in which unlisted
+    children can also be looked up (see LookupListing).
+    """
+    def __init__(self, get_children_func, lookup_func, ttl_sec=60):
+        CLDir.__init__(self, get_children_func, ttl_sec)
+        self.lookup_func = lookup_func
+
+    def make_listing(self, generation):
+        return LookupListing(self.get_children_func(), self.lookup_func,
+                             generation)
+
+
+class PackedStrings(object):
+    """
+    Strings, kept as their UTF-8 one after another in a single buffer
+    rather than as an object each.
+    """
+    __slots__ = ['data', 'ends']
+
+    def __init__(self):
+        self.data = bytearray()
+        # Where each string ends in data. 4 bytes each, so data can hold
+        # up to 4GiB.
+        self.ends = array('I')
+
+    def __len__(self):
+        return len(self.ends)
+
+    def append(self, encoded):
+        # data first, so that a reader never sees an end past it
+        self.data.extend(encoded)
+        self.ends.append(len(self.data))
+
+    def get(self, i):
+        ends = self.ends
+        return self.data[ends[i - 1] if i else 0:ends[i]].decode('utf-8')
+
+    def get_encoded(self, i):
+        ends = self.ends
+        return bytes(self.data[ends[i - 1] if i else 0:ends[i]])
+
+    def equals(self, i, encoded):
+        ends = self.ends
+        (start, end) = (ends[i - 1] if i else 0, ends[i])
+        return (end - start == len(encoded) and
+                self.data[start:end] == encoded)
+
+
+class EntryTable(object):
+    """
+    The names of a dir's entries, and optionally the type, size, mtime and
+    one more string (e.g. an S3 object's ETag) of each, packed into a few
+    arrays rather than kept as objects. For a dir of millions of entries,
+    that's tens of bytes an entry rather than hundreds.
+
+    It's a sequence of the names, in the order they were added. Names are
+    unique; adding one again does nothing. It's not thread-safe, except
+    that it can be read by index while it's added to.
+    """
+    __slots__ = ['names', 'slots', 'types', 'sizes', 'mtimes', 'extras']
+
+    def __init__(self):
+        self.names = PackedStrings()
+        # Open-addressed hash index of the names: the index of the name in
+        # each slot, or -1. Kept under half full.
+        self.slots = array('i', [-1]) * 8
+        # Made once an entry is added with attributes. Types are kept as
+        # the type bits of the mode >> 12, with 0 for an entry without
+        # attributes, and unknown sizes and mtimes as -1.
+        self.types = None
+        self.sizes = None
+        self.mtimes = None
+        self.extras = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.names.get(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.names.get(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.names.get(i)
+
+    def find(self, name):
+        """
+        :return The index of name, or -1
+        """
+        encoded = encode_name(name)
+        return self.slots[self.find_slot(encoded)]
+
+    def find_slot(self, encoded):
+        """
+        :return The slot that has the name, or else the one it'd go in
+        """
+        # This and add are run for every name, so they go easy on lookups
+        slots = self.slots
+        mask = len(slots) - 1
+        slot = hash(encoded) & mask
+        while True:
+            i = slots[slot]
+            if i < 0 or self.names.equals(i, encoded):
+                return slot
+            slot = (slot + 1) & mask
+
+    def add(self, name, type=None, size=None, mtime=None, extra=None):
+        """
+        :param type The type bits of the entry's mode (e.g. S_IFDIR).
+                    Without one, the entry has no attributes.
+        :return Whether it was added, i.e. the name is new.
+        """
+        encoded = name if isinstance(name, bytes) else name.encode('utf-8')
+        slot = self.find_slot(encoded)
+        slots = self.slots
+        if slots[slot] >= 0:
+            return False
+        i = len(self.names.ends)
+        slots[slot] = i
+        if type is not None and self.types is None:
+            self.add_attribute_arrays(i)
+        if self.types is not None:
+            self.types.append(type >> 12 if type is not None else 0)
+            self.sizes.append(size if size is not None else -1)
+            self.mtimes.append(mtime if mtime is not None else -1)
+            self.extras.append(encode_name(extra or b''))
+        self.names.append(encoded)
+
+        if 2 * (i + 1) > len(slots):
+            self.grow_slots()
+        return True
+
+    def add_attribute_arrays(self, count):
+        # For the entries so far, which were added without
+        self.types = array('B', [0]) * count
+        # Doubles, which hold any size exactly, since Python 2's arrays
+        # have no portable 64-bit int
+        self.sizes = array('d', [-1]) * count
+        self.mtimes = array('d', [-1]) * count
+        self.extras = PackedStrings()
+        for _ in range(count):
+            self.extras.append(b'')
+
+    def grow_slots(self):
+        slots = array('i', [-1]) * (2 * len(self.slots))
+        mask = len(slots) - 1
+        for i in range(len(self.names)):
+            slot = hash(self.names.get_encoded(i)) & mask
+            while slots[slot] >= 0:
+                slot = (slot + 1) & mask
+            slots[slot] = i
+        self.slots = slots
+
+    def get_entry(self, i):
+        """
+        :return An Entry for the name at i, or None if it was added
+                without attributes
+        """
+        if self.types is None or not self.types[i]:
+            return None
+        return Entry(self, i)
+
+
+def encode_name(name):
+    return name if isinstance(name, bytes) else name.encode('utf-8')
+
+
+class Entry(object):
+    """
+    A view of one entry of an EntryTable. It has what listing a dir needs
+    of a node (is_dir, get_type, get_listed_size and get_mtime), so that
+    no real node need be made to list one.
+    """
+    __slots__ = ['table', 'index']
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def get_name(self):
+        return self.table.names.get(self.index)
+
+    def is_dir(self):
+        return self.get_type() == S_IFDIR
+
+    def get_type(self):
+        return self.table.types[self.index] << 12
+
+    def get_listed_size(self):
+        size = self.table.sizes[self.index]
+        return int(size) if size >= 0 else None
+
+    def get_mtime(self):
+        mtime = self.table.mtimes[self.index]
+        return mtime if mtime >= 0 else None
+
+    def get_extra(self):
+        return self.table.extras.get(self.index)
+
+
+class PagedListing(Listing):
+    """
+    A listing which is filled a page of names at a time, by another thread.
+    It can be read while it's being filled; readers wait for the names they
+    need to arrive.
+
+    Rather than a node per child, it can keep only the names, and make a
+    child's node when it's first looked up. The names are kept in an
+    EntryTable, along with any attributes they were added with. A child
+    added with attributes is made from them, and unless it's a dir (which
+    holds its own listing), made again on each lookup rather than kept.
+
+    :param make_node_func       Called as make_node_func(name), for
+                                children added with neither a node nor
+                                attributes.
+    :param make_entry_node_func Called as make_entry_node_func(entry) with
+                                an Entry, for children added with
+                                attributes.
+    """
+    def __init__(self, make_node_func, generation=None,
+                 make_entry_node_func=None):
+        Listing.__init__(self, [], generation)
+        self.make_node_func = make_node_func
+        self.make_entry_node_func = make_entry_node_func
+        self.names = EntryTable()
+        self.nodes = dict()  # For children added with one, by name
+        self.cond = Condition()
+        self.complete = False
+        self.error = None
+
+    def fill(self, fill_func, on_complete=None):
+        """
+        Runs fill_func(add_names), where add_names(names[, nodes]) is to be
+        called with each page as it arrives, possibly from several threads.
+        """
+        error = None
+        try:
+            fill_func(self.add_names)
+        except Exception as e:
+            log.warning('Filling listing failed', exc_info=True)
+            error = e
+        with self.cond:
+            self.complete = True
+            self.error = error
+            self.cond.notify_all()
+        if on_complete:
+            on_complete()
+
+    def add_names(self, names, nodes=None, attrs=None):
+        """
+        :param nodes    If given, the node for each name, or a function that
+                        makes it (as in Listing).
+        :param attrs    If given, (type, size, mtime, extra) for each name,
+                        as in EntryTable.add.
+        """
+        with self.cond:
+            for (i, name) in enumerate(names):
+                added = (self.names.add(name, *attrs[i]) if attrs is not None
+                         else self.names.add(name))
+                if added and nodes is not None:
+                    self.nodes[name] = nodes[i]
+            self.cond.notify_all()
+
+    def wait(self):
+        """
+        Waits for the last page. The caller must hold cond.
+        """
+        while not self.complete:
+            self.cond.wait()
+        if self.error:
+            raise self.error
+
+    def get_child(self, name):
+        with self.cond:
+            i = self.names.find(name)
+            while i < 0 and not self.complete:
+                self.cond.wait()
+                i = self.names.find(name)
+            if i < 0:
+                self.wait()
+                return None
+            node = self.nodes.get(name)
+            entry = self.names.get_entry(i)
+        if node is not None:
+            return self.make(name, node) if callable(node) else node
+        if entry is not None:
+            if entry.is_dir():
+                return self.make(name,
+                                 lambda: self.make_entry_node_func(entry))
+            # Only a view of the entry, so there's no need to keep it
+            return self.make_entry_node_func(entry)
+        return self.make(name, lambda: self.make_node_func(name))
+
+    def get_children(self):
+        return [(name, self.get_child(name)) for name in self.get_names()]
+
+    def get_names(self):
+        with self.cond:
+            self.wait()
+            return list(self.names)
+
+    def get_entries_from(self, offset, limit):
+        # Return as soon as there's something, so that the caller can list
+        # what's arrived while the rest is being loaded
+        with self.cond:
+            while offset >= len(self.names) and not self.complete:
+                self.cond.wait()
+            if offset >= len(self.names):
+                self.wait()
+            entries = []
+            for i in range(offset, min(offset + limit, len(self.names))):
+                name = self.names[i]
+                entries.append((name, self.get_listed_node(name, i)))
+            return entries
+
+    def get_listed_node(self, name, i):
+        """
+        The caller must hold cond.
+        """
+        node = self.nodes.get(name)
+        if node is not None:
+            return self.get_made(name, node)
+        # A dir's node is kept once made, and is more current than its
+        # entry (e.g. it knows when it was listed)
+        made = self.made.get(name)
+        return made if made is not None else self.names.get_entry(i)
+
+
+class PDir(CLDir):
+    """
+    A directory with cached contents, which are loaded a page at a time in
+    the background (see PagedListing). It can be listed while it's loading.
+
+    When the contents expire, the stale listing is used until the new one
+    is complete.
+
+    :param fill_func            See PagedListing.fill.
+    :param make_node_func       See PagedListing.
+    :param make_entry_node_func See PagedListing.
+    """
+    def __init__(self, fill_func, make_node_func, ttl_sec=60,
+                 make_entry_node_func=None):
+        CLDir.__init__(self, None, ttl_sec)
+        self.fill_func = fill_func
+        self.make_node_func = make_node_func
+        self.make_entry_node_func = make_entry_node_func
+
+    def make_listing(self, generation):
+        listing = PagedListing(self.make_node_func, generation,
+                               self.make_entry_node_func)
+        filler = Thread(target=listing.fill,
+                        args=(self.fill_func,
+                              lambda: self.on_filled(listing)),
+                        name='fill-listing')
+        filler.daemon = True
+        filler.start()
+
+        stale = self.cache.peek('listing')
+        if stale is not None and stale.complete and not stale.error:
+            # The stale listing is served while we reload in the background,
+            # so don't swap a half-full listing in for it. Otherwise (the
+            # first listing, or after an eviction or a failed fill) the
+            # caller is waiting, and can list this as it arrives.
+            with listing.cond:
+                listing.wait()
+        return listing
+
+    def get_listing(self):
+        listing = self.cache.get('listing')
+        if listing.complete and listing.error:
+            # Like a failed load, don't keep it; try again
+            self.cache.invalidate('listing', listing)
+            listing = self.cache.get('listing')
+        return listing
+
+    def on_filled(self, listing):
+        if not listing.error:
+            self.cache.update_size('listing')
 
 
 class SFile(VFile):
@@ -108,8 +707,11 @@ class SFile(VFile):
         self.contents = contents
         self.size = len(self.contents)
 
-    def read(self):
-        return self.contents
+    def open(self):
+        return self
+
+    def read(self, size=None, offset=0):
+        return slice_contents(self.contents, size, offset)
 
     def write(self, _):
         pass
@@ -117,27 +719,138 @@ class SFile(VFile):
     def get_size(self):
         return self.size
 
+    def get_listed_size(self):
+        return self.size
+
 
 class LFile(VFile):
     """
     A file with lazy-loaded contents.
 
     :param size Of the file, in bytes.
-                If 'auto', will be computed by calling read(). This is
-                inadvisable since size is reported by stat(2), which is
-                generally assumed to be fast (e.g. `ls` stats every file).
+                If 'auto', the size is unknown until the file is read. Until
+                then it's reported as 0, and afterwards as of the latest
+                read; either way it's not exact. We never load the contents
+                just to report the size, since size is reported by stat(2),
+                which is generally assumed to be fast (e.g. `ls` stats
+                every file).
     """
     def __init__(self, get_contents_func, size='auto'):
         VFile.__init__(self)
         self.get_contents_func = get_contents_func
         self.size = size
-        # TODO what if the contents change? We'll cache size forever
+        self.last_read_size = 0
+        self.last_read_time = None
 
-    def read(self):
-        return self.get_contents_func()
+    def read(self, size=None, offset=0):
+        contents = self.get_contents_func()
+        self.last_read_size = len(contents)
+        self.last_read_time = time()
+        return slice_contents(contents, size, offset)
 
     def write(self, _):
         pass
 
     def get_size(self):
-        return len(self.read()) if self.size == 'auto' else self.size
+        return self.last_read_size if self.size == 'auto' else self.size
+
+    def get_listed_size(self):
+        return self.size if self.size != 'auto' else None
+
+    def is_size_exact(self):
+        return self.size != 'auto'
+
+    def get_mtime(self):
+        # The contents are fetched on every read, so that's when they're from
+        return self.last_read_time
+
+
+class CLFile(LFile):
+    """
+    A file with lazy-loaded contents, which are loaded once and kept.
+    Use this for contents that are expensive to make but never change,
+    like the JSON of a record we already have.
+
+    :param mtime    See VNode.get_mtime. By default, when the contents were
+                    made.
+    """
+    def __init__(self, get_contents_func, mtime=None):
+        LFile.__init__(self, get_contents_func)
+        self.contents = None
+        self.mtime = mtime
+
+    def read(self, size=None, offset=0):
+        if self.contents is None:
+            self.contents = self.get_contents_func()
+            self.last_read_time = time()
+        return slice_contents(self.contents, size, offset)
+
+    def open(self):
+        return self
+
+    def get_size(self):
+        # Making the contents is cheap, since nothing has to be fetched
+        return len(self.read())
+
+    def get_listed_size(self):
+        # But it's not free, and listing a dir shouldn't make all of them
+        return len(self.contents) if self.contents is not None else None
+
+    def is_size_exact(self):
+        return True
+
+    def keeps_cache(self):
+        # A record's own time (e.g. when an instance was launched) stays put
+        # while the rest of it changes. The time the contents were made is
+        # new each time the record is, since that makes a new file.
+        return self.mtime is None
+
+    def get_mtime(self):
+        return self.mtime if self.mtime is not None else self.last_read_time
+
+
+class RFile(VFile):
+    """
+    A file of known size whose contents are loaded a range at a time.
+    Use this for big files, where loading the whole thing to serve a
+    single read(2) would be wasteful.
+
+    :param read_range_func  Called as read_range_func(size, offset), with
+                            the range already clipped to the file.
+    :param size             Of the file, in bytes.
+    :param mtime            See VNode.get_mtime.
+    """
+    def __init__(self, read_range_func, size, mtime=None):
+        VFile.__init__(self)
+        self.read_range_func = read_range_func
+        self.size = size
+        self.mtime = mtime
+
+    def read(self, size=None, offset=0):
+        offset = min(offset, self.size)
+        if size is None or offset + size > self.size:
+            size = self.size - offset
+        if size == 0:
+            return b''
+        return self.read_range_func(size, offset)
+
+    def open(self):
+        # Reads are already ranged, so there's nothing to snapshot
+        return self
+
+    def write(self, _):
+        pass
+
+    def get_size(self):
+        return self.size
+
+    def get_listed_size(self):
+        return self.size
+
+    def get_mtime(self):
+        return self.mtime
+
+    def keeps_cache(self):
+        # If the object changes, so does its mtime, and the kernel drops
+        # what it cached of it (with auto_inval_data; see __main__)
+        return self.mtime is not None
@@ -0,0 +1,327 @@
+"""
+Benchmarks of awsfs against a fake AWS, without mounting anything.
+
+Each scenario runs in a process of its own, so that its caches and peak
+RSS are its own, and drives AwsOps the way the kernel would for a few
+common commands (ls -l, cat, find). For each it reports ops/sec, the
+p50/p99 latency of each kind of op, AWS calls per op and peak RSS.
+
+Usage:
+    python tests/bench/bench.py [options] [scenario ...]
+
+With --baseline, exits 1 if any scenario is more than --tolerance worse
+than in the baseline (as written by --json) in calls per op or peak RSS,
+which don't depend on how fast the machine is. With --compare-speed, in
+ops/sec too. CI runs it against tests/bench/baseline.json, made with
+--scale 0.05; remake that with --json when a change is meant to move it.
+"""
+
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import sys
+from collections import OrderedDict
+from stat import S_ISDIR
+from time import time
+
+from fuse import fuse_file_info
+
+from awsfs import clients, stats
+from awsfs.awsfs import AwsOps
+from awsfs.memo import memo
+from fake_aws import FakeAws
+
+
+# Bytes the kernel asks for per read
+READ_SIZE = 128 * 1024
+
+# ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+RSS_UNITS_PER_MB = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+
+
+class Driver:
+    """
+    Makes the calls the kernel would make for some commands, timing each.
+    """
+    def __init__(self, ops):
+        self.ops = ops
+        self.latencies = dict()  # op -> [secs]
+
+    def call(self, op, *args):
+        started = time()
+        try:
+            return self.ops(op, *args)
+        finally:
+            self.latencies.setdefault(op, []).append(time() - started)
+
+    def ls(self, path, stat=True):
+        """
+        :return The names in the dir at path, having stat'd each (as ls -l)
+        """
+        fh = self.call('opendir', path)
+        names = []
+        while True:
+            entries = self.call('readdir', path, fh, len(names))
+            if not entries:
+                break
+            names.extend(name for (name, _, _) in entries)
+        self.call('releasedir', path, fh)
+        if stat:
+            for name in names:
+                self.call('getattr', join(path, name))
+        return names
+
+    def cat(self, path):
+        fi = fuse_file_info()
+        self.call('open', path, fi)
+        contents = []
+        offset = 0
+        while True:
+            chunk = self.call('read', path, READ_SIZE, offset, fi)
+            if not chunk:
+                break
+            contents.append(chunk)
+            offset += len(chunk)
+        self.call('release', path, fi)
+        return b''.join(contents)
+
+    def find(self, path):
+        """
+        :return How many files are under path
+        """
+        file_count = 0
+        for name in self.ls(path, stat=False):
+            child = join(path, name)
+            if S_ISDIR(self.call('getattr', child)['st_mode']):
+                file_count += self.find(child)
+            else:
+                file_count += 1
+        return file_count
+
+
+def join(path, name):
+    return path.rstrip('/') + '/' + name
+
+
+#################################################
+# Scenarios
+#################################################
+
+# name -> (set up the fake with scale, run the commands with a Driver and
+# scale). Scale multiplies the size of the data.
+scenarios = OrderedDict()
+
+
+def scenario(name, set_up_func):
+    def register(run_func):
+        scenarios[name] = (set_up_func, run_func)
+        return run_func
+    return register
+
+
+@scenario('dynamo-100k-keys', lambda aws, scale:
+          aws.add_table('us-west-2', 'bench', int(100000 * scale)))
+def run_dynamo(driver, scale):
+    keys = driver.ls('/dynamo/us-west-2/bench')
+    # Sequential reads, as by grep -r, so that items are read ahead
+    for key in keys[:int(2000 * scale)]:
+        driver.cat('/dynamo/us-west-2/bench/' + key)
+
+
+# About 11k objects under 1365 prefixes, 5 deep
+@scenario('s3-deep-prefixes', lambda aws, scale:
+          aws.add_bucket('bench', 'us-west-2', depth=5, fanout=4,
+                         files_per_prefix=max(1, int(8 * scale))))
+def run_s3(driver, scale):
+    driver.find('/s3/bench')
+    files_per_prefix = max(1, int(8 * scale))
+    for i in range(int(200 * scale)):
+        driver.cat('/s3/bench/d%d/d%d/f%d'
+                   % (i % 4, i // 4 % 4, i // 16 % files_per_prefix))
+
+
+@scenario('ec2-5k-instances', lambda aws, scale:
+          aws.add_instances('us-east-1', int(5000 * scale)))
+def run_ec2(driver, scale):
+    instances = driver.ls('/ec2/us-east-1/instances')
+    for instance_id in instances[:int(1000 * scale)]:
+        driver.cat('/ec2/us-east-1/instances/%s/info' % instance_id)
+        driver.cat('/ec2/us-east-1/instances/%s/status' % instance_id)
+    driver.ls('/ec2/_all/instances')
+
+
+@scenario('iam-large-account', lambda aws, scale:
+          aws.set_iam(users=int(5000 * scale), groups=int(300 * scale),
+                      roles=int(3000 * scale), policies=int(2000 * scale)))
+def run_iam(driver, scale):
+    for user in driver.ls('/iam/users'):
+        driver.cat('/iam/users/%s/info' % user)
+        driver.ls('/iam/users/%s/policies' % user)
+    for policy in driver.ls('/iam/policies')[:int(500 * scale)]:
+        for kind in ['users', 'groups', 'roles']:
+            driver.ls('/iam/policies/%s/%s' % (policy, kind))
+
+
+def run_scenario(name, latency_secs, page_size, scale):
+    """
+    Runs in a fresh process.
+
+    :return The results, as a dict
+    """
+    (set_up, run) = scenarios[name]
+    aws = FakeAws(latency_secs, page_size)
+    set_up(aws, scale)
+    clients.registry.use_session(aws.make_session())
+
+    ops = AwsOps()
+    ops.crash = crash
+
+    driver = Driver(ops)
+    started = time()
+    run(driver, scale)
+    secs = time() - started
+
+    op_count = sum(len(latencies)
+                   for latencies in driver.latencies.values())
+    aws_calls = stats.aws_calls.to_dict()
+    call_count = sum(call['count'] for call in aws_calls.values())
+    return OrderedDict([
+        ('ops', op_count),
+        ('secs', secs),
+        ('ops_per_sec', op_count / secs),
+        ('latency_ms', OrderedDict(
+            (op, OrderedDict([('count', len(latencies)),
+                              ('p50', percentile(latencies, 0.5) * 1000),
+                              ('p99', percentile(latencies, 0.99) * 1000)]))
+            for (op, latencies) in sorted(driver.latencies.items()))),
+        ('aws_calls', call_count),
+        ('aws_calls_per_op', float(call_count) / op_count),
+        ('aws_calls_by_operation',
+         OrderedDict((operation, call['count'])
+                     for (operation, call) in sorted(aws_calls.items()))),
+        ('memo', memo.stats()),
+        ('peak_rss_mb',
+         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / RSS_UNITS_PER_MB)
+    ])
+
+
+def crash():
+    # Rather than dumping core, as a mount would
+    raise Exception('AwsOps crashed; see the log')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+#################################################
+# Reporting
+#################################################
+
+def report(results):
+    for (name, result) in results.items():
+        print('%s: %d ops in %.2fs, %.0f ops/sec, %.3f AWS calls/op, '
+              'peak RSS %.0fMB' % (name, result['ops'], result['secs'],
+                                   result['ops_per_sec'],
+                                   result['aws_calls_per_op'],
+                                   result['peak_rss_mb']))
+        for (op, latency) in result['latency_ms'].items():
+            print('    %-10s %8d  p50 %8.3fms  p99 %8.3fms'
+                  % (op, latency['count'], latency['p50'], latency['p99']))
+        for (operation, count) in result['aws_calls_by_operation'].items():
+            print('    %-40s %6d calls' % (operation, count))
+
+
+def find_regressions(results, baseline, tolerance, compare_speed=False):
+    """
+    :return Descriptions of what got worse by more than tolerance
+    """
+    # (measure, whether higher is worse)
+    measures = [('aws_calls_per_op', True), ('peak_rss_mb', True)]
+    if compare_speed:
+        measures.append(('ops_per_sec', False))
+    regressions = []
+    for (name, result) in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for (measure, higher_is_worse) in measures:
+            (new_value, old_value) = (result[measure], old[measure])
+            limit = (old_value * (1 + tolerance) if higher_is_worse
+                     else old_value * (1 - tolerance))
+            if (new_value > limit if higher_is_worse else new_value < limit):
+                regressions.append('%s: %s went from %.3f to %.3f'
+                                   % (name, measure, old_value, new_value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks awsfs against a fake AWS.')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='Any of: %s (default all)'
+                             % ', '.join(scenarios))
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='How long each AWS call takes (default 0)')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Most results per page of a call '
+                             '(default 1000)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the size of the data, e.g. 0.1 '
+                             'for a quick run (default 1)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write the results to FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Results from --json to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much worse than the baseline counts as '
+                             'a regression (default 0.2)')
+    parser.add_argument('--compare-speed', action='store_true',
+                        help='Also compare ops/sec with the baseline, '
+                             'which is only fair on the same machine')
+    parser.add_argument('--one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        logging.basicConfig(level=logging.WARNING)
+        result = run_scenario(args.one, args.latency_ms / 1000.0,
+                              args.page_size, args.scale)
+        print(json.dumps(result))
+        return
+
+    names = args.scenarios or list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        parser.error('Unknown scenarios: %s' % ', '.join(unknown))
+
+    results = OrderedDict()
+    for name in names:
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--one', name,
+             '--latency-ms', str(args.latency_ms),
+             '--page-size', str(args.page_size),
+             '--scale', str(args.scale)])
+        results[name] = json.loads(output.splitlines()[-1],
+                                   object_pairs_hook=OrderedDict)
+    report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4, separators=(',', ': '))
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f),
+                                           args.tolerance, args.compare_speed)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import datetime
+import hashlib
+from io import BytesIO
+from time import sleep
+
+import boto3
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+
+EPOCH = datetime.datetime(2016, 1, 1)
+
+
+class FakeAws:
+    """
+    Answers AWS calls from made-up data, without any network, by handling
+    the events of the clients of its session. Calls go through boto as
+    usual up to where the request would be sent, so paginators, event
+    handlers and response handling all run as they do against AWS.
+
+    Each operation is answered by the method of the same (snake case) name,
+    called with the region and the call's params. Operations without one
+    fail as if AWS didn't know them.
+
+    :param latency_secs How long each call takes to answer.
+    :param page_size    Most results per page, unless the caller asks for
+                        fewer.
+    """
+    def __init__(self, latency_secs=0.0, page_size=1000):
+        self.latency_secs = latency_secs
+        self.page_size = page_size
+        self.tables = dict()        # (region, table) -> key count
+        self.buckets = dict()       # bucket -> (region, depth, fanout, files)
+        self.instances = dict()     # region -> instance count
+        self.iam_records = []       # (detail list name, record)
+
+    def make_session(self):
+        session = boto3.session.Session(aws_access_key_id='bench',
+                                        aws_secret_access_key='bench')
+        session.events.register('before-parameter-build', self.on_params)
+        session.events.register('before-call', self.on_call)
+        return session
+
+    def on_params(self, params, context, **kwargs):
+        # before-call only gets the serialized request, so keep the params
+        # for it
+        context['fake_params'] = dict(params)
+
+    def on_call(self, model, context, request_signer, **kwargs):
+        if self.latency_secs:
+            sleep(self.latency_secs)
+        answer = getattr(self, xform_name(model.name), None)
+        if answer is None:
+            return (AWSResponse('https://fake', 400, {}, None),
+                    {'Error': {'Code': 'InvalidAction',
+                               'Message': 'FakeAws has no %s' % model.name},
+                     'ResponseMetadata': {'HTTPStatusCode': 400}})
+        parsed = answer(request_signer.region_name,
+                        **context.get('fake_params', {}))
+        parsed.setdefault('ResponseMetadata', {'HTTPStatusCode': 200})
+        return AWSResponse('https://fake', 200, {}, None), parsed
+
+    def get_page(self, items, token, limit=None):
+        """
+        :return (the page of items from token, the token of the next page,
+                or None if that was the last)
+        """
+        start = int(token or 0)
+        end = start + min(limit or self.page_size, self.page_size)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    #################################################
+    # Dynamo
+    #################################################
+
+    def add_table(self, region, table, key_count):
+        self.tables[(region, table)] = key_count
+
+    def list_tables(self, region, ExclusiveStartTableName=None, Limit=None):
+        names = sorted(table for (table_region, table) in self.tables
+                       if table_region == region)
+        if ExclusiveStartTableName is not None:
+            names = [name for name in names if name > ExclusiveStartTableName]
+        (page, next_token) = self.get_page(names, None, Limit)
+        response = {'TableNames': page}
+        if next_token is not None:
+            response['LastEvaluatedTableName'] = page[-1]
+        return response
+
+    def describe_table(self, region, TableName):
+        return {'Table': {
+            'TableName': TableName,
+            'ItemCount': self.tables[(region, TableName)],
+            'KeySchema': [{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            'AttributeDefinitions': [{'AttributeName': 'id',
+                                      'AttributeType': 'S'}]}}
+
+    def scan(self, region, TableName, Segment=0, TotalSegments=1,
+             ExclusiveStartKey=None, Limit=None, **kwargs):
+        key_count = self.tables[(region, TableName)]
+        start = (key_index(ExclusiveStartKey['id']['S']) + TotalSegments
+                 if ExclusiveStartKey else Segment)
+        end = min(key_count, start + TotalSegments *
+                  min(Limit or self.page_size, self.page_size))
+        response = {'Items': [{'id': {'S': key_name(i)}}
+                              for i in range(start, end, TotalSegments)]}
+        response['Count'] = len(response['Items'])
+        if end < key_count and response['Items']:
+            response['LastEvaluatedKey'] = response['Items'][-1]
+        return response
+
+    def get_item(self, region, TableName, Key):
+        return {'Item': make_item(Key['id']['S'])}
+
+    def batch_get_item(self, region, RequestItems):
+        return {
+            'Responses': dict(
+                (table, [make_item(key['id']['S']) for key in request['Keys']])
+                for (table, request) in RequestItems.items()),
+            'UnprocessedKeys': {}
+        }
+
+    #################################################
+    # S3
+    #################################################
+
+    def add_bucket(self, bucket, region, depth, fanout, files_per_prefix):
+        """
+        Makes a tree of prefixes depth deep, each with fanout sub-prefixes
+        (but the deepest) and files_per_prefix objects.
+        """
+        self.buckets[bucket] = (region, depth, fanout, files_per_prefix)
+
+    def list_buckets(self, region):
+        return {'Buckets': [{'Name': bucket, 'CreationDate': EPOCH}
+                            for bucket in sorted(self.buckets)]}
+
+    def get_bucket_location(self, region, Bucket):
+        return {'LocationConstraint': self.buckets[Bucket][0]}
+
+    def list_objects_v2(self, region, Bucket, Prefix='', Delimiter=None,
+                        ContinuationToken=None, MaxKeys=None, **kwargs):
+        (_, depth, fanout, files_per_prefix) = self.buckets[Bucket]
+        level = Prefix.count('/')
+        entries = sorted(
+            ['%sf%d' % (Prefix, i) for i in range(files_per_prefix)] +
+            (['%sd%d/' % (Prefix, i) for i in range(fanout)]
+             if level < depth else []))
+        (page, next_token) = self.get_page(entries, ContinuationToken,
+                                           MaxKeys)
+        response = {
+            'Contents': [{'Key': key, 'Size': object_size(key),
+                          'ETag': object_etag(key), 'LastModified': EPOCH}
+                         for key in page if not key.endswith('/')],
+            'CommonPrefixes': [{'Prefix': key}
+                               for key in page if key.endswith('/')],
+            'KeyCount': len(page),
+            'IsTruncated': next_token is not None
+        }
+        if next_token is not None:
+            response['NextContinuationToken'] = next_token
+        return response
+
+    def get_object(self, region, Bucket, Key, Range=None, **kwargs):
+        size = object_size(Key)
+        (start, end) = (0, size - 1)
+        if Range:
+            (start, end) = [int(n) for n in Range[len('bytes='):].split('-')]
+        body = object_contents(Key)[start:min(end, size - 1) + 1]
+        return {'Body': StreamingBody(BytesIO(body), len(body)),
+                'ContentLength': len(body),
+                'ETag': object_etag(Key)}
+
+    #################################################
+    # EC2
+    #################################################
+
+    def add_instances(self, region, count):
+        self.instances[region] = count
+
+    def describe_instances(self, region, NextToken=None, MaxResults=None,
+                           **kwargs):
+        (page, next_token) = self.get_page(
+            range(self.instances.get(region, 0)), NextToken, MaxResults)
+        response = {'Reservations': [{
+            'ReservationId': 'r-%08d' % i,
+            'Instances': [make_instance(i)]
+        } for i in page]}
+        if next_token is not None:
+            response['NextToken'] = next_token
+        return response
+
+    def describe_instance_status(self, region, NextToken=None,
+                                 MaxResults=None, **kwargs):
+        (page, next_token) = self.get_page(
+            range(self.instances.get(region, 0)), NextToken, MaxResults)
+        response = {'InstanceStatuses': [{
+            'InstanceId': instance_id(i),
+            'InstanceState': {'Code': 16, 'Name': 'running'},
+            'SystemStatus': {'Status': 'ok'},
+            'InstanceStatus': {'Status': 'ok'}
+        } for i in page]}
+        if next_token is not None:
+            response['NextToken'] = next_token
+        return response
+
+    def describe_images(self, region, **kwargs):
+        return {'Images': []}
+
+    def describe_security_groups(self, region, **kwargs):
+        return {'SecurityGroups': [{'GroupId': 'sg-00000000',
+                                    'GroupName': 'default'}]}
+
+    #################################################
+    # IAM
+    #################################################
+
+    def set_iam(self, users, groups, roles, policies, policies_each=3):
+        """
+        Makes an account of that many of each, where every principal has
+        policies_each managed policies attached and every user is in a
+        group.
+        """
+        def attached(i):
+            return [{'PolicyName': policy_name((i + j) % policies)}
+                    for j in range(min(policies_each, policies))]
+        self.iam_records = (
+            [('UserDetailList', {
+                'UserName': 'user-%06d' % i, 'CreateDate': EPOCH,
+                'GroupList': ['group-%06d' % (i % groups)] if groups else [],
+                'AttachedManagedPolicies': attached(i)})
+             for i in range(users)] +
+            [('GroupDetailList', {
+                'GroupName': 'group-%06d' % i, 'CreateDate': EPOCH,
+                'AttachedManagedPolicies': attached(i)})
+             for i in range(groups)] +
+            [('RoleDetailList', {
+                'RoleName': 'role-%06d' % i, 'CreateDate': EPOCH,
+                'AttachedManagedPolicies': attached(i)})
+             for i in range(roles)] +
+            [('Policies', {
+                'PolicyName': policy_name(i), 'CreateDate': EPOCH,
+                'UpdateDate': EPOCH})
+             for i in range(policies)])
+
+    def get_account_authorization_details(self, region, Marker=None,
+                                          MaxItems=None, **kwargs):
+        (page, next_token) = self.get_page(self.iam_records, Marker, MaxItems)
+        response = dict((list_name, []) for list_name in
+                        ['UserDetailList', 'GroupDetailList',
+                         'RoleDetailList', 'Policies'])
+        for (list_name, record) in page:
+            response[list_name].append(record)
+        response['IsTruncated'] = next_token is not None
+        if next_token is not None:
+            response['Marker'] = next_token
+        return response
+
+
+def key_name(i):
+    return 'key-%08d' % i
+
+
+def key_index(name):
+    return int(name[len('key-'):])
+
+
+def make_item(key):
+    return {'id': {'S': key}, 'value': {'N': str(key_index(key))}}
+
+
+def object_size(key):
+    # Varied, but the same every time
+    return 512 + int(hashlib.md5(key).hexdigest()[:4], 16) % 4096
+
+
+def object_etag(key):
+    return '"%s"' % hashlib.md5(key).hexdigest()
+
+
+def object_contents(key):
+    return (key.encode() + b'\n') * (object_size(key) // (len(key) + 1) + 1)
+
+
+def instance_id(i):
+    return 'i-%08x' % i
+
+
+def make_instance(i):
+    return {
+        'InstanceId': instance_id(i),
+        'ImageId': 'ami-%08x' % (i % 20),
+        'InstanceType': 't2.micro',
+        'LaunchTime': EPOCH + datetime.timedelta(minutes=i),
+        'State': {'Code': 16, 'Name': 'running'},
+        'PrivateIpAddress': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255,
+                                             i & 255),
+        'SecurityGroups': [{'GroupId': 'sg-00000000', 'GroupName': 'default'}],
+        'Tags': [{'Key': 'Name', 'Value': 'bench-%d' % i}]
+    }
+
+
+def policy_name(i):
+    return 'policy-%06d' % i
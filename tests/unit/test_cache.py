@@ -0,0 +1,207 @@
+import unittest
+from threading import Event, Thread
+from time import time
+
+from awsfs.cache import STALE_TTL_SECS, CacheBudget, LoadingCache, \
+    cache_stats, estimate_size, note_stale
+
+
+class TestLoadingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = 0
+        self.release_loads = Event()
+        self.release_loads.set()
+
+    def load(self, key):
+        self.loads += 1
+        self.release_loads.wait()
+        return '%s %d' % (key, self.loads)
+
+    def test_when_value_is_fresh_then_dont_reload(self):
+        cache = LoadingCache(self.load)
+        self.assertEqual(cache.get('a'), 'a 1')
+        self.assertEqual(cache.get('a'), 'a 1')
+        self.assertEqual(self.loads, 1)
+
+    def test_when_a_get_has_its_own_load_func_then_load_with_it(self):
+        cache = LoadingCache(self.load)
+        self.assertEqual(cache.get('a', lambda key: key + ' mine'), 'a mine')
+        # It only matters to whoever loads
+        self.assertEqual(cache.get('a', lambda key: key + ' other'),
+                         'a mine')
+        self.assertEqual(cache.get('b'), 'b 1')
+
+    def test_when_value_expires_then_reload(self):
+        cache = LoadingCache(self.load, ttl_secs=0)
+        self.assertEqual(cache.get('a'), 'a 1')
+        self.assertEqual(cache.get('a'), 'a 2')
+
+    def test_when_many_threads_miss_at_once_then_load_only_once(self):
+        cache = LoadingCache(self.load)
+        self.release_loads.clear()
+        results = []
+        threads = [Thread(target=lambda: results.append(cache.get('a')))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        self.release_loads.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['a 1'] * 10)
+        self.assertEqual(self.loads, 1)
+
+    def test_when_a_load_fails_then_waiters_see_the_error_and_retry(self):
+        def failing_load(key):
+            raise ValueError('nope')
+        cache = LoadingCache(failing_load)
+        with self.assertRaises(ValueError):
+            cache.get('a')
+        cache.load_func = self.load
+        self.assertEqual(cache.get('a'), 'a 1')
+
+    def test_when_serving_stale_then_return_old_value_and_refresh(self):
+        cache = LoadingCache(self.load, ttl_secs=0, serve_stale=True)
+        self.assertEqual(cache.get('a'), 'a 1')
+
+        self.release_loads.clear()
+        self.assertEqual(cache.get('a'), 'a 1')
+        self.assertEqual(cache.get('a'), 'a 1')  # Doesn't start another
+        (refresh,) = cache.loads.values()
+        self.release_loads.set()
+        refresh.wait()
+
+        self.assertEqual(self.loads, 2)
+        self.assertEqual(cache.cache['a'][0], 'a 2')
+
+    def test_when_a_load_reads_stale_data_then_keep_it_briefly(self):
+        def load_stale(key):
+            note_stale()
+            return self.load(key)
+        inner = LoadingCache(load_stale)
+        outer = LoadingCache(lambda key: inner.get(key) + ' outer',
+                             ttl_secs=60)
+        self.assertEqual(outer.get('a'), 'a 1 outer')
+        # So is what was loaded from it, even from the cache
+        other = LoadingCache(lambda key: inner.get(key) + ' other',
+                             ttl_secs=60)
+        other.get('a')
+        for cache in [inner, outer, other]:
+            (_, expiry) = cache.cache['a']
+            self.assertLessEqual(expiry, time() + STALE_TTL_SECS)
+
+        # Once it's loaded from fresh data, it's kept as usual
+        inner.load_func = self.load
+        inner.invalidate('a')
+        fresh = LoadingCache(lambda key: inner.get(key), ttl_secs=60)
+        fresh.get('a')
+        self.assertGreater(fresh.cache['a'][1],
+                           time() + STALE_TTL_SECS)
+
+
+class TestCacheBudget(unittest.TestCase):
+
+    def test_when_over_entry_budget_then_evict_lru_across_caches(self):
+        budget = CacheBudget(max_entries=2)
+        cache1 = LoadingCache(lambda key: key, budget=budget)
+        cache2 = LoadingCache(lambda key: key, budget=budget)
+        cache1.get('a')
+        cache2.get('b')
+        cache1.get('a')  # Now b is least recently used
+        cache1.get('c')
+
+        self.assertEqual(list(cache1.cache), ['a', 'c'])
+        self.assertEqual(list(cache2.cache), [])
+        self.assertEqual(budget.stats()['evictions'], 1)
+
+    def test_when_over_byte_budget_then_evict(self):
+        budget = CacheBudget(max_bytes=estimate_size('x' * 1000) * 2)
+        cache = LoadingCache(lambda key: key * 1000, budget=budget)
+        for key in 'abc':
+            cache.get(key)
+        self.assertEqual(list(cache.cache), ['b', 'c'])
+        self.assertEqual(budget.stats()['bytes'],
+                         2 * estimate_size('x' * 1000))
+
+    def test_when_expired_then_reap(self):
+        budget = CacheBudget()
+        cache = LoadingCache(lambda key: key, ttl_secs=0, budget=budget)
+        stale_cache = LoadingCache(lambda key: key, ttl_secs=0,
+                                   serve_stale=True, budget=budget)
+        forever_cache = LoadingCache(lambda key: key, budget=budget)
+        for c in [cache, stale_cache, forever_cache]:
+            c.get('a')
+
+        self.assertEqual(budget.reap(), 1)
+        self.assertEqual(list(cache.cache), [])
+        self.assertEqual(list(stale_cache.cache), ['a'])
+        self.assertEqual(list(forever_cache.cache), ['a'])
+        self.assertEqual(budget.stats()['entries'], 2)
+
+    def test_estimate_size_counts_nested_values(self):
+        self.assertGreater(estimate_size([('name', 'x' * 1000)]), 1000)
+
+    def test_estimate_size_follows_slots(self):
+        class Slotted(object):
+            __slots__ = ['value']
+        slotted = Slotted()
+        slotted.value = 'x' * 1000
+        self.assertGreater(estimate_size(slotted), 1000)
+
+
+class TestLoadMany(unittest.TestCase):
+
+    def test_gets_wait_for_a_batch_load_instead_of_loading(self):
+        cache = LoadingCache(lambda key: 'single %s' % key)
+        batch_started = Event()
+        release_batch = Event()
+
+        def load_batch(keys):
+            batch_started.set()
+            release_batch.wait()
+            return {key: 'batch %s' % key for key in keys if key != 'c'}
+
+        batch = Thread(target=cache.load_many,
+                       args=(['a', 'b', 'c'], load_batch))
+        batch.start()
+        batch_started.wait()
+        results = []
+        getter = Thread(target=lambda: results.append(cache.get('a')))
+        getter.start()
+        release_batch.set()
+        batch.join()
+        getter.join()
+
+        self.assertEqual(results, ['batch a'])
+        self.assertEqual(cache.get('b'), 'batch b')
+        # The batch couldn't load c, so a get loads it itself
+        self.assertEqual(cache.get('c'), 'single c')
+
+    def test_cached_keys_are_not_loaded_again(self):
+        cache = LoadingCache(lambda key: key)
+        cache.get('a')
+        loaded = []
+        cache.load_many(['a', 'b'], lambda keys: loaded.extend(keys) or {})
+        self.assertEqual(loaded, ['b'])
+
+
+class TestCacheStats(unittest.TestCase):
+
+    def test_caches_are_reported_together_by_name(self):
+        caches = [LoadingCache(lambda key: key, name='test-stats')
+                  for _ in range(2)]
+        for cache in caches:
+            cache.get('a')
+            cache.get('a')
+        stats = cache_stats()['test-stats']
+        self.assertEqual(stats['caches'], 2)
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_evictions_are_counted(self):
+        cache = LoadingCache(lambda key: key, max_entries=1,
+                             name='test-evictions')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache_stats()['test-evictions']['evictions'], 1)
@@ -0,0 +1,44 @@
+import unittest
+
+import boto3
+
+from awsfs.clients import ClientRegistry
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def test_when_asked_twice_then_reuse_the_client(self):
+        registry = ClientRegistry()
+        client = registry.get('ec2', 'us-west-2')
+        self.assertIs(registry.get('ec2', 'us-west-2'), client)
+        self.assertEqual(registry.stats(),
+                         dict(clients=1, hits=1, misses=1))
+
+    def test_when_region_or_service_differs_then_make_a_new_client(self):
+        registry = ClientRegistry()
+        ec2_west = registry.get('ec2', 'us-west-2')
+        self.assertIsNot(registry.get('ec2', 'us-east-1'), ec2_west)
+        self.assertIsNot(registry.get('elb', 'us-west-2'), ec2_west)
+        self.assertEqual(registry.stats()['clients'], 3)
+
+    def test_clients_get_the_configured_pool_size(self):
+        client = ClientRegistry(max_pool_connections=7).get('s3', 'us-west-2')
+        self.assertEqual(client.meta.config.max_pool_connections, 7)
+
+    def test_each_client_gets_a_governor(self):
+        registry = ClientRegistry()
+        registry.get('ec2', 'us-west-2')
+        registry.get('iam')
+        self.assertEqual(sorted(registry.governor_stats()),
+                         ['ec2/us-west-2', 'iam/-'])
+
+    def test_when_given_a_session_then_make_clients_from_it(self):
+        registry = ClientRegistry()
+        old_client = registry.get('ec2', 'us-west-2')
+        session = boto3.session.Session(aws_access_key_id='test',
+                                        aws_secret_access_key='test')
+        registry.use_session(session)
+        client = registry.get('ec2', 'us-west-2')
+        self.assertIsNot(client, old_client)
+        self.assertEqual(client._request_signer._credentials.access_key,
+                         'test')
@@ -0,0 +1,153 @@
+import logging
+import unittest
+from concurrent.futures import Future
+
+from awsfs import dynamo
+from awsfs.vfs import PagedListing
+
+
+class TestListingKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.real_get_client = dynamo.get_client
+        dynamo.get_client = lambda region: FakeDynamo()
+        dynamo.key_schemas.cache.clear()
+
+    def tearDown(self):
+        dynamo.get_client = self.real_get_client
+
+    def test_keys_are_scanned_in_parallel_segments(self):
+        names = []
+        dynamo.scan_keys('us-west-2', 'table', names.extend)
+        self.assertEqual(sorted(names),
+                         sorted('%d-%d' % (segment, i)
+                                for segment in range(dynamo.SCAN_SEGMENTS)
+                                for i in range(4)))
+
+    def test_when_the_table_list_is_refreshed_then_keep_the_table_dir(self):
+        real_get = dynamo.tables.get
+        dynamo.tables.get = lambda region: ['table']
+        dynamo.table_dirs.cache.clear()
+        try:
+            region_dir = dynamo.dynamo_root().get_child('us-west-2')
+            table_dir = region_dir.get_child('table')
+            region_dir.cache.invalidate('listing')
+            self.assertIs(region_dir.get_child('table'), table_dir)
+        finally:
+            dynamo.tables.get = real_get
+
+    def test_binary_key_names_round_trip(self):
+        attr = {'B': b'\x00\xffkey'}
+        name = dynamo.get_key_name(attr)
+        self.assertNotIn('/', name)
+        self.assertEqual(dynamo.get_key_attr('B', name), attr)
+        self.assertEqual(dynamo.get_key_attr('N', '42'), {'N': '42'})
+
+
+class FakeDynamo:
+
+    def describe_table(self, TableName):
+        return {'Table': {
+            'KeySchema': [{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            'AttributeDefinitions': [{'AttributeName': 'id',
+                                      'AttributeType': 'S'}]}}
+
+    gets = 0
+
+    def get_item(self, TableName, Key):
+        FakeDynamo.gets += 1
+        return {'Item': dict(Key, value={'N': str(FakeDynamo.gets)})}
+
+    def batch_get_item(self, RequestItems):
+        # Only does one key at a time, as if the table were overloaded
+        keys = RequestItems['table']['Keys']
+        return {
+            'Responses': {'table': [dict(keys[0], value=keys[0]['id'])]},
+            'UnprocessedKeys': ({'table': {'Keys': keys[1:]}}
+                                if len(keys) > 1 else {})
+        }
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, TableName, AttributesToGet, Segment, TotalSegments):
+        assert AttributesToGet == ['id']
+        assert TotalSegments == dynamo.SCAN_SEGMENTS
+        for page in range(2):
+            yield {'Items': [{'id': {'S': '%d-%d' % (Segment, 2 * page + i)}}
+                             for i in range(2)]}
+
+
+class TestBatchGets(unittest.TestCase):
+
+    def setUp(self):
+        self.real_get_client = dynamo.get_client
+        dynamo.get_client = lambda region: FakeDynamo()
+        dynamo.key_schemas.cache.clear()
+
+    def tearDown(self):
+        dynamo.get_client = self.real_get_client
+
+    def test_unprocessed_keys_are_retried(self):
+        item_ids = [('us-west-2', 'table', name) for name in ['a', 'b', 'c']]
+        files = dynamo.batch_get_item_files(item_ids)
+        self.assertEqual(sorted(files), item_ids)
+        self.assertIn(b'"value": "a"', files[item_ids[0]])
+
+    def test_items_that_werent_read_ahead_are_read_fresh_each_time(self):
+        listing = PagedListing(None)
+        listing.add_names(['a', 'b'])
+        read_ahead = dynamo.ReadAhead(lambda: listing)
+        dynamo.items.cache.clear()
+        FakeDynamo.gets = 0
+        for value in ['1', '2']:
+            self.assertIn(b'"value": "%s"' % value.encode(),
+                          dynamo.read_item('us-west-2', 'table', 'b',
+                                           read_ahead))
+        self.assertNotIn(('us-west-2', 'table', 'b'), dynamo.items.cache)
+
+    def test_when_a_read_ahead_batch_fails_then_log_it(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        dynamo.log.addHandler(handler)
+        try:
+            batch = Future()
+            batch.set_exception(IOError('cant talk to aws'))
+            dynamo.on_batch_done(batch)
+        finally:
+            dynamo.log.removeHandler(handler)
+        self.assertEqual([record.levelno for record in records],
+                         [logging.WARNING])
+        self.assertIn('cant talk to aws', records[0].getMessage())
+
+
+class TestReadAhead(unittest.TestCase):
+
+    def setUp(self):
+        self.listing = PagedListing(None)
+        self.listing.add_names(['k%03d' % i for i in range(1000, 0, -1)])
+        self.listing.complete = True
+        self.read_ahead = dynamo.ReadAhead(lambda: self.listing)
+
+    def test_when_reading_in_listed_order_then_read_ahead(self):
+        names = self.listing.names
+        self.assertEqual(self.read_ahead.note_read(names[0]), [])
+        window = self.read_ahead.note_read(names[1])
+        self.assertEqual(window, names[2:2 + dynamo.READ_AHEAD])
+
+        # Don't fetch again until the reader gets through half the window
+        for name in names[2:dynamo.READ_AHEAD // 2 + 2]:
+            self.assertEqual(self.read_ahead.note_read(name), [])
+        window = self.read_ahead.note_read(names[dynamo.READ_AHEAD // 2 + 2])
+        self.assertEqual(window[0], names[dynamo.READ_AHEAD + 2])
+
+    def test_when_reading_in_sorted_order_then_read_ahead(self):
+        names = sorted(self.listing.names)
+        self.read_ahead.note_read(names[10])
+        window = self.read_ahead.note_read(names[11])
+        self.assertEqual(window, names[12:12 + dynamo.READ_AHEAD])
+
+    def test_when_reading_randomly_then_dont_read_ahead(self):
+        for name in ['k500', 'k007', 'k300']:
+            self.assertEqual(self.read_ahead.note_read(name), [])
@@ -0,0 +1,103 @@
+import unittest
+
+from awsfs import ec2
+from awsfs.memo import memo
+
+
+class TestInstanceStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.real_get_client = ec2.get_client
+        ec2.get_client = lambda region: self
+        ec2.instance_statuses.cache.clear()
+        memo.clear()
+
+    def tearDown(self):
+        ec2.get_client = self.real_get_client
+
+    # Fake EC2 client
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_instance_status'
+        return self
+
+    def paginate(self, IncludeAllInstances):
+        assert IncludeAllInstances
+        self.calls += 1
+        for page in range(3):
+            yield {'InstanceStatuses': [
+                {'InstanceId': 'i-%d%d' % (page, i), 'State': 'ok'}
+                for i in range(2)]}
+
+    def test_all_instance_statuses_come_from_one_listing(self):
+        for page in range(3):
+            for i in range(2):
+                status = ec2.get_instance_status('us-west-2',
+                                                 'i-%d%d' % (page, i))
+                self.assertIn(b'"State": "ok"', status)
+        self.assertEqual(self.calls, 1)
+
+    def test_when_statuses_are_dropped_then_theyre_listed_again(self):
+        ec2.get_instance_status('us-west-2', 'i-00')
+        ec2.instance_statuses.invalidate('us-west-2')
+        ec2.get_instance_status('us-west-2', 'i-00')
+        self.assertEqual(self.calls, 2)
+
+    def test_when_instance_has_no_status_then_null(self):
+        self.assertEqual(ec2.get_instance_status('us-west-2', 'i-99'), b'null')
+
+
+class TestImages(unittest.TestCase):
+
+    def setUp(self):
+        self.describes = []
+        self.real_get_client = ec2.get_client
+        self.real_get_regions = ec2.get_regions
+        ec2.get_client = lambda region: self
+        # So that other regions aren't prefetched
+        ec2.get_regions = lambda: ['us-west-2']
+        ec2.instances.cache.cache.clear()
+        memo.clear()
+        self.images = ec2.ec2_root().get_child('us-west-2').get_child('images')
+
+    def tearDown(self):
+        ec2.get_client = self.real_get_client
+        ec2.get_regions = self.real_get_regions
+
+    # Fake EC2 client
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_instances'
+        return self
+
+    def paginate(self):
+        yield {'Reservations': [{'Instances': [
+            {'InstanceId': 'i-1', 'ImageId': 'ami-mine'},
+            {'InstanceId': 'i-2', 'ImageId': 'ami-public'}]}]}
+
+    def describe_images(self, Owners=None, Filters=None):
+        self.describes.append((Owners, Filters))
+        if Owners is not None:
+            assert Owners == ['self']
+            return {'Images': [{'ImageId': 'ami-mine'}]}
+        known = ['ami-public', 'ami-other']
+        return {'Images': [{'ImageId': image_id}
+                           for image_id in Filters[0]['Values']
+                           if image_id in known]}
+
+    def test_only_own_and_instance_images_are_listed(self):
+        self.assertEqual(self.images.get_names(), ['ami-mine', 'ami-public'])
+
+    def test_unlisted_images_are_looked_up_by_id(self):
+        image = self.images.get_child('ami-other')
+        self.assertIn(b'ami-other', image.get_child('info').read())
+        self.assertEqual(self.describes[-1],
+                         (None, [{'Name': 'image-id',
+                                  'Values': ['ami-other']}]))
+
+    def test_when_image_doesnt_exist_then_theres_no_child(self):
+        self.assertIsNone(self.images.get_child('ami-gone'))
+        calls = len(self.describes)
+        self.assertIsNone(self.images.get_child('.hidden'))
+        self.assertEqual(len(self.describes), calls)
@@ -43,6 +43,9 @@ class TestOperationWrapper(unittest.TestCase):
         case(ClientError({'Error': {'Code': 'AuthFailure'}}, 'scan'), EPERM, WARNING)
         case(ClientError({'Error': {'Code': 'UnauthorizedOperation'}}, 'scan'), EPERM, WARNING)
         case(ClientError({'Error': {'Code': 'Blocked'}}, 'scan'), EPERM, WARNING)
+        case(ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'get_object'), ESTALE, WARNING)
+        case(ClientError({'Error': {'Code': 'ThrottlingException'}}, 'scan'), EAGAIN, WARNING)
+        case(ClientError({'Error': {'Code': 'RequestLimitExceeded'}}, 'describe_instances'), EAGAIN, WARNING)
 
         # Code missing or not recognized, but useful HTTPStatusCode
         case(ClientError({'Error': {'HTTPStatusCode': 401}}, 'scan'), EPERM, WARNING)
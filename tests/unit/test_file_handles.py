@@ -0,0 +1,106 @@
+import json
+import unittest
+from errno import EBADF
+
+from fuse import FuseOSError, fuse_file_info
+
+import awsfs
+from awsfs.vfs import CLFile, LFile, RFile, SDir
+
+
+class FileOpsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = 0
+        self.ops = awsfs.AwsOps()
+        self.ops.root = SDir([('file', LFile(self.load)),
+                              ('sized', LFile(self.load, size=9))])
+
+    def load(self):
+        self.loads += 1
+        return b'version %d' % self.loads
+
+    def open(self, path):
+        fi = fuse_file_info()
+        self.assertEqual(self.ops.open(path, fi), 0)
+        return fi
+
+
+class TestFileHandles(FileOpsTestCase):
+
+    def test_when_reading_an_open_file_then_load_it_only_once(self):
+        fi = self.open('/file')
+        self.assertEqual(self.ops.read('/file', 4, 0, fi), b'vers')
+        self.assertEqual(self.ops.read('/file', 100, 4, fi), b'ion 1')
+        self.assertEqual(self.loads, 1)
+
+    def test_when_opening_twice_then_each_handle_has_its_own_snapshot(self):
+        fi1 = self.open('/file')
+        fi2 = self.open('/file')
+        self.assertNotEqual(fi1.fh, fi2.fh)
+        self.assertEqual(self.ops.read('/file', 100, 0, fi1), b'version 1')
+        self.assertEqual(self.ops.read('/file', 100, 0, fi2), b'version 2')
+
+    def test_when_a_handle_is_released_then_reads_fail(self):
+        fi = self.open('/file')
+        self.ops.release('/file', fi)
+        self.assertEqual(self.ops.handles, {})
+        with self.assertRaises(FuseOSError) as cm:
+            self.ops.read('/file', 100, 0, fi)
+        self.assertEqual(cm.exception.errno, EBADF)
+
+
+class TestFileSizes(FileOpsTestCase):
+
+    def test_when_size_is_unknown_then_getattr_doesnt_load(self):
+        self.assertEqual(self.ops.getattr('/file')['st_size'], 0)
+        self.assertEqual(self.loads, 0)
+
+    def test_when_size_is_unknown_then_read_with_direct_io(self):
+        self.assertTrue(self.open('/file').direct_io)
+        self.assertFalse(self.open('/sized').direct_io)
+
+    def test_when_file_is_open_then_getattr_reports_its_exact_size(self):
+        fi = self.open('/file')
+        self.assertEqual(self.ops.getattr('/file', fi)['st_size'], 9)
+
+    def test_when_file_has_been_read_then_getattr_reports_that_size(self):
+        self.open('/file')
+        self.assertEqual(self.ops.getattr('/file')['st_size'], 9)
+
+
+class TestTimestamps(FileOpsTestCase):
+
+    def setUp(self):
+        FileOpsTestCase.setUp(self)
+        self.ops.root = SDir([('file', LFile(self.load)),
+                              ('object', RFile(lambda size, offset: b'',
+                                               0, mtime=1000)),
+                              ('record', CLFile(lambda: b'{}', mtime=1000)),
+                              ('dir', SDir([], mtime=2000))])
+
+    def test_nodes_report_their_own_times(self):
+        self.assertEqual(self.ops.getattr('/object')['st_mtime'], 1000)
+        self.assertEqual(self.ops.getattr('/dir')['st_mtime'], 2000)
+
+    def test_when_time_is_unknown_then_report_mount_time(self):
+        self.assertEqual(self.ops.getattr('/')['st_mtime'], self.ops.mounted)
+        self.assertEqual(self.ops.getattr('/file')['st_mtime'],
+                         self.ops.mounted)
+
+    def test_only_files_that_cant_change_unnoticed_keep_cache(self):
+        self.assertTrue(self.open('/object').keep_cache)
+        self.assertFalse(self.open('/file').keep_cache)
+        self.assertFalse(self.open('/record').keep_cache)
+
+
+class TestStatsFile(unittest.TestCase):
+
+    def test_ops_are_counted_in_the_stats_file(self):
+        ops = awsfs.AwsOps()
+        ops('getattr', '/')
+        fi = fuse_file_info()
+        ops('open', '/.awsfs/stats', fi)
+        stats = json.loads(ops('read', '/.awsfs/stats', 1024 * 1024, 0, fi))
+        self.assertGreaterEqual(stats['fuse_ops']['getattr']['count'], 1)
+        self.assertIn('listings', stats['caches'])
@@ -0,0 +1,86 @@
+import time as time_module
+import unittest
+from time import time
+
+import boto3
+import botocore.endpoint
+from botocore.awsrequest import AWSResponse
+
+from awsfs import governor as governor_module
+from awsfs.governor import Governor
+
+
+class TestGovernor(unittest.TestCase):
+
+    def test_requests_are_paced_once_the_burst_is_spent(self):
+        governor = Governor(rate=20)
+        start = time()
+        for _ in range(30):
+            governor.acquire()
+        # The first 20 are the burst; the next 10 take half a second
+        self.assertGreater(time() - start, 0.4)
+
+    def test_rate_halves_when_throttled_and_creeps_back_up(self):
+        governor = Governor(rate=40)
+        governor.on_throttle()
+        governor.on_throttle()  # Same burst, so no further
+        self.assertEqual(governor.stats()['rate'], 20)
+        for _ in range(20):
+            governor.on_success()
+        self.assertAlmostEqual(governor.stats()['rate'], 21, delta=0.1)
+
+    def test_when_throttled_then_retry_until_it_goes_through(self):
+        client = boto3.client('dynamodb', region_name='us-west-2',
+                              aws_access_key_id='test',
+                              aws_secret_access_key='test')
+        governor = Governor()
+        governor.attach(client)
+        responses = [throttle_response(), throttle_response(),
+                     AWSResponse('https://test', 200, {}, RawBody(
+                         b'{"TableNames": ["table"]}'))]
+        client.meta.events.register('before-send',
+                                    lambda **kwargs: responses.pop(0))
+
+        # Note how long botocore waits between attempts, and make the
+        # governor's delays ones botocore wouldn't pick
+        sleeps = []
+        real_uniform = governor_module.random.uniform
+        governor_module.random.uniform = lambda low, high: 0.0123
+        botocore.endpoint.time = Clock(sleeps)
+        try:
+            self.assertEqual(client.list_tables()['TableNames'], ['table'])
+        finally:
+            governor_module.random.uniform = real_uniform
+            botocore.endpoint.time = time_module
+        self.assertEqual(sleeps, [0.0123, 0.0123])
+        stats = governor.stats()
+        self.assertEqual(stats['throttles'], 2)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['requests'], 3)
+        self.assertLess(stats['rate'], 50)
+
+
+def throttle_response():
+    return AWSResponse('https://test', 400, {}, RawBody(
+        b'{"__type": "com.amazonaws.dynamodb.v20120810#ThrottlingException",'
+        b' "message": "Slow down"}'))
+
+
+class RawBody:
+
+    def __init__(self, content):
+        self.content = content
+
+    def stream(self, **kwargs):
+        yield self.content
+
+
+class Clock:
+    """
+    Stands in for the time module, noting sleeps rather than sleeping.
+    """
+    def __init__(self, sleeps):
+        self.sleep = sleeps.append
+
+    def __getattr__(self, name):
+        return getattr(time_module, name)
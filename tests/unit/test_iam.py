@@ -0,0 +1,72 @@
+import unittest
+
+from awsfs import iam
+from awsfs.memo import memo
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.real_get_client = iam.get_client
+        iam.get_client = lambda: self
+        iam.snapshots.cache.clear()
+        memo.clear()
+        self.root = iam.iam_root()
+
+    def tearDown(self):
+        iam.get_client = self.real_get_client
+
+    # Fake IAM client
+
+    def get_paginator(self, operation):
+        assert operation == 'get_account_authorization_details'
+        return self
+
+    def paginate(self):
+        self.calls += 1
+        yield {
+            'UserDetailList': [
+                {'UserName': 'alice', 'GroupList': ['admins'],
+                 'AttachedManagedPolicies': [{'PolicyName': 'ReadOnly'}]},
+                {'UserName': 'bob'}],
+            'GroupDetailList': [
+                {'GroupName': 'admins',
+                 'AttachedManagedPolicies': [{'PolicyName': 'Admin'}]}],
+        }
+        yield {
+            'RoleDetailList': [
+                {'RoleName': 'deployer',
+                 'AttachedManagedPolicies': [{'PolicyName': 'ReadOnly'}]}],
+            'Policies': [{'PolicyName': 'ReadOnly'}, {'PolicyName': 'Admin'}],
+        }
+
+    def get_names(self, *path):
+        node = self.root
+        for part in path:
+            node = node.get_child(part)
+        return node.get_names()
+
+    def test_whole_tree_comes_from_one_listing(self):
+        self.assertEqual(self.get_names('users'), ['alice', 'bob'])
+        self.assertEqual(self.get_names('users', 'alice', 'groups'),
+                         ['admins'])
+        self.assertEqual(self.get_names('users', 'alice', 'policies'),
+                         ['ReadOnly'])
+        self.assertEqual(self.get_names('users', 'bob', 'groups'), [])
+        self.assertEqual(self.get_names('groups', 'admins', 'policies'),
+                         ['Admin'])
+        self.assertEqual(self.get_names('roles', 'deployer', 'policies'),
+                         ['ReadOnly'])
+        self.assertEqual(self.calls, 1)
+
+    def test_policies_link_back_to_their_principals(self):
+        self.assertEqual(self.get_names('policies', 'ReadOnly', 'users'),
+                         ['alice'])
+        self.assertEqual(self.get_names('policies', 'ReadOnly', 'roles'),
+                         ['deployer'])
+        self.assertEqual(self.get_names('policies', 'Admin', 'groups'),
+                         ['admins'])
+        link = (self.root.get_child('policies').get_child('Admin').
+                get_child('groups').get_child('admins'))
+        self.assertEqual(link.read(), '../../../groups/admins')
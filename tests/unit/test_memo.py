@@ -0,0 +1,160 @@
+import os
+import shutil
+import unittest
+from datetime import datetime
+from tempfile import mkdtemp
+from time import sleep, time
+
+from dateutil.tz import tzutc
+
+from awsfs.cache import STALE_TTL_SECS, LoadingCache
+from awsfs.memo import Memo
+from awsfs.store import DiskStore
+
+
+class TestMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.memo = Memo()
+
+    # Fake client
+
+    def describe_things(self, **params):
+        self.calls.append(('describe_things', params))
+        return {'Things': params.get('Ids', ['all'])}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, **params):
+        self.calls.append(('paginate', params))
+        return [{'Page': page} for page in range(3)]
+
+    def test_when_same_call_is_repeated_then_its_fetched_once(self):
+        for _ in range(3):
+            response = self.memo.call('ec2', 'us-west-2', self,
+                                      'describe_things', Ids=['a', 'b'])
+            self.assertEqual(response, {'Things': ['a', 'b']})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_calls_are_keyed_by_region_and_params(self):
+        self.memo.call('ec2', 'us-west-2', self, 'describe_things')
+        self.memo.call('ec2', 'us-east-1', self, 'describe_things')
+        self.memo.call('ec2', 'us-west-2', self, 'describe_things',
+                       Ids=['a'])
+        self.memo.call('ec2', 'us-west-2', self, 'describe_things',
+                       Ids=['a'])
+        self.assertEqual(len(self.calls), 3)
+
+    def test_when_refetched_then_use_the_callers_client(self):
+        memo = Memo(ttl_secs=0)
+        memo.call('ec2', 'us-west-2', self, 'describe_things')
+        other_calls = []
+        other = type('OtherClient', (), dict(
+            describe_things=lambda _, **params: other_calls.append(params)))
+        memo.call('ec2', 'us-west-2', other(), 'describe_things')
+        self.assertEqual((len(self.calls), len(other_calls)), (1, 1))
+
+    def test_stats_count_calls_saved_per_page(self):
+        for _ in range(2):
+            pages = self.memo.paginate('ec2', 'us-west-2', self,
+                                       'describe_things')
+            self.assertEqual(len(pages), 3)
+        self.assertEqual(self.memo.stats(),
+                         dict(requests=2, hits=1, hit_rate=0.5, calls=3,
+                              calls_saved=3, stale_served=0))
+
+
+class TestStoredMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.calls = 0
+        self.things = ['old']
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Fake client
+
+    def describe_things(self):
+        self.calls += 1
+        return {'Things': list(self.things)}
+
+    def make_memo(self):
+        return Memo(store=DiskStore(os.path.join(self.dir, 'test.sqlite')))
+
+    def test_when_restarted_then_last_response_is_served_while_refetching(self):
+        memo = self.make_memo()
+        memo.call('ec2', 'us-west-2', self, 'describe_things')
+        memo.store.flush()
+
+        self.things = ['new']
+        memo = self.make_memo()
+        self.assertEqual(memo.call('ec2', 'us-west-2', self,
+                                   'describe_things'),
+                         {'Things': ['old']})
+        self.assertEqual(memo.stats()['stale_served'], 1)
+
+        deadline = time() + 5
+        while (memo.call('ec2', 'us-west-2', self, 'describe_things') !=
+               {'Things': ['new']} and time() < deadline):
+            sleep(0.01)
+        self.assertEqual(memo.call('ec2', 'us-west-2', self,
+                                   'describe_things'),
+                         {'Things': ['new']})
+        self.assertEqual(self.calls, 2)
+
+    def test_what_is_cached_from_a_stale_response_is_kept_briefly(self):
+        memo = self.make_memo()
+        memo.call('ec2', 'us-west-2', self, 'describe_things')
+        memo.store.flush()
+
+        self.things = ['new']
+        memo = self.make_memo()
+        things = LoadingCache(lambda _: memo.call('ec2', 'us-west-2', self,
+                                                  'describe_things'),
+                              ttl_secs=60, serve_stale=True)
+        self.assertEqual(things.get('things'), {'Things': ['old']})
+        (_, expiry) = things.cache['things']
+        self.assertLessEqual(expiry, time() + STALE_TTL_SECS)
+
+
+class TestDiskStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'test.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_responses_round_trip(self):
+        response = {'LaunchTime': datetime(2016, 1, 2, 3, 4, 5,
+                                           tzinfo=tzutc()),
+                    'Blob': b'\x00\xff',
+                    'Tags': [{'Key': 'Name', 'Value': u'caf\xe9'}]}
+        store = DiskStore(self.path)
+        store.put('key', response, 42.0)
+        store.flush()
+        self.assertEqual(DiskStore(self.path).get('key'), (response, 42.0))
+
+    def test_when_over_the_limits_then_drop_the_oldest(self):
+        store = DiskStore(self.path, max_entries=2)
+        for (key, fetched) in [('b', 2.0), ('a', 1.0), ('c', 3.0)]:
+            store.put(key, {'Key': key}, fetched)
+        store.flush()
+        self.assertEqual([store.get(key) for key in 'abc'],
+                         [None, ({'Key': 'b'}, 2.0), ({'Key': 'c'}, 3.0)])
+
+        # Replacing one doesn't count twice
+        store.put('b', {'Key': 'b'}, 4.0)
+        store.flush()
+        self.assertEqual(store.get('c'), ({'Key': 'c'}, 3.0))
+
+        store = DiskStore(self.path, max_bytes=1)
+        store.put('d', {'Key': 'd'}, 5.0)
+        store.flush()
+        self.assertEqual([store.get(key) for key in 'bcd'],
+                         [None, None, ({'Key': 'd'}, 5.0)])
@@ -0,0 +1,31 @@
+import unittest
+from threading import Event, Lock
+
+from awsfs.regions import RegionalData
+
+
+class TestRegionalData(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = Lock()
+        self.fetched = []
+        self.all_fetched = Event()
+        self.data = RegionalData(self.fetch, lambda: ['r1', 'r2', 'r3'])
+
+    def fetch(self, region):
+        with self.lock:
+            self.fetched.append(region)
+            if len(self.fetched) == 3:
+                self.all_fetched.set()
+        if region == 'r2':
+            raise IOError('unreachable')
+        return [region + '-thing']
+
+    def test_when_one_region_is_fetched_then_others_are_prefetched(self):
+        self.assertEqual(self.data.get('r1'), ['r1-thing'])
+        self.assertTrue(self.all_fetched.wait(5))
+        self.assertEqual(sorted(self.fetched), ['r1', 'r2', 'r3'])
+
+    def test_all_regions_skip_failed_ones(self):
+        self.assertEqual(self.data.get_all(),
+                         [('r1', ['r1-thing']), ('r3', ['r3-thing'])])
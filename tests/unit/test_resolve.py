@@ -0,0 +1,85 @@
+import unittest
+from errno import ENOENT, ENOTDIR
+from stat import S_IFREG
+
+from fuse import FuseOSError
+
+import awsfs
+from awsfs.vfs import CLDir, LFile, SDir, SFile
+
+
+class TestResolve(unittest.TestCase):
+
+    def setUp(self):
+        self.listings = 0
+        self.ops = awsfs.AwsOps()
+        self.ops.root = SDir([
+            ('dir', CLDir(self.list_dir)),
+            ('file', SFile(b'contents'))
+        ])
+
+    def list_dir(self):
+        self.listings += 1
+        return [('child', SDir([('leaf', SFile(b'%d' % self.listings))]))]
+
+    def test_resolve_finds_nested_nodes(self):
+        self.assertEqual(self.ops.resolve('/dir/child/leaf').read(), b'1')
+        self.assertTrue(self.ops.resolve('/dir/child/').is_dir())
+        self.assertIs(self.ops.resolve('/'), self.ops.root)
+
+    def test_when_path_is_missing_or_not_a_dir_then_fail(self):
+        for (path, expected_errno) in [('/nope', ENOENT),
+                                       ('/dir/nope', ENOENT),
+                                       ('/file/nope', ENOTDIR)]:
+            with self.assertRaises(FuseOSError) as cm:
+                self.ops.resolve(path)
+            self.assertEqual(cm.exception.errno, expected_errno)
+
+    def test_when_resolving_again_then_use_the_path_cache(self):
+        leaf = self.ops.resolve('/dir/child/leaf')
+        self.ops.paths.load_func = None  # Would fail if called
+        self.assertIs(self.ops.resolve('/dir/child/leaf'), leaf)
+
+    def test_when_a_dir_on_the_path_refreshes_then_resolve_again(self):
+        self.assertEqual(self.ops.resolve('/dir/child/leaf').read(), b'1')
+        self.ops.root.get_child('dir').cache.invalidate('listing')
+        self.ops.root.get_child('dir').get_children()
+        self.assertEqual(self.ops.resolve('/dir/child/leaf').read(), b'2')
+
+    def test_readdir_lists_from_an_offset(self):
+        fh = self.ops.opendir('/')
+        self.assertEqual([(name, offset) for (name, _, offset)
+                          in self.ops.readdir('/', fh, 0)],
+                         [('dir', 1), ('file', 2)])
+        self.assertEqual([(name, offset) for (name, _, offset)
+                          in self.ops.readdir('/', fh, 1)],
+                         [('file', 2)])
+        self.assertEqual(self.ops.readdir('/', fh, 2), [])
+        self.ops.releasedir('/', fh)
+        self.assertEqual(self.ops.handles, {})
+
+    def test_readdir_gives_the_attrs_that_getattr_would(self):
+        fh = self.ops.opendir('/')
+        for (name, attrs, _) in self.ops.readdir('/', fh, 0):
+            self.assertEqual(attrs, self.ops.getattr('/' + name))
+
+    def test_when_a_child_is_not_made_yet_then_readdir_gives_no_attrs(self):
+        self.ops.root = SDir([
+            ('lazy', lambda: SFile(b'contents')),
+            ('unsized', LFile(lambda: b'contents'))
+        ])
+        fh = self.ops.opendir('/')
+        self.assertEqual([attrs for (_, attrs, _)
+                          in self.ops.readdir('/', fh, 0)],
+                         [None, dict(st_mode=S_IFREG)])
+        # Once it's been looked up, its attrs are known
+        self.ops.getattr('/lazy')
+        self.assertEqual(self.ops.readdir('/', fh, 0)[0][1]['st_size'], 8)
+
+    def test_when_a_dir_refreshes_then_open_handles_keep_their_listing(self):
+        fh = self.ops.opendir('/dir')
+        self.ops.root.get_child('dir').cache.invalidate('listing')
+        self.assertEqual([name for (name, _, _)
+                          in self.ops.readdir('/dir', fh, 0)],
+                         ['child'])
+        self.assertEqual(self.listings, 1)
@@ -0,0 +1,213 @@
+import unittest
+from io import BytesIO
+from threading import Lock
+from time import sleep, time
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from awsfs import s3
+from awsfs.memo import memo
+from awsfs.vfs import RFile
+
+
+class TestRangedReads(unittest.TestCase):
+
+    def setUp(self):
+        self.client = boto3.client('s3', region_name='us-west-2',
+                                   aws_access_key_id='test',
+                                   aws_secret_access_key='test')
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.real_get_client = s3.get_client
+        s3.get_client = lambda region: self.client
+        s3.block_cache.cache.clear()
+
+        size = 2 * s3.BLOCK_SIZE + 10
+        self.contents = (b'abcdefghijklmnopqrstuvwxyz' * (size // 26 + 1))[:size]
+        self.file = RFile(lambda size, offset:
+                          s3.read_item_range('us-west-2', 'bucket', 'key',
+                                             '"etag"', size, offset),
+                          len(self.contents))
+
+    def tearDown(self):
+        s3.get_client = self.real_get_client
+        self.stubber.deactivate()
+
+    def expect_block(self, index):
+        start = index * s3.BLOCK_SIZE
+        block = self.contents[start:start + s3.BLOCK_SIZE]
+        self.stubber.add_response(
+            'get_object',
+            {'Body': StreamingBody(BytesIO(block), len(block))},
+            {'Bucket': 'bucket', 'Key': 'key', 'IfMatch': '"etag"',
+             'Range': 'bytes=%d-%d' % (start, start + s3.BLOCK_SIZE - 1)})
+
+    def test_when_reading_within_a_block_then_fetch_only_that_block(self):
+        self.expect_block(1)
+        offset = s3.BLOCK_SIZE + 5
+        self.assertEqual(self.file.read(100, offset),
+                         self.contents[offset:offset + 100])
+        self.stubber.assert_no_pending_responses()
+
+    def test_when_reading_across_blocks_then_join_them(self):
+        self.expect_block(0)
+        self.expect_block(1)
+        offset = s3.BLOCK_SIZE - 5
+        self.assertEqual(self.file.read(10, offset),
+                         self.contents[offset:offset + 10])
+
+    def test_when_rereading_a_block_then_serve_it_from_cache(self):
+        self.expect_block(0)
+        self.file.read(10, 0)
+        # No more responses stubbed, so another request would fail
+        self.assertEqual(self.file.read(10, 20), self.contents[20:30])
+
+    def test_when_reading_past_the_end_then_clip(self):
+        self.expect_block(2)
+        offset = len(self.contents) - 4
+        self.assertEqual(self.file.read(100, offset), self.contents[-4:])
+        self.assertEqual(self.file.read(100, len(self.contents)), b'')
+
+
+class TestListing(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = Lock()
+        self.listed = []
+        self.real_get_client = s3.get_client
+        s3.get_client = lambda region: self
+
+    def tearDown(self):
+        s3.get_client = self.real_get_client
+
+    # Fake S3 client, with a tree of prefixes three deep
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Delimiter, Prefix):
+        with self.lock:
+            self.listed.append(Prefix)
+        depth = Prefix.count('/')
+        # Including the prefix itself, as S3 sometimes does
+        yield {'Contents': ([{'Key': Prefix, 'ETag': '"d"', 'Size': 0}]
+                            if Prefix else []) +
+                           [{'Key': Prefix + 'file', 'ETag': '"f"',
+                             'Size': 3}]}
+        if depth < 3:
+            yield {'CommonPrefixes': [{'Prefix': '%s%s/' % (Prefix, name)}
+                                      for name in 'abcd']}
+
+    def test_objects_and_prefixes_are_listed_by_page(self):
+        bucket = s3.PrefixDir('us-west-2', 'bucket')
+        self.assertEqual(bucket.get_names(), ['file', 'a', 'b', 'c', 'd'])
+        self.assertEqual(bucket.get_child('file').get_size(), 3)
+        # Sub-prefixes are kept, with their listings
+        self.assertIs(bucket.get_child('a'), bucket.get_child('a'))
+        self.assertEqual(bucket.get_child('a').get_names(),
+                         ['file', 'a', 'b', 'c', 'd'])
+        self.assertEqual(self.listed, ['', 'a/'])
+
+    def wait_for_listed(self, prefixes):
+        deadline = time() + 5
+        while not prefixes <= set(self.listed) and time() < deadline:
+            sleep(0.01)
+        # Give anything that shouldn't be listed the chance to be
+        sleep(0.05)
+        return set(self.listed)
+
+    def test_when_walked_recursively_then_prefixes_are_listed_ahead(self):
+        bucket = s3.PrefixDir('us-west-2', 'bucket')
+        for name in 'abc':
+            bucket.get_child(name).get_names()
+        # Only the sub-prefixes the walker hasn't got to yet, not theirs
+        self.assertEqual(self.wait_for_listed({'d/'}),
+                         {'', 'a/', 'b/', 'c/', 'd/'})
+
+        # Once it gets to one, its sub-prefixes are listed ahead too
+        bucket.get_child('d').get_names()
+        self.assertEqual(self.wait_for_listed({'d/a/', 'd/d/'}),
+                         {'', 'a/', 'b/', 'c/', 'd/',
+                          'd/a/', 'd/b/', 'd/c/', 'd/d/'})
+
+    def test_when_the_same_prefix_is_listed_again_then_its_not_a_walk(self):
+        bucket = s3.PrefixDir('us-west-2', 'bucket')
+        for _ in range(3):
+            bucket.get_child('a').get_names()
+        bucket.get_child('b').get_names()
+        self.assertEqual(self.wait_for_listed(set()), {'', 'a/', 'b/'})
+
+    def test_walks_list_ahead_only_so_far(self):
+        real_limits = (s3.WALK_THRESHOLD, s3.MAX_WALK_DEPTH,
+                       s3.MAX_WALK_PREFETCHES)
+        (s3.WALK_THRESHOLD, s3.MAX_WALK_DEPTH, s3.MAX_WALK_PREFETCHES) = \
+            (2, 1, 1)
+        try:
+            bucket = s3.PrefixDir('us-west-2', 'bucket')
+            for name in 'ab':
+                bucket.get_child(name).get_names()
+            # Only one of the other two is listed ahead
+            listed = self.wait_for_listed({'', 'a/', 'b/'})
+            self.assertEqual(len(listed - {'', 'a/', 'b/'}), 1)
+
+            # Nor is anything below the depth it may go to
+            for name in 'cd':
+                bucket.get_child(name).get_names()
+            self.assertEqual(self.wait_for_listed(set()),
+                             {'', 'a/', 'b/', 'c/', 'd/'})
+        finally:
+            (s3.WALK_THRESHOLD, s3.MAX_WALK_DEPTH,
+             s3.MAX_WALK_PREFETCHES) = real_limits
+
+
+class TestBucketRegions(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = Lock()
+        self.located = []
+        self.real_get_client = s3.get_client
+        s3.get_client = lambda region: self
+        s3.bucket_regions.cache.clear()
+        s3.bucket_dirs.cache.clear()
+        memo.clear()
+
+    def tearDown(self):
+        s3.get_client = self.real_get_client
+
+    # Fake S3 client
+
+    locations = {'old-virginia': None, 'virginia': '', 'old-ireland': 'EU',
+                 'tokyo': 'ap-northeast-1'}
+
+    def list_buckets(self):
+        return {'Buckets': [{'Name': name} for name in sorted(self.locations)]}
+
+    def get_bucket_location(self, Bucket):
+        with self.lock:
+            self.located.append(Bucket)
+        return {'LocationConstraint': self.locations[Bucket]}
+
+    def test_legacy_locations_are_translated(self):
+        self.assertEqual(s3.get_bucket_region('old-virginia'), 'us-east-1')
+        self.assertEqual(s3.get_bucket_region('virginia'), 'us-east-1')
+        self.assertEqual(s3.get_bucket_region('old-ireland'), 'eu-west-1')
+        self.assertEqual(s3.get_bucket_region('tokyo'), 'ap-northeast-1')
+
+    def test_when_buckets_are_listed_then_all_regions_are_looked_up_once(self):
+        s3.s3_root().get_names()
+        deadline = time() + 5
+        while len(self.located) < len(self.locations) and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(s3.bucket_regions.get('tokyo'), 'ap-northeast-1')
+        s3.s3_root().get_names()
+        sleep(0.05)
+        self.assertEqual(sorted(self.located), sorted(self.locations))
+
+    def test_when_the_bucket_list_is_refreshed_then_keep_the_bucket_dir(self):
+        root = s3.s3_root()
+        bucket_dir = root.get_child('tokyo')
+        root.cache.invalidate('listing')
+        self.assertIs(root.get_child('tokyo'), bucket_dir)
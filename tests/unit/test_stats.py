@@ -0,0 +1,51 @@
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+from awsfs import stats
+from awsfs.stats import Histogram, Timings
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles_are_bucket_bounds(self):
+        histogram = Histogram()
+        for _ in range(98):
+            histogram.record(0.0015)
+        histogram.record(0.1)
+        histogram.record(20)
+        self.assertEqual(histogram.percentile_ms(0.5), 2)
+        self.assertEqual(histogram.percentile_ms(0.99), 128)
+        self.assertEqual(histogram.percentile_ms(1), 20000)
+
+    def test_empty_histogram_has_no_percentiles(self):
+        self.assertIsNone(Histogram().to_dict()['p50_ms'])
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_ops_are_counted_by_name(self):
+        timings = Timings()
+        timings.record('read', 0.001, byte_count=10)
+        timings.record('read', 0.001, error=True, byte_count=5)
+        timings.record('getattr', 0.001)
+        ops = timings.to_dict()
+        self.assertEqual(ops['read']['count'], 2)
+        self.assertEqual(ops['read']['errors'], 1)
+        self.assertEqual(ops['read']['bytes'], 15)
+        self.assertEqual(ops['getattr']['count'], 1)
+
+    def test_aws_calls_are_timed_through_client_events(self):
+        client = boto3.client('dynamodb', region_name='us-west-2',
+                              aws_access_key_id='test',
+                              aws_secret_access_key='test')
+        stats.attach(client)
+        before = (stats.aws_calls.to_dict().
+                  get('dynamodb.ListTables', {}).get('count', 0))
+        with Stubber(client) as stubber:
+            stubber.add_response('list_tables', {'TableNames': []})
+            client.list_tables()
+        self.assertEqual(
+            stats.aws_calls.to_dict()['dynamodb.ListTables']['count'],
+            before + 1)
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from io import BytesIO
+
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from dateutil.tz import tzutc
+
+from awsfs.traffic import Player, Recorder
+
+
+class TestRecordAndReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace')
+        self.listed = 0
+        self.objects = {'k': b'contents', 'binary': b'\x00\xff'}
+        self.modified = datetime(2016, 1, 2, 3, 4, 5, tzinfo=tzutc())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def answer(self, model, context, **kwargs):
+        # Stands in for AWS, after the recorder has seen the call
+        if model.name == 'ListTables':
+            self.listed += 1
+            return (AWSResponse('https://fake', 200, {}, None),
+                    {'TableNames': ['table-%d' % self.listed]})
+        if model.name == 'GetObject':
+            body = self.objects[context['traffic_params']['Key']]
+            return (AWSResponse('https://fake', 200, {}, None),
+                    {'Body': StreamingBody(BytesIO(body), len(body)),
+                     'LastModified': self.modified})
+        return (AWSResponse('https://fake', 404, {}, None),
+                {'Error': {'Code': 'ResourceNotFoundException'}})
+
+    def record(self):
+        recorder = Recorder(self.path)
+        session = recorder.make_session()
+        session.events.register('before-call', self.answer)
+        dynamo = session.client('dynamodb', region_name='us-west-2',
+                                aws_access_key_id='test',
+                                aws_secret_access_key='test')
+        s3 = session.client('s3', region_name='us-west-2',
+                            aws_access_key_id='test',
+                            aws_secret_access_key='test')
+        self.assertEqual(dynamo.list_tables()['TableNames'], ['table-1'])
+        self.assertEqual(dynamo.list_tables()['TableNames'], ['table-2'])
+        # The caller still gets the body the recorder read
+        self.assertEqual(s3.get_object(Bucket='b', Key='k')['Body'].read(),
+                         b'contents')
+        s3.get_object(Bucket='b', Key='binary')
+        with self.assertRaises(ClientError):
+            dynamo.describe_table(TableName='missing')
+        self.assertEqual(recorder.calls, 5)
+
+    def replay(self):
+        session = Player(self.path, latency_scale=0).make_session()
+        return (session.client('dynamodb', region_name='us-west-2'),
+                session.client('s3', region_name='us-west-2'))
+
+    def test_when_replayed_then_calls_get_the_recorded_responses(self):
+        self.record()
+        (dynamo, s3) = self.replay()
+        response = s3.get_object(Bucket='b', Key='k')
+        self.assertEqual(response['Body'].read(), b'contents')
+        self.assertEqual(response['LastModified'], self.modified)
+        self.assertEqual(s3.get_object(Bucket='b', Key='binary')['Body'].
+                         read(), b'\x00\xff')
+        with self.assertRaises(ClientError) as raised:
+            dynamo.describe_table(TableName='missing')
+        self.assertEqual(raised.exception.response['Error']['Code'],
+                         'ResourceNotFoundException')
+
+    def test_when_a_call_repeats_then_replay_its_responses_in_order(self):
+        self.record()
+        (dynamo, _) = self.replay()
+        self.assertEqual([dynamo.list_tables()['TableNames']
+                          for _ in range(3)],
+                         [['table-1'], ['table-2'], ['table-2']])
+
+    def test_when_a_call_was_not_recorded_then_fail(self):
+        self.record()
+        (dynamo, s3) = self.replay()
+        with self.assertRaises(ClientError) as raised:
+            dynamo.describe_table(TableName='other')
+        self.assertEqual(raised.exception.response['Error']['Code'],
+                         'NotInTrace')
+        with self.assertRaises(ClientError):
+            s3.get_object(Bucket='b', Key='k', Range='bytes=0-1')
+
+    def test_when_the_trace_was_cut_short_then_replay_what_made_it(self):
+        self.record()
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        (dynamo, s3) = self.replay()
+        self.assertEqual(dynamo.list_tables()['TableNames'], ['table-1'])
+        self.assertEqual(s3.get_object(Bucket='b', Key='k')['Body'].read(),
+                         b'contents')
@@ -0,0 +1,237 @@
+import unittest
+from datetime import datetime
+from stat import S_IFDIR, S_IFREG
+from threading import Event, Thread
+from time import sleep, time
+
+from awsfs.format import to_timestamp
+from awsfs.vfs import CLDir, CLFile, EntryTable, LDir, LFile, PDir, \
+    PagedListing, SDir, SFile
+
+
+class TestDirs(unittest.TestCase):
+
+    def test_children_are_looked_up_by_name(self):
+        first = SFile(b'1')
+        d = SDir([('a', first), ('b', SFile(b'2')), ('a', SFile(b'3'))])
+        self.assertIs(d.get_child('a'), first)
+        self.assertIsNone(d.get_child('c'))
+        self.assertEqual([name for (name, _) in d.get_children()],
+                         ['a', 'b', 'a'])
+
+    def test_static_dirs_never_change(self):
+        d = SDir([])
+        self.assertTrue(d.is_current(d.get_listing().generation))
+
+    def test_uncached_dirs_always_may_change(self):
+        d = LDir(lambda: [('a', SFile(b'1'))])
+        self.assertIsNotNone(d.get_child('a'))
+        self.assertFalse(d.is_current(d.get_listing().generation))
+
+    def test_cached_dirs_are_current_until_they_reload(self):
+        d = CLDir(lambda: [('a', SFile(b'1'))])
+        generation = d.get_listing().generation
+        self.assertTrue(d.is_current(generation))
+
+        d.cache.invalidate('listing')
+        self.assertNotEqual(d.get_listing().generation, generation)
+        self.assertFalse(d.is_current(generation))
+
+    def test_cached_dirs_are_not_current_once_expired(self):
+        d = CLDir(lambda: [], ttl_sec=0)
+        self.assertFalse(d.is_current(d.get_listing().generation))
+
+    def test_when_a_child_is_a_function_then_make_it_on_first_lookup(self):
+        made = []
+
+        def make(name):
+            made.append(name)
+            return SFile(name.encode())
+
+        d = CLDir(lambda: [(name, lambda _name=name: make(_name))
+                           for name in ['a', 'b']])
+        self.assertEqual(d.get_names(), ['a', 'b'])
+        self.assertEqual(made, [])
+
+        self.assertIs(d.get_child('a'), d.get_child('a'))
+        self.assertEqual(made, ['a'])
+        self.assertEqual([node.read() for (_, node) in d.get_children()],
+                         [b'a', b'b'])
+        self.assertEqual(made, ['a', 'b'])
+
+
+class TestPagedDirs(unittest.TestCase):
+
+    def setUp(self):
+        self.pages = []
+        self.next_page = Event()
+        self.dir = PDir(self.fill, lambda name: SFile(name.encode()))
+
+    def fill(self, add_names):
+        for page in [['a', 'b'], ['c']]:
+            self.next_page.wait()
+            self.next_page.clear()
+            add_names(page)
+
+    def test_names_can_be_listed_as_they_arrive(self):
+        listing = self.dir.get_listing()
+
+        def get_names_from(offset):
+            return [name for (name, _) in listing.get_entries_from(offset, 10)]
+        self.next_page.set()
+        self.assertEqual(get_names_from(0), ['a', 'b'])
+        self.assertEqual(get_names_from(1), ['b'])
+        self.next_page.set()
+        self.assertEqual(get_names_from(2), ['c'])
+        self.assertEqual(get_names_from(3), [])
+
+    def test_entries_only_have_the_nodes_made_so_far(self):
+        listing = self.dir.get_listing()
+        self.next_page.set()
+        self.assertEqual(listing.get_entries_from(0, 10),
+                         [('a', None), ('b', None)])
+        b = self.dir.get_child('b')
+        self.assertEqual(listing.get_entries_from(1, 10), [('b', b)])
+
+    def test_lookups_wait_for_the_name_to_arrive(self):
+        self.next_page.set()
+        self.assertEqual(self.dir.get_child('a').read(), b'a')
+        self.next_page.set()
+        self.assertEqual(self.dir.get_child('c').read(), b'c')
+        self.assertIsNone(self.dir.get_child('d'))
+        self.assertEqual(self.dir.get_names(), ['a', 'b', 'c'])
+
+    def test_when_a_listing_is_dropped_then_its_reload_is_listed_at_once(self):
+        listing = self.dir.get_listing()
+        for _ in range(2):
+            offset = len(listing.names)
+            self.next_page.set()
+            listing.get_entries_from(offset, 10)
+        # e.g. evicted from the budget: nothing stale to serve meanwhile
+        self.dir.cache.invalidate('listing')
+        reloads = []
+        reloader = Thread(target=lambda: reloads.append(
+            self.dir.get_listing()))
+        reloader.daemon = True
+        reloader.start()
+        reloader.join(5)
+        (reloaded,) = reloads
+        self.assertEqual(reloaded.generation, 2)
+        self.assertFalse(reloaded.complete)
+        self.next_page.set()
+        self.assertEqual(reloaded.get_entries_from(0, 10)[0][0], 'a')
+
+    def test_when_a_listing_expires_then_serve_it_until_reloaded(self):
+        self.dir = PDir(self.fill, lambda name: SFile(name.encode()),
+                        ttl_sec=0)
+        listing = self.dir.get_listing()
+        for _ in range(2):
+            offset = len(listing.names)
+            self.next_page.set()
+            listing.get_entries_from(offset, 10)
+        self.assertIs(self.dir.get_listing(), listing)
+        for _ in range(2):
+            self.next_page.set()
+            sleep(0.05)
+        deadline = time() + 5
+        while self.dir.get_listing() is listing and time() < deadline:
+            sleep(0.01)
+        self.assertTrue(self.dir.get_listing().complete)
+
+    def test_when_filling_fails_then_fail_and_try_again(self):
+        def fail(add_names):
+            add_names(['a'])
+            raise IOError('no more')
+        self.dir.fill_func = fail
+        with self.assertRaises(IOError):
+            self.dir.get_names()
+
+        self.dir.fill_func = lambda add_names: add_names(['b'])
+        self.assertEqual(self.dir.get_names(), ['b'])
+
+
+class TestEntryTable(unittest.TestCase):
+
+    def test_names_are_found_and_listed_in_order_added(self):
+        table = EntryTable()
+        names = [u'key-%d' % i for i in range(1000)] + [u'caf\xe9', b'bytes']
+        for name in names:
+            self.assertTrue(table.add(name))
+        self.assertFalse(table.add(u'key-5'))
+        self.assertEqual(len(table), len(names))
+        self.assertEqual(table[1001], u'bytes')
+        self.assertEqual(table[-2], u'caf\xe9')
+        self.assertEqual(table[3:5], [u'key-3', u'key-4'])
+        self.assertEqual(list(table), names)
+        for (i, name) in enumerate(names):
+            self.assertEqual(table.find(name), i)
+        self.assertEqual(table.find(u'key-1000'), -1)
+
+    def test_attributes_are_kept_for_entries_added_with_them(self):
+        table = EntryTable()
+        table.add(u'plain')
+        table.add(u'file', S_IFREG, 5 * 2 ** 40, 1451606400, u'"etag"')
+        table.add(u'dir', S_IFDIR, 0, None, None)
+        self.assertIsNone(table.get_entry(0))
+        entry = table.get_entry(1)
+        self.assertEqual((entry.get_name(), entry.is_dir(), entry.get_type(),
+                          entry.get_listed_size(), entry.get_mtime(),
+                          entry.get_extra()),
+                         (u'file', False, S_IFREG, 5 * 2 ** 40, 1451606400,
+                          u'"etag"'))
+        self.assertTrue(table.get_entry(2).is_dir())
+        self.assertIsNone(table.get_entry(2).get_mtime())
+
+    def test_files_are_made_from_entries_on_each_lookup_but_dirs_are_kept(self):
+        listing = PagedListing(
+            None, make_entry_node_func=lambda entry: (
+                SDir([]) if entry.is_dir()
+                else SFile(entry.get_extra().encode())))
+        listing.add_names([u'file', u'dir'],
+                          attrs=[(S_IFREG, 8, None, u'contents'),
+                                 (S_IFDIR, 0, None, None)])
+        listing.complete = True
+        self.assertEqual(listing.get_child(u'file').read(), b'contents')
+        self.assertIsNot(listing.get_child(u'file'),
+                         listing.get_child(u'file'))
+        self.assertIs(listing.get_child(u'dir'), listing.get_child(u'dir'))
+        # Listed as the entries themselves, or the dir made from one
+        [(_, file_entry), (_, dir_node)] = listing.get_entries_from(0, 10)
+        self.assertEqual(file_entry.get_listed_size(), 8)
+        self.assertIs(dir_node, listing.get_child(u'dir'))
+
+
+class TestFiles(unittest.TestCase):
+
+    def test_cached_files_load_once(self):
+        loads = []
+        f = CLFile(lambda: loads.append(1) or b'contents')
+        self.assertEqual(f.get_size(), 8)
+        self.assertEqual(f.read(3, 1), b'ont')
+        self.assertEqual(len(loads), 1)
+
+    def test_lazy_files_dont_load_to_report_size(self):
+        loads = []
+        f = LFile(lambda: loads.append(1) or b'contents')
+        self.assertEqual(f.get_size(), 0)
+        self.assertFalse(f.is_size_exact())
+        self.assertEqual(loads, [])
+
+        f.read()
+        self.assertEqual(f.get_size(), 8)
+        self.assertTrue(LFile(lambda: b'', size=8).is_size_exact())
+
+    def test_fetched_files_are_as_new_as_their_last_fetch(self):
+        f = LFile(lambda: b'contents')
+        self.assertIsNone(f.get_mtime())
+        before = time()
+        f.read()
+        self.assertGreaterEqual(f.get_mtime(), before)
+
+    def test_record_files_are_as_old_as_their_record(self):
+        f = CLFile(lambda: b'{}', to_timestamp(datetime(2016, 1, 1)))
+        self.assertEqual(f.get_mtime(), 1451606400)
+
+    def test_record_files_keep_cache_only_if_their_mtime_is_their_own(self):
+        self.assertTrue(CLFile(lambda: b'{}').keeps_cache())
+        self.assertFalse(CLFile(lambda: b'{}', 1451606400).keeps_cache())